@@ -0,0 +1,293 @@
+"""
+Opacify benchmark suite.
+
+Generates a deterministic synthetic corpus and inputs, serves the corpus from
+a local http.server and times pacify, satisfy, validate_output and manifest
+parsing. Results are written as JSON so runs on different commits can be
+compared:
+
+    $ python benchmarks/bench.py --out before.json
+    $ git checkout other-branch
+    $ python benchmarks/bench.py --out after.json
+    $ python benchmarks/bench.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import functools
+import contextlib
+import subprocess
+try:
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    ThreadingHTTPServer = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from opacify import Opacify, StatusCodes
+from opacify.manifest import open_manifest, convert_manifest
+
+# Default matrix, --quick uses the first value of each list only
+INPUT_SIZES = [64 * 1024, 1024 * 1024]
+URL_COUNTS = [8, 32]
+URL_SIZE = 64 * 1024
+CHUNK_SIZES = [1, 4096]
+THREADS = [1, 4]
+ENTROPY = ['text', 'binary', 'repeat']
+REPEATS = 3
+SEED = 1234
+# A case is a regression when it is this much slower than the baseline
+THRESHOLD = 1.10
+
+WORDS = [w.encode() for w in (
+    'the of and to in is was for on that with as by at from his her it an were are which this be or has had '
+    'not but first one their its new after who they have two been other when there all during into school '
+    'time may years more most only over city some world would where later up such used many can state about '
+    'national out known university united then made').split()]
+
+def make_data(rng, size, entropy):
+    # text: word soup, binary: uniform random bytes, repeat: a short pattern
+    # with rare mutations
+    if entropy == 'binary':
+        return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+    if entropy == 'repeat':
+        pattern = make_data(rng, 512, 'text')
+        data = bytearray((pattern * (size // len(pattern) + 1))[:size])
+        for _ in range(size // 1024):
+            data[rng.randrange(size)] = rng.getrandbits(8)
+        return bytes(data)
+    out = []
+    n = 0
+    while n < size:
+        w = rng.choice(WORDS)
+        out.append(w)
+        n += len(w) + 1
+    return b' '.join(out)[:size]
+
+def make_corpus(path, url_count, entropy, seed=SEED):
+    # The first url also holds every byte value, so any input can be pacified
+    rng = random.Random('%s-%s-%s' % (seed, url_count, entropy))
+    names = []
+    for i in range(url_count):
+        data = make_data(rng, URL_SIZE, entropy)
+        if i == 0:
+            data = bytes(bytearray(range(256))) + data
+        name = 'c%03d.bin' % (i)
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+        names.append(name)
+    return names
+
+def make_input(path, size, corpus_dir, names, entropy, seed=SEED):
+    # Mostly spans copied out of the corpus, with fresh data mixed in
+    rng = random.Random('%s-%s-%s-input' % (seed, size, entropy))
+    sources = [open(os.path.join(corpus_dir, name), 'rb').read() for name in names]
+    out = bytearray()
+    while len(out) < size:
+        if rng.random() < 0.8:
+            src = rng.choice(sources)
+            n = rng.randint(16, 2048)
+            start = rng.randrange(max(1, len(src) - n))
+            out += src[start:start + n]
+        else:
+            out += make_data(rng, rng.randint(1, 64), entropy)
+    with open(path, 'wb') as f:
+        f.write(bytes(out[:size]))
+
+class QuietHandler(SimpleHTTPRequestHandler if ThreadingHTTPServer else object):
+    def log_message(self, *args):
+        pass
+
+def serve(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % (server.server_address[1])
+
+@contextlib.contextmanager
+def quiet():
+    # Opacify prints progress to stdout
+    with open(os.devnull, 'w') as null:
+        with contextlib.redirect_stdout(null):
+            yield
+
+def timed(fn, repeats, setup=None):
+    times = []
+    result = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.time()
+        with quiet():
+            result = fn()
+        times.append(time.time() - start)
+    return times, result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def record(results, name, params, times, nbytes):
+    best = min(times)
+    results.append({
+        'name': name,
+        'params': params,
+        'seconds': best,
+        'mean': sum(times) / len(times),
+        'runs': len(times),
+        'bytes': nbytes,
+        'mb_per_sec': (nbytes / 1048576.0) / best if best > 0 else None,
+    })
+    sys.stderr.write('%-16s %-60s %8.3fs\n' % (name, json.dumps(params, sort_keys=True), best))
+
+def run_case(results, work, base_url, names, size, url_count, entropy, chunk_sizes, threads, repeats):
+    tag = '%s-%d-%d' % (entropy, url_count, size)
+    input_file = os.path.join(work, 'input-%s.bin' % (tag))
+    url_file = os.path.join(work, 'urls-%s.txt' % (tag))
+    manifest = os.path.join(work, 'manifest-%s.opm' % (tag))
+    out_file = os.path.join(work, 'out-%s.bin' % (tag))
+    make_input(input_file, size, os.path.join(work, 'www-%s-%d' % (entropy, url_count)), names, entropy)
+    with open(url_file, 'w') as f:
+        for name in names:
+            f.write('%s/%s\n' % (base_url, name))
+    params = {'entropy': entropy, 'urls': url_count, 'size': size}
+    pcache = os.path.join(work, 'pcache')
+    scache = os.path.join(work, 'scache')
+    fresh = lambda path: (lambda: shutil.rmtree(path, ignore_errors=True))
+
+    # Cold pacify downloads the corpus and builds the index, warm reuses both.
+    # The manifest of the cold run with the first chunk size is the one
+    # satisfied below, the warm runs write their own.
+    pacify = lambda o, n, path: o.pacify(input_file=input_file, url_file=url_file, manifest=path,
+        overwrite=True, keep_cache=True, threads=n)
+    o = Opacify(cache_dir=pcache, chunk_size=chunk_sizes[0])
+    times, r = timed(lambda: pacify(o, None, manifest), repeats, setup=fresh(pcache))
+    if r != StatusCodes.OK:
+        raise Exception('pacify failed for %s' % (tag))
+    record(results, 'pacify_cold', dict(params, chunk_size=chunk_sizes[0]), times, size)
+    warm = manifest + '.warm'
+    for chunk_size in chunk_sizes:
+        o = Opacify(cache_dir=pcache, chunk_size=chunk_size)
+        for n in threads:
+            times, r = timed(lambda: pacify(o, n, warm), repeats)
+            record(results, 'pacify', dict(params, chunk_size=chunk_size, threads=n), times, size)
+
+    s = Opacify(cache_dir=scache)
+    satisfy = lambda: s.satisfy(manifest=manifest, out_file=out_file, overwrite=True, keep_cache=True)
+    times, r = timed(satisfy, repeats, setup=fresh(scache))
+    if r != StatusCodes.OK:
+        raise Exception('satisfy failed for %s' % (tag))
+    record(results, 'satisfy_cold', params, times, size)
+    times, r = timed(satisfy, repeats)
+    record(results, 'satisfy', params, times, size)
+
+    (version, sha, length) = open_manifest(manifest).header()
+    times, r = timed(lambda: s.validate_output(out_file, sha, length), repeats)
+    record(results, 'validate_output', params, times, size)
+
+    text_manifest = manifest + '.txt'
+    convert_manifest(manifest, text_manifest, fmt='text')
+    for (fmt, path) in (('v2', manifest), ('text', text_manifest)):
+        times, count = timed(lambda: sum(1 for _ in open_manifest(path).entries()), repeats)
+        record(results, 'manifest_parse', dict(params, format=fmt, items=count,
+            manifest_size=os.path.getsize(path)), times, size)
+    shutil.rmtree(pcache, ignore_errors=True)
+    shutil.rmtree(scache, ignore_errors=True)
+
+def run(args):
+    first = lambda values: values[:1] if args.quick else values
+    sizes = args.sizes or first(INPUT_SIZES)
+    url_counts = args.urls or first(URL_COUNTS)
+    chunk_sizes = args.chunk_sizes or first(CHUNK_SIZES)
+    threads = args.threads or THREADS
+    entropies = args.entropy or first(ENTROPY)
+    work = tempfile.mkdtemp(prefix='opacify-bench-')
+    results = []
+    servers = []
+    try:
+        for entropy in entropies:
+            for url_count in url_counts:
+                www = os.path.join(work, 'www-%s-%d' % (entropy, url_count))
+                os.mkdir(www)
+                names = make_corpus(www, url_count, entropy)
+                server, base_url = serve(www)
+                servers.append(server)
+                for size in sizes:
+                    run_case(results, work, base_url, names, size, url_count, entropy, chunk_sizes,
+                        threads, args.repeats)
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeats': args.repeats,
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(data + '\n')
+        sys.stderr.write('Wrote results to: %s\n' % (args.out))
+    else:
+        print(data)
+
+def case_key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+def compare(old_path, new_path, threshold):
+    # Returns the number of cases that got slower than threshold allows
+    old = json.load(open(old_path))
+    new = json.load(open(new_path))
+    before = dict((case_key(r), r) for r in old['results'])
+    regressions = 0
+    print('%s (%s) -> %s (%s)' % (old_path, old.get('commit'), new_path, new.get('commit')))
+    for r in new['results']:
+        b = before.get(case_key(r))
+        if b is None:
+            continue
+        ratio = r['seconds'] / b['seconds'] if b['seconds'] > 0 else 1.0
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-16s %-60s %8.3fs %8.3fs %6.2fx%s' % (r['name'], case_key(r)[1], b['seconds'], r['seconds'],
+            ratio, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Opacify benchmark suite')
+    parser.add_argument('-o', '--out', help='Write JSON results to this path (default is stdout)')
+    parser.add_argument('-q', '--quick', action='store_true', help='Run the smallest case of each dimension only')
+    parser.add_argument('-r', '--repeats', type=int, default=REPEATS, help='Runs per case, the fastest is kept')
+    parser.add_argument('--sizes', type=int, nargs='+', help='Input sizes in bytes')
+    parser.add_argument('--urls', type=int, nargs='+', help='Number of corpus urls')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', help='Chunk sizes for pacify')
+    parser.add_argument('--threads', type=int, nargs='+', help='Thread counts for pacify')
+    parser.add_argument('--entropy', nargs='+', choices=ENTROPY, help='Kinds of synthetic data')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+        help='Slowdown ratio reported as a regression (default is %.2f)' % (THRESHOLD))
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+    if ThreadingHTTPServer is None:
+        sys.exit('The benchmark suite requires Python 3.7 or later')
+    run(args)
+
+if __name__ == '__main__':
+    main()
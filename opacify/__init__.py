@@ -1 +1,2 @@
 from .opacify import Opacify, INFOTXT, EPILOG, StatusCodes
+from .api import Library, OpacifyError, NotCoveredError, SourceError, IntegrityError
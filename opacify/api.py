@@ -0,0 +1,253 @@
+import io
+import os
+import zlib
+import struct
+import hashlib
+import threading
+import contextlib
+
+from .opacifyinfo import VERSION
+from .opacify import Opacify, StatusCodes, ENGINES
+from .corpus import MemoryCorpus
+from .grams import GramTables
+from .selfref import SELF_URL, OutputWindow
+from .manifest import ManifestReader, TextManifestReader, ManifestError, manifest_writer, open_manifest, \
+    GZIP_MAGIC, DEFAULT_FORMAT
+
+#
+# Library API.
+#
+# Opacify works on paths and collects Status objects, which suits the CLI.
+# Library is for embedding: the sources are held in memory (or come from an
+# existing cache directory), the index is built once and shared by every
+# call, data and manifests are bytes or file objects, manifest items are
+# generated one at a time and failures raise the exceptions below. Nothing
+# is written to disk.
+#
+# Matching keeps no state between calls, so one Library can serve several
+# threads. Adding sources rebuilds the index on the next call, a lock makes
+# sure only one thread builds it. Sources are not to be added while other
+# threads are matching.
+#
+
+class OpacifyError(Exception):
+    """
+    Base of the errors raised by Library. code is the StatusCodes value the
+    command line reports for the same failure.
+    """
+    code = StatusCodes.E_FAILED
+
+    def __init__(self, message, code=None):
+        Exception.__init__(self, message)
+        if code is not None:
+            self.code = code
+
+class NotCoveredError(OpacifyError):
+    """Input data at offset is in none of the sources."""
+    code = StatusCodes.E_URL_NOT_FOUND
+
+    def __init__(self, message, offset=None):
+        OpacifyError.__init__(self, message)
+        self.offset = offset
+
+class SourceError(OpacifyError):
+    """A source a manifest needs is missing from the library or too short."""
+    code = StatusCodes.E_OPEN_URL
+
+    def __init__(self, message, url=None):
+        OpacifyError.__init__(self, message)
+        self.url = url
+
+class IntegrityError(OpacifyError):
+    """Rebuilt data does not match the sha256 or length in the manifest."""
+    code = StatusCodes.E_HASH_MISMATCH
+
+def _is_data(value):
+    return isinstance(value, (bytes, bytearray, memoryview))
+
+# What reading a damaged or truncated manifest can raise
+MANIFEST_ERRORS = (ManifestError, zlib.error, struct.error, EOFError, ValueError, IndexError, IOError, OSError)
+
+@contextlib.contextmanager
+def _manifest_errors():
+    try:
+        yield
+    except MANIFEST_ERRORS as e:
+        raise OpacifyError('Invalid manifest: %s' % (e), code=StatusCodes.E_MANIFEST)
+
+def _entries(reader):
+    # reader.entries(), raising OpacifyError for a damaged manifest
+    with _manifest_errors():
+        for item in reader.entries():
+            yield item
+
+def _reader(manifest):
+    # A manifest reader for bytes, a file object or a path
+    if isinstance(manifest, str) and not os.path.exists(manifest):
+        raise OpacifyError('Manifest not found: %s' % (manifest), code=StatusCodes.E_OPEN_MANIFEST)
+    with _manifest_errors():
+        return _open_reader(manifest)
+
+def _open_reader(manifest):
+    if _is_data(manifest):
+        manifest = io.BytesIO(bytes(manifest))
+    if not hasattr(manifest, 'read'):
+        return open_manifest(manifest)
+    if hasattr(manifest, 'seekable') and manifest.seekable():
+        pos = manifest.tell()
+        magic = manifest.read(len(GZIP_MAGIC))
+        manifest.seek(pos)
+        if magic == GZIP_MAGIC:
+            return TextManifestReader(manifest)
+    return ManifestReader(manifest)
+
+class Library(object):
+    """
+    In-memory pacify and satisfy. sources is a dict or an iterable of
+    (url, data) pairs, in the order of a urls list.
+
+        lib = Library([('http://example.com/a.bin', data_a), ...])
+        manifest = lib.pacify_bytes(data)
+        data = lib.satisfy_bytes(manifest)
+    """
+    def __init__(self, sources=None, engine=None, chunk_size=None, self_refs=True):
+        if isinstance(sources, dict):
+            sources = sources.items()
+        self._o = Opacify(engine=engine, chunk_size=chunk_size)
+        self._o.self_refs = self_refs
+        self._o.corpus = MemoryCorpus()
+        self.corpus = self._o.corpus
+        self.urls = []
+        self._lock = threading.Lock()
+        for (url, data) in (sources or []):
+            self.add(url, data)
+
+    @classmethod
+    def from_cache(cls, cache_dir, urls, engine=None, chunk_size=None, self_refs=True):
+        """
+        Library over an existing cache directory (e.g. kept with pacify
+        --keep or --cache-limit) and its urls list. The saved indexes are
+        loaded once and urls that are not cached are left out.
+        """
+        lib = cls.__new__(cls)
+        lib._o = Opacify(cache_dir=cache_dir, engine=engine, chunk_size=chunk_size)
+        lib._o.self_refs = self_refs
+        # Keep the progress messages of build_index() off stdout
+        lib._o.log = io.StringIO()
+        lib.corpus = lib._o.corpus
+        lib.urls = [url for url in urls if lib.corpus.has(url)]
+        lib._lock = threading.Lock()
+        lib._o.build_index(lib.urls)
+        return lib
+
+    def add(self, url, data):
+        """Add or replace a source, sources added later are searched last."""
+        with self._lock:
+            self.corpus.add(url, data)
+            if url not in self.urls:
+                self.urls.append(url)
+            self._o.index = None
+            self._o.grams = None
+
+    def _prepare(self):
+        with self._lock:
+            if self._o.index is None:
+                # Grams first, a thread that sees the index sees both
+                self._o.grams = GramTables.build(self.urls, self.corpus)
+                self._o.index = ENGINES[self._o.engine].build(self.urls, self.corpus)
+
+    def entries(self, data, input_hash=None, feed=None):
+        """
+        Yield (url, offset, length) manifest items for data, which is bytes
+        or a readable file object. input_hash (e.g. hashlib.sha256()) is
+        updated with and feed called on the data as it is read, ahead of the
+        items covering it. Repeats of earlier data are back references to
+        SELF_URL unless self_refs is False. Raises NotCoveredError.
+        """
+        self._prepare()
+        if _is_data(data):
+            size = len(data)
+            data = io.BytesIO(data)
+        else:
+            size = None
+        for (buf_len, url_offset, url) in self._o._match_stream(data, size, self.urls, input_hash, feed,
+                self_refs=self._o.self_refs):
+            if url is None:
+                # url_offset is the input offset here
+                raise NotCoveredError('No source contains the data at offset %d' % (url_offset),
+                    offset=url_offset)
+            yield (url, url_offset, buf_len)
+
+    def pacify(self, data, out, fmt=DEFAULT_FORMAT):
+        """
+        Write the manifest of data (bytes or a readable) to the writable out.
+        Returns (sha256, length) of data.
+        """
+        h = hashlib.sha256()
+        writer = manifest_writer(out, fmt)
+        length = 0
+        for (url, url_offset, buf_len) in self.entries(data, h, writer.feed):
+            writer.add(url, url_offset, buf_len)
+            length += buf_len
+        writer.close(VERSION, h.hexdigest(), length)
+        return (h.hexdigest(), length)
+
+    def pacify_bytes(self, data, fmt=DEFAULT_FORMAT):
+        out = io.BytesIO()
+        self.pacify(data, out, fmt)
+        return out.getvalue()
+
+    def satisfy(self, manifest, out):
+        """
+        Rebuild data into the writable out. manifest is manifest bytes, a
+        readable, a path or an iterable of (url, offset, length) items. A
+        manifest is checked against its header and raises IntegrityError,
+        for plain items nothing is checked. Returns (sha256, length) of the
+        data written. Raises SourceError for sources the library lacks and
+        OpacifyError with code E_MANIFEST for a damaged manifest.
+        """
+        reader = None
+        if _is_data(manifest) or hasattr(manifest, 'read') or isinstance(manifest, str):
+            reader = _reader(manifest)
+            items = _entries(reader)
+        else:
+            items = manifest
+        h = hashlib.sha256()
+        length = 0
+        written = OutputWindow()
+        for (url, url_offset, buf_len) in items:
+            if url == SELF_URL:
+                # A back reference copies output written before it
+                if url_offset >= length:
+                    raise OpacifyError('Back reference to later output: %d' % (url_offset), code=StatusCodes.E_MANIFEST)
+                try:
+                    buf = written.resolve(url_offset, buf_len)
+                except IOError as e:
+                    raise OpacifyError(str(e), code=StatusCodes.E_MANIFEST)
+            else:
+                if not self.corpus.has(url):
+                    raise SourceError('Source not in library: %s' % (url), url=url)
+                buf = self.corpus.read(url, url_offset, buf_len)
+                if len(buf) != buf_len:
+                    raise SourceError('Source is too short: %s' % (url), url=url)
+            out.write(buf)
+            written.write(buf)
+            h.update(buf)
+            length += buf_len
+        sha = h.hexdigest()
+        if reader is not None:
+            with _manifest_errors():
+                (version, expect_sha, expect_length) = reader.header()
+            if sha != expect_sha:
+                raise IntegrityError('Output hash did not match manifest hash')
+            if length != int(expect_length):
+                raise IntegrityError('Output length did not match manifest length', code=StatusCodes.E_LEN_MISMATCH)
+        return (sha, length)
+
+    def satisfy_bytes(self, manifest):
+        out = io.BytesIO()
+        self.satisfy(manifest, out)
+        return out.getvalue()
+
+    def close(self):
+        self.corpus.close()
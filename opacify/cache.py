@@ -0,0 +1,186 @@
+import os
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#
+# Shared on-disk cache.
+#
+# Urls keep their original names (opacify-<sha256(url)>.tmp) so every reader
+# of the cache is unchanged, but each name is a hard link to a content
+# addressed object (opacify-obj-<sha256(data)>.tmp). Urls serving the same
+# bytes therefore share one copy on disk.
+#
+# The modification time of a url link is its last use. When a byte budget is
+# set, evict() removes the least recently used links (and objects nobody
+# links to any more) until the cache fits. The budget covers downloads,
+# byte ranges and indexes. Indexes (.idx) can be rebuilt from the downloads
+# without the network, so they are evicted first.
+#
+# Every process using the cache holds a shared lock on opacify.lock for the
+# whole run. Files are only ever added by atomic rename/link, which needs no
+# exclusive lock. Eviction needs the exclusive lock and is skipped while
+# another process is using the cache, so a file can never disappear under
+# a running pacify or satisfy. Removing the whole cache (no --keep) is
+# skipped the same way.
+#
+LOCK_NAME = 'opacify.lock'
+OBJECT_PREFIX = 'opacify-obj-'
+INDEX_SUFFIX = '.idx'
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
+def parse_size(value):
+    """Parse a byte count such as 4096, 500M or 2G."""
+    if value is None:
+        return None
+    value = str(value).strip().lower().rstrip('b')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+class Cache(object):
+    def __init__(self, cache_dir, limit=None):
+        self.cache_dir = cache_dir
+        self.limit = parse_size(limit)
+        self._lock_f = None
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def object_path(self, digest):
+        return self._path('%s%s.tmp' % (OBJECT_PREFIX, digest))
+
+    def acquire(self):
+        # Shared lock for the duration of a run
+        if fcntl is None or self._lock_f is not None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+        self._lock_f = open(self._path(LOCK_NAME), 'a')
+        fcntl.flock(self._lock_f.fileno(), fcntl.LOCK_SH)
+
+    def release(self):
+        if self._lock_f is not None:
+            self._lock_f.close()
+            self._lock_f = None
+
+    def store(self, tmp, path, digest):
+        """
+        Move a finished download (tmp, with sha256 digest) into the cache as
+        path. Identical content already in the cache is reused instead.
+        """
+        obj = self.object_path(digest)
+        if os.path.exists(obj):
+            os.unlink(tmp)
+        else:
+            os.rename(tmp, obj)
+        link = '%s.%d.link' % (path, os.getpid())
+        if os.path.exists(link):
+            os.unlink(link)
+        try:
+            os.link(obj, link)
+        except OSError:
+            # No hard links on this filesystem, store a private copy
+            with open(obj, 'rb') as src:
+                with open(link, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(1024*1024), b''):
+                        dst.write(chunk)
+        os.rename(link, path)
+        self.touch(path)
+
+    def touch(self, path):
+        # Record a use of a cached file for LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def usage(self):
+        """Return (bytes used, [(mtime, size, path, inode)] of evictable files)."""
+        used = 0
+        seen = set()
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith('opacify-') or name.startswith(OBJECT_PREFIX):
+                continue
+            if not name.endswith(('.tmp', INDEX_SUFFIX, '.rng')):
+                continue
+            path = self._path(name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_ino not in seen:
+                seen.add(st.st_ino)
+                used += st.st_size
+            files.append((st.st_mtime, st.st_size, path, st.st_ino))
+        return used, files
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Hold the exclusive lock for the body of the with statement. Yields
+        False (and holds no lock) when another process is using the cache.
+        A shared lock held by this process is restored afterwards.
+        """
+        lock_f = self._lock_f
+        if fcntl is not None:
+            if lock_f is None:
+                lock_f = open(self._path(LOCK_NAME), 'a')
+            try:
+                fcntl.flock(lock_f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # A failed conversion may have dropped our shared lock
+                if lock_f is self._lock_f:
+                    fcntl.flock(lock_f.fileno(), fcntl.LOCK_SH)
+                else:
+                    lock_f.close()
+                yield False
+                return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                if lock_f is self._lock_f:
+                    fcntl.flock(lock_f.fileno(), fcntl.LOCK_SH)
+                else:
+                    lock_f.close()
+
+    def evict(self):
+        """
+        Remove indexes and then the least recently used files until the
+        cache fits in the limit. Returns the number of bytes freed, or None when the cache is in use
+        by another process.
+        """
+        if self.limit is None:
+            return 0
+        with self.exclusive() as locked:
+            if not locked:
+                return None
+            used, files = self.usage()
+            freed = 0
+            links = {}
+            for (_, _, _, ino) in files:
+                links[ino] = links.get(ino, 0) + 1
+            for (mtime, size, path, ino) in sorted(files, key=lambda f: (not f[2].endswith(INDEX_SUFFIX), f[0])):
+                if used - freed <= self.limit:
+                    break
+                os.unlink(path)
+                links[ino] -= 1
+                if links[ino] == 0:
+                    freed += size
+            self._remove_orphans()
+            return freed
+
+    def _remove_orphans(self):
+        # Objects only linked from their own name are no longer used by any url
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(OBJECT_PREFIX):
+                path = self._path(name)
+                try:
+                    if os.stat(path).st_nlink <= 1:
+                        os.unlink(path)
+                except OSError:
+                    pass
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import threading
+import hashlib
+
+#
+# Pacify checkpoints.
+#
+# While a v2 manifest is written, <manifest>.ckpt records how far pacify got:
+# the input offset every finished manifest block adds up to and the writer
+# state at that point (see ManifestWriter.state()), along with the sha256 of
+# the input read so far. The input is hashed as it is read, ahead of the
+# finished blocks, so the checkpoint takes a copy of the running hash and
+# notes how many bytes it covers. The manifest is synced before the
+# checkpoint is replaced, so the checkpoint never points past data on disk.
+#
+# hashlib objects cannot be saved, so a resumed run hashes the input prefix
+# again. That also proves the input did not change. Hashing is far faster
+# than matching, so this costs little next to the work it saves.
+#
+CHECKPOINT_VERSION = 1
+# Seconds between checkpoints
+CHECKPOINT_INTERVAL = 10
+HASH_BLOCK = 1024 * 1024
+
+def checkpoint_path(manifest):
+    return '%s.ckpt' % (manifest)
+
+def urls_digest(urls):
+    return hashlib.sha256('\n'.join(urls).encode('utf-8')).hexdigest()
+
+def hash_prefix(path, length, h=None, start=0):
+    """Update h (a new sha256 by default) with bytes [start, length) of path."""
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        left = length - start
+        while left > 0:
+            data = f.read(min(HASH_BLOCK, left))
+            if not data:
+                break
+            h.update(data)
+            left -= len(data)
+    return h
+
+def load_checkpoint(manifest):
+    path = checkpoint_path(manifest)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('version') != CHECKPOINT_VERSION:
+        return None
+    return state
+
+def remove_checkpoint(manifest):
+    path = checkpoint_path(manifest)
+    if os.path.exists(path):
+        os.unlink(path)
+
+class Checkpointer(object):
+    """
+    Writes checkpoints of a pacify run. Used as ManifestWriter.on_flush, so
+    it is called whenever a block is complete and saves at most every
+    `interval` seconds. input_hash is the running sha256 of the input, it
+    covers the data fed to the writer (up to ManifestWriter.fed).
+    """
+    def __init__(self, manifest, input_file, urls, input_hash, interval=CHECKPOINT_INTERVAL):
+        self.manifest = manifest
+        self.input_file = input_file
+        self.input_size = os.path.getsize(input_file)
+        self.urls = urls_digest(urls)
+        self.input_hash = input_hash
+        self.interval = interval
+        self.last = time.time()
+
+    def __call__(self, writer):
+        if time.time() - self.last >= self.interval:
+            self.save(writer)
+
+    def save(self, writer):
+        state = writer.state()
+        writer.sync()
+        data = json.dumps({
+            'version': CHECKPOINT_VERSION,
+            'input_size': self.input_size,
+            'urls': self.urls,
+            'offset': state['out_offset'],
+            'hashed': writer.fed,
+            'sha256': self.input_hash.copy().hexdigest(),
+            'manifest': state,
+        })
+        path = checkpoint_path(self.manifest)
+        tmp = '%s.%d.part' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        self.last = time.time()
+
+#
+# Satisfy journal.
+#
+# satisfy writes every source's items straight to their place in the output
+# file, so progress is tracked per source. <out>.journal starts with a line
+# naming the manifest (sha256 and length of the output) followed by a
+# "sha256 url" line per source whose items were all written, the sha256
+# being that of the bytes written in item order. Lines are only appended, a
+# torn last line is ignored and a later line for the same url wins. A
+# resumed run checks these digests against the output file before trusting
+# them, which also covers writes that never reached the disk.
+#
+JOURNAL_VERSION = 1
+
+def journal_path(out_file):
+    return '%s.journal' % (out_file)
+
+def load_journal(out_file, sha, length):
+    """Return url -> digest from the journal of out_file, or None if it is for another manifest."""
+    path = journal_path(out_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        try:
+            head = json.loads(f.readline())
+        except ValueError:
+            return None
+        if head.get('version') != JOURNAL_VERSION or head.get('sha256') != sha or head.get('length') != length:
+            return None
+        done = {}
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            (digest, _, url) = line.rstrip('\n').partition(' ')
+            if len(digest) == 64 and url:
+                done[url] = digest
+    return done
+
+def remove_journal(out_file):
+    path = journal_path(out_file)
+    if os.path.exists(path):
+        os.unlink(path)
+
+class Journal(object):
+    """
+    Appends finished sources to the journal of out_file. add() may be called
+    from several threads.
+    """
+    def __init__(self, out_file, sha, length, append=False):
+        self.path = journal_path(out_file)
+        self._lock = threading.Lock()
+        self._f = open(self.path, 'a' if append else 'w')
+        if not append:
+            self._f.write(json.dumps({'version': JOURNAL_VERSION, 'sha256': sha, 'length': length}) + '\n')
+            self._f.flush()
+
+    def add(self, url, digest):
+        with self._lock:
+            self._f.write('%s %s\n' % (digest, url))
+            self._f.flush()
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,125 @@
+import os
+import mmap
+
+class Corpus(object):
+    """
+    Read-only view of the cached URL data.
+
+    Each cache file is memory mapped once per run and handed out as a
+    memoryview, so the matcher and satisfy take zero-copy slices of it
+    instead of re-opening and re-reading the file for every manifest item.
+    """
+    def __init__(self, path_for, on_open=None):
+        # path_for(url) returns the cache path of a url, on_open(path) is
+        # called the first time a url is mapped
+        self.path_for = path_for
+        self.on_open = on_open
+        self._maps = {}
+        self._views = {}
+
+    def path(self, url):
+        return self.path_for(url)
+
+    def has(self, url):
+        return url in self._views or os.path.exists(self.path_for(url))
+
+    def size(self, url):
+        if url in self._views:
+            return len(self._views[url])
+        path = self.path_for(url)
+        if not os.path.exists(path):
+            return None
+        return os.path.getsize(path)
+
+    def view(self, url):
+        v = self._views.get(url)
+        if v is not None:
+            return v
+        path = self.path_for(url)
+        if self.on_open is not None:
+            self.on_open(path)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap refuses empty files
+                v = memoryview(b'')
+            else:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[url] = m
+                v = memoryview(m)
+        self._views[url] = v
+        return v
+
+    def find(self, url, buf):
+        # Search the whole mapping in C, -1 if buf is not in the url data
+        self.view(url)
+        m = self._maps.get(url)
+        if m is None:
+            return -1
+        return m.find(buf)
+
+    def read(self, url, offset, length):
+        return self.view(url)[offset:offset+length]
+
+    def invalidate(self, url):
+        # Drop the mapping of a url whose cache file is about to be replaced
+        v = self._views.pop(url, None)
+        m = self._maps.pop(url, None)
+        try:
+            if v is not None:
+                v.release()
+            if m is not None:
+                m.close()
+        except BufferError:
+            # A slice handed out earlier is still alive, the mapping is
+            # unmapped once it is garbage collected
+            pass
+
+    def close(self):
+        for url in list(self._views.keys()):
+            self.invalidate(url)
+
+class MemoryCorpus(object):
+    """
+    Corpus over sources held in memory, used by the library API. It has the
+    interface of Corpus, but urls map to bytes instead of cache files.
+    """
+    def __init__(self, sources=None):
+        self._data = {}
+        self._views = {}
+        for (url, data) in (sources or []):
+            self.add(url, data)
+
+    def add(self, url, data):
+        data = bytes(data)
+        self._data[url] = data
+        self._views[url] = memoryview(data)
+
+    def has(self, url):
+        return url in self._data
+
+    def size(self, url):
+        if url not in self._data:
+            return None
+        return len(self._data[url])
+
+    def view(self, url):
+        v = self._views.get(url)
+        if v is None:
+            raise IOError('Source not in corpus: %s' % (url))
+        return v
+
+    def find(self, url, buf):
+        data = self._data.get(url)
+        if data is None:
+            return -1
+        return data.find(buf)
+
+    def read(self, url, offset, length):
+        return self.view(url)[offset:offset+length]
+
+    def invalidate(self, url):
+        self._data.pop(url, None)
+        self._views.pop(url, None)
+
+    def close(self):
+        pass
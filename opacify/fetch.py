@@ -0,0 +1,267 @@
+import os
+import time
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+FETCH_WORKERS = 16
+FETCH_PER_HOST = 4
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+FETCH_TIMEOUT = 5
+# Responses worth retrying, anything else is a permanent failure
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class Fetcher(object):
+    """
+    Downloads urls into cache files.
+
+    All requests share one keep-alive requests.Session whose connection pool
+    is sized for the worker pool. fetch_all() fans a url list out over a
+    bounded thread pool while a per-host semaphore caps how many requests hit
+    the same server at once. Transient errors are retried with exponential
+    backoff and permanent failures land in the `failed` set.
+    """
+    def __init__(self, workers=FETCH_WORKERS, per_host=FETCH_PER_HOST, retries=FETCH_RETRIES,
+            backoff=FETCH_BACKOFF, timeout=FETCH_TIMEOUT, failed=None, store=None, on_download=None):
+        self.workers = int(workers)
+        self.per_host = int(per_host)
+        self.retries = int(retries)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.failed = failed if failed is not None else set()
+        # store(tmp, path, sha256) moves a finished download into place
+        self.store = store
+        # on_download(url, bytes, seconds) is called after every body written
+        self.on_download = on_download
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._hosts_lock:
+            sem = self._hosts.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.per_host)
+                self._hosts[host] = sem
+        return sem
+
+    def _attempts(self, url, work):
+        """
+        Call work() holding one slot of the url's host until it succeeds or
+        the retries are used up. work() sends the request and reads the
+        body, and returns (retry, result) where retry is set for responses
+        worth another try. Connection errors, including ones in the middle
+        of a body, are retried too and the last one is raised.
+        """
+        attempt = 0
+        with self._host_slot(url):
+            while True:
+                try:
+                    (retry, result) = work()
+                    if not retry or attempt >= self.retries:
+                        return result
+                except requests.exceptions.RequestException:
+                    if attempt >= self.retries:
+                        raise
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+
+    def request(self, method, url, **kw):
+        """
+        Issue a request with retries. Returns the response (possibly a non-2xx
+        one that is not worth retrying) or raises the last connection error.
+        The body is not read, so use this for requests without one.
+        """
+        kw.setdefault('timeout', self.timeout)
+        def work():
+            r = self.session.request(method, url, **kw)
+            if r.status_code in RETRY_STATUS:
+                r.close()
+                return (True, r)
+            return (False, r)
+        return self._attempts(url, work)
+
+    def _get(self, url, headers=None):
+        return self.session.request('GET', url, stream=True, timeout=self.timeout, headers=headers)
+
+    def _save(self, r, url, path, tmp, store=True, length=None):
+        # Write a response body to tmp and move it into place as path.
+        # Returns the number of bytes written. A body that is not length
+        # bytes long is left in tmp.
+        h = hashlib.sha256()
+        start = time.time()
+        nbytes = 0
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in r.iter_content(65536):
+                    f.write(chunk)
+                    h.update(chunk)
+                    nbytes += len(chunk)
+        finally:
+            r.close()
+        if self.on_download is not None:
+            self.on_download(url, nbytes, time.time() - start)
+        if length is not None and nbytes != length:
+            return nbytes
+        if store and self.store is not None:
+            self.store(tmp, path, h.hexdigest())
+        else:
+            os.rename(tmp, path)
+        return nbytes
+
+    def fetch(self, url, path):
+        """
+        Download url to path. The body is written to a temporary file which is
+        renamed into place, so readers never see a partial cache file.
+        Returns None on success or an error message.
+        """
+        if url in self.failed:
+            return 'Previously failed url: %s' % (url)
+        tmp = '%s.%d.%d.part' % (path, os.getpid(), threading.current_thread().ident)
+        def work():
+            r = self._get(url)
+            if r.status_code != 200:
+                r.close()
+                return (r.status_code in RETRY_STATUS, r.status_code)
+            self._save(r, url, path, tmp)
+            return (False, None)
+        try:
+            status = self._attempts(url, work)
+            if status is not None:
+                self.failed.add(url)
+                return 'Failed to open URL: %s (status %d)' % (url, status)
+        except requests.exceptions.RequestException as e:
+            self.failed.add(url)
+            return 'Failed to open URL: %s (%s)' % (url, e)
+        except (IOError, OSError) as e:
+            # Not the url's fault, so it is not added to failed
+            return "Failed to open cache '%s'. Error=%s" % (path, e)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        return None
+
+    def fetch_range(self, url, start, end, path, full_path):
+        """
+        Download bytes [start, end) of url to path. A server that ignores the
+        Range header sends the whole body, which is then stored as the full
+        cache file full_path instead. Returns (kind, error) where kind is
+        'range' or 'full'.
+        """
+        if url in self.failed:
+            return (None, 'Previously failed url: %s' % (url))
+        tmp = '%s.%d.%d.part' % (path, os.getpid(), threading.current_thread().ident)
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1), 'Accept-Encoding': 'identity'}
+        def work():
+            r = self._get(url, headers)
+            if r.status_code == 206:
+                first = r.headers.get('Content-Range', '').partition(' ')[2].partition('-')[0]
+                if first != str(start):
+                    r.close()
+                    return (False, (None, 'Unexpected Content-Range from URL: %s' % (url)))
+                if self._save(r, url, path, tmp, store=False, length=end - start) != end - start:
+                    # Cut short without a connection error, worth another try
+                    return (True, (None, 'Short range from URL: %s' % (url)))
+                return (False, ('range', None))
+            if r.status_code == 200:
+                self._save(r, url, full_path, tmp)
+                return (False, ('full', None))
+            r.close()
+            if r.status_code == 416:
+                return (False, (None, 'Source is too short: %s' % (url)))
+            return (r.status_code in RETRY_STATUS, r.status_code)
+        try:
+            result = self._attempts(url, work)
+            if not isinstance(result, tuple):
+                self.failed.add(url)
+                return (None, 'Failed to open URL: %s (status %d)' % (url, result))
+            return result
+        except requests.exceptions.RequestException as e:
+            self.failed.add(url)
+            return (None, 'Failed to open URL: %s (%s)' % (url, e))
+        except (IOError, OSError) as e:
+            return (None, "Failed to open cache '%s'. Error=%s" % (path, e))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def probe(self, url, need):
+        """
+        Check that url serves at least `need` bytes without downloading it.
+        A HEAD request answers most servers. When it is refused or carries no
+        length, a single byte is requested at need-1 and the total size is
+        taken from Content-Range. Returns (size, error) where size may be None
+        if the server does not say, and error is None when the url is usable.
+        """
+        try:
+            r = self.request('HEAD', url, allow_redirects=True)
+            r.close()
+            length = r.headers.get('Content-Length')
+            encoded = r.headers.get('Content-Encoding', 'identity') != 'identity'
+            if r.status_code == 200 and length is not None and not encoded:
+                size = int(length)
+                if size < need:
+                    return (size, 'Source is too short (%d < %d bytes)' % (size, need))
+                return (size, None)
+            last = max(need - 1, 0)
+            def work():
+                r = self._get(url, {'Range': 'bytes=%d-%d' % (last, last), 'Accept-Encoding': 'identity'})
+                try:
+                    if r.status_code in RETRY_STATUS:
+                        return (True, (None, 'Failed to open URL: %s (status %d)' % (url, r.status_code)))
+                    return (False, self._probe_range(r, url, need))
+                finally:
+                    r.close()
+            return self._attempts(url, work)
+        except requests.exceptions.RequestException as e:
+            return (None, 'Failed to open URL: %s (%s)' % (url, e))
+
+    def _probe_range(self, r, url, need):
+        # (size, error) of probe() from the response to a one byte range
+        if r.status_code == 416:
+            return (None, 'Source is too short (< %d bytes)' % (need))
+        if r.status_code == 206:
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            size = int(total) if total.isdigit() else None
+            if size is not None and size < need:
+                return (size, 'Source is too short (%d < %d bytes)' % (size, need))
+            return (size, None)
+        if r.status_code != 200:
+            return (None, 'Failed to open URL: %s (status %d)' % (url, r.status_code))
+        # Ranges are ignored, read no further than the needed bytes
+        size = 0
+        for chunk in r.iter_content(65536):
+            size += len(chunk)
+            if size >= need:
+                return (None, None)
+        return (size, 'Source is too short (%d < %d bytes)' % (size, need))
+
+    def fetch_all(self, items):
+        """
+        Download (url, path) pairs concurrently. Returns a dict of url -> error
+        message for every url that failed.
+        """
+        items = [(url, path) for (url, path) in items if url not in self.failed]
+        if not items:
+            return {}
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            results = pool.map(lambda item: (item[0], self.fetch(item[0], item[1])), items)
+        finally:
+            pool.close()
+            pool.join()
+        return dict((url, err) for (url, err) in results if err is not None)
+
+    def close(self):
+        self.session.close()
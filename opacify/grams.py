@@ -0,0 +1,182 @@
+import os
+import json
+import struct
+from array import array
+from bisect import bisect_right
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .index import index_is_current, cached_urls
+
+#
+# Dense short-gram tables over the URL cache.
+#
+# tables[n][g] is the first position of the n-byte gram with big-endian value
+# g in the corpus, for n = 1..GRAM_MAX, or -1 if no url contains it. Positions
+# are global like in the k-gram index (urls laid end to end). Lookups of short
+# buffers are then a single array access, and tables[1] tells before a run
+# starts which byte values the corpus cannot provide at all.
+#
+# URLs are added in reverse list order and replace the positions of earlier
+# ones, so the URLs at the top of the list win as everywhere else. With NumPy
+# every url is added in one vectorized pass per gram length, without it the
+# first occurrences are collected in plain Python.
+#
+# Positions are 32 bit while the corpus fits, which keeps the 3-gram table at
+# 64MB, and 64 bit for corpora of 2GB and more.
+#
+GRAMS_MAGIC = b'OPCFYGRM'
+GRAMS_VERSION = 2
+GRAM_MAX = 3
+READ_BLOCK = 1024 * 1024
+
+def byte_values(path):
+    """Return the set of byte values in the file at path."""
+    present = set()
+    with open(path, 'rb') as f:
+        while len(present) < 256:
+            data = f.read(READ_BLOCK)
+            if not data:
+                break
+            present.update(bytearray(data))
+    return present
+
+def position_type(total):
+    """The array typecode of positions in a corpus of total bytes."""
+    return 'i' if total < (1 << 31) else 'q'
+
+class GramTables(object):
+    def __init__(self, typecode='i'):
+        self.corpus = None
+        self.urls = []
+        self.sizes = []
+        self.starts = []
+        self.total = 0
+        self.typecode = typecode
+        self.tables = [None] + [array(typecode, [-1]) * (1 << (8*n)) for n in range(1, GRAM_MAX + 1)]
+
+    def add(self, url):
+        data = self.corpus.view(url)
+        if numpy is not None:
+            self._add_numpy(data, self.total)
+        else:
+            self._add_python(data, self.total)
+        self.urls.append(url)
+        self.sizes.append(len(data))
+        self.starts.append(self.total)
+        self.total += len(data)
+
+    def _add_numpy(self, data, base):
+        d = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+        for n in range(1, GRAM_MAX + 1):
+            count = len(d) - n + 1
+            if count <= 0:
+                break
+            grams = d[:count].copy()
+            for j in range(1, n):
+                grams <<= 8
+                grams |= d[j:j+count]
+            (values, first) = numpy.unique(grams, return_index=True)
+            # A view of the array, assigned in place
+            table = numpy.frombuffer(self.tables[n], dtype='i%d' % (self.tables[n].itemsize))
+            table[values] = base + first
+
+    def _add_python(self, data, base):
+        data = bytes(data)
+        table = self.tables[1]
+        for b in range(256):
+            i = data.find(bytes([b]))
+            if i >= 0:
+                table[b] = base + i
+        for n in range(2, GRAM_MAX + 1):
+            table = self.tables[n]
+            first = {}
+            # Walking backwards leaves the first occurrence of every gram
+            for i in range(len(data) - n, -1, -1):
+                first[data[i:i+n]] = i
+            for (gram, i) in first.items():
+                table[int.from_bytes(gram, 'big')] = base + i
+
+    def find(self, buf):
+        """
+        Return (length, url_offset, url) for the longest prefix of buf of at
+        most GRAM_MAX bytes in the corpus, or None if buf[0] never occurs.
+        The cached bytes are compared before a position is returned.
+        """
+        for n in range(min(GRAM_MAX, len(buf)), 0, -1):
+            pos = self.tables[n][int.from_bytes(buf[:n], 'big')]
+            if pos >= 0:
+                doc = bisect_right(self.starts, pos) - 1
+                offset = pos - self.starts[doc]
+                if self.corpus.read(self.urls[doc], offset, n) == buf[:n]:
+                    return (n, offset, self.urls[doc])
+        return None
+
+    def missing(self, present):
+        """Return the byte values of present that the corpus does not contain, sorted."""
+        table = self.tables[1]
+        return sorted(b for b in present if table[b] < 0)
+
+    def save(self, path):
+        meta = json.dumps({
+            'version': GRAMS_VERSION,
+            'n': GRAM_MAX,
+            'typecode': self.typecode,
+            'urls': self.urls,
+            'sizes': self.sizes,
+        }).encode('utf-8')
+        tmp = path + '.part'
+        with open(tmp, 'wb') as f:
+            f.write(GRAMS_MAGIC)
+            f.write(struct.pack('<I', len(meta)))
+            f.write(meta)
+            for table in self.tables[1:]:
+                table.tofile(f)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, urls, corpus):
+        """
+        Load tables written by save(). Returns None if they are missing or
+        stale, i.e. the cached urls or their sizes changed since the build.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            if f.read(len(GRAMS_MAGIC)) != GRAMS_MAGIC:
+                return None
+            (meta_len,) = struct.unpack('<I', f.read(4))
+            meta = json.loads(f.read(meta_len).decode('utf-8'))
+            if meta['version'] != GRAMS_VERSION or meta['n'] != GRAM_MAX:
+                return None
+            if not index_is_current({'urls': meta['urls'][::-1], 'sizes': meta['sizes'][::-1]}, urls, corpus):
+                return None
+            grams = cls.__new__(cls)
+            grams.typecode = meta['typecode']
+            grams.tables = [None]
+            for n in range(1, GRAM_MAX + 1):
+                table = array(grams.typecode)
+                table.fromfile(f, 1 << (8*n))
+                grams.tables.append(table)
+        grams.corpus = corpus
+        grams.urls = []
+        grams.sizes = []
+        grams.starts = []
+        grams.total = 0
+        for url, size in zip(meta['urls'], meta['sizes']):
+            grams.urls.append(url)
+            grams.sizes.append(size)
+            grams.starts.append(grams.total)
+            grams.total += size
+        return grams
+
+    @classmethod
+    def build(cls, urls, corpus):
+        urls = cached_urls(urls, corpus)
+        grams = cls(position_type(sum(corpus.size(url) for url in urls)))
+        grams.corpus = corpus
+        for url in reversed(urls):
+            grams.add(url)
+        return grams
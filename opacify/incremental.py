@@ -0,0 +1,121 @@
+import random
+import hashlib
+from bisect import bisect_right
+
+#
+# Incremental pacify.
+#
+# Both the previous version of a file (rebuilt from its manifest and the
+# cache) and the new version are cut into content-defined chunks with a gear
+# rolling hash: a boundary is placed wherever the top CDC_BITS bits of the
+# hash are zero, so an edit only moves the boundaries around it. Every byte
+# is shifted one bit further up, so bit k of the hash only depends on the
+# last k + 1 bytes and only the top bits cover the whole 32 byte window (as
+# in FastCDC). Testing low bits would cut low-entropy data far too rarely.
+# Chunks of the new file that also occur in the old one reuse the old
+# manifest items, only the rest is matched again.
+#
+CDC_MIN = 2048
+CDC_BITS = 13
+CDC_MAX = 65536
+# The gear hash only depends on the last 32 bytes
+CDC_WINDOW = 32
+READ_BLOCK = 1024 * 1024
+
+_rng = random.Random(0x6f706163)
+GEAR = [_rng.getrandbits(32) for _ in range(256)]
+del _rng
+
+def cdc_chunks(blocks, min_size=CDC_MIN, bits=CDC_BITS, max_size=CDC_MAX):
+    """
+    Cut the data of an iterable of byte blocks into content-defined chunks.
+    Yields (offset, chunk) in order.
+    """
+    gear = GEAR
+    mask = ((1 << bits) - 1) << (32 - bits)
+    pending = b''
+    offset = 0
+    for block in blocks:
+        pending += block
+        start = 0
+        n = len(pending)
+        while n - start >= max_size:
+            cut = _boundary(pending, start, start + max_size, min_size, mask, gear)
+            yield (offset, pending[start:cut])
+            offset += cut - start
+            start = cut
+        if start:
+            pending = pending[start:]
+    # The tail is shorter than max_size, cut it the same way
+    start = 0
+    while start < len(pending):
+        cut = _boundary(pending, start, len(pending), min_size, mask, gear)
+        yield (offset, pending[start:cut])
+        offset += cut - start
+        start = cut
+
+def _boundary(data, start, end, min_size, mask, gear):
+    # End of the chunk starting at start, at most end. Hashing starts one
+    # window before min_size, which gives the same hash as starting at start.
+    i = start + min_size - CDC_WINDOW
+    if i >= end:
+        return end
+    h = 0
+    limit = start + min_size
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & 0xffffffff
+        i += 1
+        if i >= limit and not (h & mask):
+            return i
+    return end
+
+def chunk_key(chunk):
+    return hashlib.blake2b(chunk, digest_size=16).digest()
+
+class PreviousVersion(object):
+    """
+    Chunks of the previous version of a file and the manifest items that
+    produced them. entries are (url, offset, length) in output order and
+    read(url, offset, length) returns source bytes from the cache.
+    """
+    def __init__(self, entries, read):
+        self.starts = []
+        self.items = []
+        out = 0
+        for (url, offset, length) in entries:
+            self.starts.append(out)
+            self.items.append((url, offset, length))
+            out += length
+        self.length = out
+        self.chunks = {}
+        for (offset, chunk) in cdc_chunks(self._content(read)):
+            self.chunks.setdefault(chunk_key(chunk), offset)
+
+    def _content(self, read):
+        # Items are often tiny, hand them to cdc_chunks in large blocks
+        buf = bytearray()
+        for (url, offset, length) in self.items:
+            data = read(url, offset, length)
+            if len(data) != length:
+                raise IOError('Source is too short: %s' % (url))
+            buf += data
+            if len(buf) >= READ_BLOCK:
+                yield bytes(buf)
+                del buf[:]
+        if buf:
+            yield bytes(buf)
+
+    def find(self, chunk):
+        # Output offset of an identical chunk in the previous version or None
+        return self.chunks.get(chunk_key(chunk))
+
+    def items_between(self, start, end):
+        """Yield the items covering output bytes [start, end), clipped to it."""
+        i = bisect_right(self.starts, start) - 1
+        while i < len(self.items) and self.starts[i] < end:
+            (url, offset, length) = self.items[i]
+            lo = max(start, self.starts[i])
+            hi = min(end, self.starts[i] + length)
+            if hi > lo:
+                yield (url, offset + lo - self.starts[i], hi - lo)
+            i += 1
@@ -0,0 +1,203 @@
+import os
+import json
+import struct
+import hashlib
+from array import array
+
+#
+# On-disk k-gram index over the URL cache.
+#
+# Every position of every cached URL is hashed by the k-gram that starts there
+# and chained LZ77-style: head[slot] holds the most recent global position for
+# a slot and prev[pos] links to the previous position with the same slot.
+# Buffers shorter than k (the tail of the input, or tiny chunk sizes) are left
+# to the dense short-gram tables in grams.py.
+#
+# A lookup walks at most max_candidates positions of one chain and verifies each
+# against the cached bytes, so finding a buffer no longer depends on how many
+# URLs are in the list.
+#
+# URLs are added in reverse list order. Chains run from the most recently
+# added position backwards, so the URLs at the top of the list are tried first
+# and win ties, the same as the linear scan.
+#
+INDEX_MAGIC = b'OPCFYIDX'
+INDEX_VERSION = 4
+INDEX_K = 3
+INDEX_BITS = 20
+INDEX_CANDIDATES = 32
+
+def index_path(cache_dir, urls, kind='index'):
+    h = hashlib.sha256('\n'.join(urls).encode()).hexdigest()
+    return '%s/opacify-%s-%s.idx' % (cache_dir, kind, h)
+
+def cached_urls(urls, corpus):
+    # The urls an index covers: cached ones, in list order, without duplicates
+    seen = set()
+    out = []
+    for url in urls:
+        if url in seen or not corpus.has(url):
+            continue
+        seen.add(url)
+        out.append(url)
+    return out
+
+def index_is_current(meta, urls, corpus):
+    # An index is stale if the set of cached urls or any of their sizes changed
+    if meta['urls'] != cached_urls(urls, corpus):
+        return False
+    for url, size in zip(meta['urls'], meta['sizes']):
+        if corpus.size(url) != size:
+            return False
+    return True
+
+def common_prefix(a, b):
+    # Length of the common prefix of a and b using slice compares (done in C)
+    # instead of a Python loop over every byte
+    hi = min(len(a), len(b))
+    if a[:hi] == b[:hi]:
+        return hi
+    lo = 0
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class NgramIndex(object):
+    def __init__(self, k=INDEX_K, bits=INDEX_BITS, max_candidates=INDEX_CANDIDATES):
+        self.k = k
+        self.bits = bits
+        self.max_candidates = max_candidates
+        self.corpus = None
+        self.urls = []
+        self.sizes = []
+        self.starts = []
+        self.total = 0
+        # Positions are 64 bit, the cache may well be larger than 2GB
+        self.head = array('q', [-1]) * (1 << bits)
+        self.prev = array('q')
+
+    def _slot(self, gram):
+        # Fibonacci hashing of the gram value into `bits` bits
+        return ((int.from_bytes(gram, 'big') * 2654435761) & 0xffffffff) >> (32 - self.bits)
+
+    def add(self, url):
+        data = self.corpus.view(url)
+        base = self.total
+        k = self.k
+        head = self.head
+        prev = self.prev
+        slot = self._slot
+        n = len(data)
+        for i in range(n):
+            if i + k <= n:
+                s = slot(data[i:i+k])
+                prev.append(head[s])
+                head[s] = base + i
+            else:
+                prev.append(-1)
+        self.urls.append(url)
+        self.sizes.append(n)
+        self.starts.append(base)
+        self.total += n
+
+    def _locate(self, pos):
+        # Map a global position to (document, offset) by bisecting starts
+        lo, hi = 0, len(self.starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.starts[mid] <= pos:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo, pos - self.starts[lo]
+
+    def _read(self, doc, offset, length):
+        return self.corpus.read(self.urls[doc], offset, length)
+
+    def find(self, buf):
+        """
+        Return (length, url_offset, url) for the longest prefix of buf that
+        was found among the candidates, or None if there were none. Buffers
+        shorter than k never have candidates.
+        """
+        k = self.k
+        best_len = 0
+        best_doc = None
+        best_off = None
+        if len(buf) >= k:
+            pos = self.head[self._slot(buf[:k])]
+            tries = 0
+            while pos >= 0 and tries < self.max_candidates:
+                tries += 1
+                doc, off = self._locate(pos)
+                n = common_prefix(self._read(doc, off, len(buf)), buf)
+                if n > best_len:
+                    best_len, best_doc, best_off = n, doc, off
+                    if n == len(buf):
+                        break
+                pos = self.prev[pos]
+        if best_len == 0:
+            return None
+        return (best_len, best_off, self.urls[best_doc])
+
+    def close(self):
+        pass
+
+    def save(self, path):
+        meta = json.dumps({
+            'version': INDEX_VERSION,
+            'k': self.k,
+            'bits': self.bits,
+            'urls': self.urls,
+            'sizes': self.sizes,
+        }).encode('utf-8')
+        tmp = path + '.part'
+        with open(tmp, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('<I', len(meta)))
+            f.write(meta)
+            self.head.tofile(f)
+            self.prev.tofile(f)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, urls, corpus):
+        """
+        Load an index written by save(). Returns None if the index is missing
+        or stale, i.e. the cached urls or their sizes changed since it was built.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            (meta_len,) = struct.unpack('<I', f.read(4))
+            meta = json.loads(f.read(meta_len).decode('utf-8'))
+            if meta['version'] != INDEX_VERSION:
+                return None
+            if not index_is_current({'urls': meta['urls'][::-1], 'sizes': meta['sizes'][::-1]}, urls, corpus):
+                return None
+            index = cls(k=meta['k'], bits=meta['bits'])
+            index.head = array('q')
+            index.head.fromfile(f, 1 << index.bits)
+            index.prev = array('q')
+            index.prev.frombytes(f.read())
+        index.corpus = corpus
+        for url, size in zip(meta['urls'], meta['sizes']):
+            index.urls.append(url)
+            index.sizes.append(size)
+            index.starts.append(index.total)
+            index.total += size
+        return index
+
+    @classmethod
+    def build(cls, urls, corpus):
+        index = cls()
+        index.corpus = corpus
+        for url in reversed(cached_urls(urls, corpus)):
+            index.add(url)
+        return index
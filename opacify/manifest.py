@@ -0,0 +1,570 @@
+import os
+import zlib
+import gzip
+import struct
+import hashlib
+import binascii
+from bisect import bisect_right
+
+#
+# Manifest formats
+#
+# text (v1): gzip compressed lines of "url offset length" followed by a
+#   "_header:version:sha256:length" line.
+#
+# v2: binary, written by ManifestWriter.
+#   MANIFEST_MAGIC
+#   blocks      b'B' u32(len) zlib(records), each holding up to BLOCK_ITEMS items
+#   end         b'E', or b'H' when the block index carries digests
+#   url table   u32(len) zlib(varint(len(url)) url ...)
+#   block index u32(count) BLOCK_ENTRY per block, followed by the sha256 of
+#               the block's output (BLOCK_DIGEST) after b'H'
+#   trailer     TRAILER, always the last TRAILER.size bytes of the file
+#
+#   A record is varint(url_id * 2 + new), [varint(len(url)) url] when new is
+#   set (first use of url_id in the manifest), zigzag varint(offset - end of
+#   the previous item of url_id in the same block) and varint(length).
+#   Offsets are delta encoded so a contiguous run from one source costs one
+#   byte, and the deltas restart in every block so any block decodes on its
+#   own given the url table.
+#
+#   The trailer sits at a fixed place, so reading the header is a single seek
+#   and read. The block index maps output offsets to compressed blocks so a
+#   reader can jump to any output range without decompressing what comes
+#   before it. A pipe can still be read front to back because urls are also
+#   defined inline and the blocks are length prefixed.
+#
+#   The output data can be handed to the writer with feed() as it is read.
+#   Each block then gets the sha256 of the output bytes it covers, so any
+#   output range can be checked on its own and a mismatch points at the
+#   block, and with it the sources, that produced the wrong bytes. Manifests
+#   written without feed() end with b'E' and have no digests.
+#
+MANIFEST_MAGIC = b'OPCFYM\x02'
+GZIP_MAGIC = b'\x1f\x8b'
+FORMATS = ('v2', 'text')
+DEFAULT_FORMAT = 'v2'
+READ_SIZE = 65536
+BLOCK_ITEMS = 4096
+# magic, version, sha256, length, url table offset, block index offset
+TRAILER = struct.Struct('<6s16s32sQQQ')
+TRAILER_MAGIC = b'OPCFYT'
+# file offset, compressed size, output offset, output length, items
+BLOCK_ENTRY = struct.Struct('<QIQQI')
+BLOCK_DIGEST = 32
+U32 = struct.Struct('<I')
+
+class ManifestError(Exception):
+    pass
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+class Block(object):
+    def __init__(self, file_offset, size, out_offset, out_length, items, digest=None):
+        self.file_offset = file_offset
+        self.size = size
+        self.out_offset = out_offset
+        self.out_length = out_length
+        self.items = items
+        # sha256 of the output bytes of the block, or None
+        self.digest = digest
+
+class ManifestWriter(object):
+    """
+    Streaming writer for the v2 binary manifest. Items are added in output
+    order with add() and close() writes the url table, block index and
+    trailer. The writer only ever appends, so out may be a path or any
+    writable file object (including a pipe). Output data passed to feed()
+    no later than the items covering it gives every block a digest.
+    """
+    def __init__(self, out):
+        self.path = None
+        if hasattr(out, 'write'):
+            self._f = out
+            self._own = False
+        else:
+            self.path = out
+            self._f = open(out, 'wb')
+            self._own = True
+        self._reset()
+        self._write(MANIFEST_MAGIC)
+
+    def _reset(self):
+        self._pos = 0
+        self._buf = bytearray()
+        self._ids = {}
+        self._urls = []
+        self._ends = {}
+        self._block_items = 0
+        self._block_length = 0
+        self._out_offset = 0
+        # Fed output data no item covers yet and the running sha256 of the
+        # block over the _hashed bytes of it that items cover
+        self._data = bytearray()
+        self._hash = hashlib.sha256()
+        self._hashed = 0
+        # Output offset the data fed so far reaches
+        self.fed = 0
+        self._digests = True
+        self.blocks = []
+        self.count = 0
+        # on_flush(writer) is called after every block written
+        self.on_flush = None
+
+    def state(self):
+        """
+        Everything needed to continue this manifest later with resume(). Only
+        valid from on_flush, when no items are buffered.
+        """
+        return {
+            'pos': self._pos,
+            'urls': list(self._urls),
+            'blocks': [[b.file_offset, b.size, b.out_offset, b.out_length, b.items,
+                b.digest and binascii.hexlify(b.digest).decode('ascii')] for b in self.blocks],
+            'out_offset': self._out_offset,
+            'count': self.count,
+            'digests': self._digests,
+        }
+
+    @classmethod
+    def resume(cls, path, state):
+        """
+        Reopen a manifest that was being written at path, dropping anything
+        written after state was taken, and continue adding items to it.
+        """
+        writer = cls.__new__(cls)
+        writer.path = path
+        writer._f = open(path, 'r+b')
+        writer._own = True
+        writer._reset()
+        if writer._f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            writer._f.close()
+            raise ManifestError('Not a v2 manifest: %s' % (path))
+        writer._f.truncate(state['pos'])
+        writer._f.seek(state['pos'])
+        writer._pos = state['pos']
+        writer._urls = list(state['urls'])
+        writer._ids = dict((url, i) for (i, url) in enumerate(writer._urls))
+        writer.blocks = [Block(*b) for b in state['blocks']]
+        for b in writer.blocks:
+            if b.digest is not None:
+                b.digest = binascii.unhexlify(b.digest)
+        writer._out_offset = state['out_offset']
+        writer.fed = writer._out_offset
+        writer.count = state['count']
+        writer._digests = state.get('digests', False)
+        return writer
+
+    def sync(self):
+        # Make everything written so far durable
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def _write(self, data):
+        self._f.write(data)
+        self._pos += len(data)
+
+    def feed(self, data):
+        """Pass on output data, in order and from the output offset of the next item."""
+        self.fed += len(data)
+        if not self._digests:
+            return
+        self._data += data
+        self._hash_covered()
+
+    def _hash_covered(self):
+        # Hash the fed data that items of the block cover, so only data that
+        # is ahead of the items stays buffered
+        n = min(len(self._data), self._block_length - self._hashed)
+        if n > 0:
+            with memoryview(self._data) as view:
+                self._hash.update(view[:n])
+            del self._data[:n]
+            self._hashed += n
+
+    def add(self, url, offset, length):
+        buf = self._buf
+        url_id = self._ids.get(url)
+        if url_id is None:
+            url_id = len(self._urls)
+            self._ids[url] = url_id
+            self._urls.append(url)
+            _put_varint(buf, url_id * 2 + 1)
+            raw = url.encode('utf-8')
+            _put_varint(buf, len(raw))
+            buf.extend(raw)
+        else:
+            _put_varint(buf, url_id * 2)
+        _put_varint(buf, _zigzag(offset - self._ends.get(url_id, 0)))
+        _put_varint(buf, length)
+        self._ends[url_id] = offset + length
+        self._block_items += 1
+        self._block_length += length
+        self.count += 1
+        if self._block_items >= BLOCK_ITEMS:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._block_items:
+            return
+        digest = None
+        if self._digests:
+            self._hash_covered()
+            if self._hashed == self._block_length:
+                digest = self._hash.digest()
+            else:
+                # Not fed (enough), the manifest goes without digests
+                self._digests = False
+                del self._data[:]
+            self._hash = hashlib.sha256()
+            self._hashed = 0
+        data = zlib.compress(bytes(self._buf), 6)
+        self.blocks.append(Block(self._pos, len(data), self._out_offset, self._block_length, self._block_items,
+            digest))
+        self._write(b'B')
+        self._write(U32.pack(len(data)))
+        self._write(data)
+        self._out_offset += self._block_length
+        del self._buf[:]
+        self._ends = {}
+        self._block_items = 0
+        self._block_length = 0
+        if self.on_flush is not None:
+            self.on_flush(self)
+
+    def close(self, version, sha, length):
+        self._flush_block()
+        digests = self._digests and all(b.digest is not None for b in self.blocks)
+        self._write(b'H' if digests else b'E')
+        table = bytearray()
+        for url in self._urls:
+            raw = url.encode('utf-8')
+            _put_varint(table, len(raw))
+            table.extend(raw)
+        table = zlib.compress(bytes(table), 6)
+        table_offset = self._pos
+        self._write(U32.pack(len(table)))
+        self._write(table)
+        index_offset = self._pos
+        self._write(U32.pack(len(self.blocks)))
+        for b in self.blocks:
+            self._write(BLOCK_ENTRY.pack(b.file_offset, b.size, b.out_offset, b.out_length, b.items))
+            if digests:
+                self._write(b.digest)
+        self._write(TRAILER.pack(TRAILER_MAGIC, version.encode('utf-8')[:16], binascii.unhexlify(sha),
+            length, table_offset, index_offset))
+        if self._own:
+            self._f.close()
+        else:
+            self._f.flush()
+
+    def abort(self):
+        # Stop writing without a trailer, the checkpoint (if any) still
+        # describes what was written for --resume
+        if self._own:
+            self._f.close()
+
+class TextManifestWriter(object):
+    """Writer for the original gzip text manifest."""
+    def __init__(self, path):
+        self.path = path
+        self._f = gzip.open(path, 'wb')
+        self.count = 0
+
+    def feed(self, data):
+        # The text format has no digests
+        pass
+
+    def add(self, url, offset, length):
+        self._f.write(str('%s %s %s\n' % (url, offset, length)).encode('utf-8'))
+        self.count += 1
+
+    def close(self, version, sha, length):
+        self._f.write(str('_header:%s:%s:%d\n' % (version, sha, length)).encode('utf-8'))
+        self._f.close()
+
+    def abort(self):
+        self._f.close()
+
+def _decode_block(raw, urls):
+    """
+    Decode one compressed block into a list of (url_id, offset, length).
+    Urls defined inline are appended to urls when they are not known yet.
+    """
+    data = zlib.decompress(raw)
+    n = len(data)
+    pos = 0
+    ends = {}
+    items = []
+    append = items.append
+    try:
+        while pos < n:
+            # Single byte varints are by far the most common, decode them inline
+            tag = data[pos]
+            pos += 1
+            if tag >= 0x80:
+                (tag, pos) = _varint(data, pos - 1)
+            url_id = tag >> 1
+            if tag & 1:
+                (size, pos) = _varint(data, pos)
+                if url_id == len(urls):
+                    urls.append(data[pos:pos+size].decode('utf-8'))
+                pos += size
+            delta = data[pos]
+            pos += 1
+            if delta >= 0x80:
+                (delta, pos) = _varint(data, pos - 1)
+            length = data[pos]
+            pos += 1
+            if length >= 0x80:
+                (length, pos) = _varint(data, pos - 1)
+            if delta & 1:
+                offset = ends.get(url_id, 0) - ((delta + 1) >> 1)
+            else:
+                offset = ends.get(url_id, 0) + (delta >> 1)
+            ends[url_id] = offset + length
+            append((url_id, offset, length))
+    except IndexError:
+        raise ManifestError('Truncated manifest block')
+    if items and max(i[0] for i in items) >= len(urls):
+        raise ManifestError('Manifest block references an unknown url')
+    return items
+
+class ManifestReader(object):
+    """
+    Reader for the v2 binary manifest. header(), blocks() and range_entries()
+    seek straight to what they need. entries() reads front to back and also
+    works on a non seekable file object such as stdin.
+    """
+    def __init__(self, path):
+        self.path = None
+        self._f = None
+        if hasattr(path, 'read'):
+            self._f = path
+        else:
+            self.path = path
+        self._header = None
+        self._urls = None
+        self._blocks = None
+
+    def _open(self):
+        if self._f is not None:
+            return self._f
+        return open(self.path, 'rb')
+
+    def _close(self, f):
+        if f is not self._f:
+            f.close()
+
+    def _read_exact(self, f, n):
+        data = f.read(n)
+        if len(data) != n:
+            raise ManifestError('Truncated manifest: %s' % (self.path))
+        return data
+
+    def _parse_trailer(self, data):
+        (magic, version, sha, length, table_offset, index_offset) = TRAILER.unpack(data)
+        if magic != TRAILER_MAGIC:
+            raise ManifestError('Missing manifest trailer: %s' % (self.path))
+        self._header = (version.rstrip(b'\0').decode('utf-8'), binascii.hexlify(sha).decode('ascii'), length)
+        return (table_offset, index_offset)
+
+    def _parse_tail(self, f, digests):
+        # url table, block index and trailer, read in order. digests tells if
+        # the manifest ended with b'H'.
+        (size,) = U32.unpack(self._read_exact(f, U32.size))
+        data = zlib.decompress(self._read_exact(f, size))
+        urls = []
+        pos = 0
+        while pos < len(data):
+            (n, pos) = _varint(data, pos)
+            urls.append(data[pos:pos+n].decode('utf-8'))
+            pos += n
+        (count,) = U32.unpack(self._read_exact(f, U32.size))
+        blocks = []
+        for _ in range(count):
+            block = Block(*BLOCK_ENTRY.unpack(self._read_exact(f, BLOCK_ENTRY.size)))
+            if digests:
+                block.digest = self._read_exact(f, BLOCK_DIGEST)
+            blocks.append(block)
+        self._parse_trailer(self._read_exact(f, TRAILER.size))
+        self._urls = urls
+        self._blocks = blocks
+
+    def _load_tail(self):
+        if self._blocks is not None:
+            return
+        f = self._open()
+        try:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            (table_offset, _) = self._parse_trailer(self._read_exact(f, TRAILER.size))
+            # The end marker sits right before the url table
+            f.seek(table_offset - 1, os.SEEK_SET)
+            end = self._read_exact(f, 1)
+            if end not in (b'E', b'H'):
+                raise ManifestError('Corrupt manifest: %s' % (self.path))
+            self._parse_tail(f, end == b'H')
+        finally:
+            self._close(f)
+
+    def header(self):
+        """Return (version, sha256, length) from the trailer."""
+        if self._header is None:
+            f = self._open()
+            try:
+                f.seek(-TRAILER.size, os.SEEK_END)
+                self._parse_trailer(self._read_exact(f, TRAILER.size))
+            finally:
+                self._close(f)
+        return self._header
+
+    def urls(self):
+        self._load_tail()
+        return self._urls
+
+    def blocks(self):
+        """Return the block index, a list of Block in output order."""
+        self._load_tail()
+        return self._blocks
+
+    def entries(self):
+        """Yield (url, offset, length) for every item in output order."""
+        f = self._open()
+        try:
+            if self._read_exact(f, len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                raise ManifestError('Not a v2 manifest: %s' % (self.path))
+            urls = []
+            while True:
+                kind = self._read_exact(f, 1)
+                if kind in (b'E', b'H'):
+                    break
+                if kind != b'B':
+                    raise ManifestError('Corrupt manifest: %s' % (self.path))
+                (size,) = U32.unpack(self._read_exact(f, U32.size))
+                for (url_id, offset, length) in _decode_block(self._read_exact(f, size), urls):
+                    yield (urls[url_id], offset, length)
+            self._parse_tail(f, kind == b'H')
+        finally:
+            self._close(f)
+
+    def block_entries(self, block):
+        """Return the (url, offset, length) items of one Block."""
+        urls = self.urls()
+        f = self._open()
+        try:
+            f.seek(block.file_offset + 1 + U32.size, os.SEEK_SET)
+            raw = self._read_exact(f, block.size)
+        finally:
+            self._close(f)
+        return [(urls[url_id], offset, length) for (url_id, offset, length) in _decode_block(raw, list(urls))]
+
+    def range_entries(self, start, end):
+        """
+        Yield (output offset, url, offset, length) for every item that
+        overlaps output bytes [start, end), decompressing only the blocks
+        that cover that range.
+        """
+        blocks = self.blocks()
+        i = max(0, bisect_right([b.out_offset for b in blocks], start) - 1)
+        while i < len(blocks) and blocks[i].out_offset < end:
+            out = blocks[i].out_offset
+            for (url, offset, length) in self.block_entries(blocks[i]):
+                if out + length > start and out < end:
+                    yield (out, url, offset, length)
+                out += length
+            i += 1
+
+class TextManifestReader(object):
+    """Reader for the original gzip text manifest."""
+    def __init__(self, path):
+        self.path = path
+        self._header = None
+
+    def _parse_header(self, line):
+        (_, version, sha, length) = line.decode().strip().split(':')
+        self._header = (version, sha, int(length))
+
+    def entries(self):
+        with gzip.open(self.path, 'rb') as m_f:
+            for line in m_f:
+                if line.startswith(b'_header:'):
+                    self._parse_header(line)
+                    break
+                (url, url_offset, buf_len) = line.decode().strip().split(' ')
+                yield (url, int(url_offset), int(buf_len))
+
+    def header(self):
+        if self._header is None:
+            last_line = None
+            with gzip.open(self.path, 'rb') as f:
+                for last_line in f:
+                    pass
+            if last_line is None or not last_line.startswith(b'_header:'):
+                raise ManifestError('Missing manifest header: %s' % (self.path))
+            self._parse_header(last_line)
+        return self._header
+
+    def blocks(self):
+        # The text format has no block index
+        return None
+
+    def range_entries(self, start, end):
+        out = 0
+        for (url, offset, length) in self.entries():
+            if out >= end:
+                break
+            if out + length > start:
+                yield (out, url, offset, length)
+            out += length
+
+def manifest_format(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(MANIFEST_MAGIC))
+    if magic == MANIFEST_MAGIC:
+        return 'v2'
+    if magic.startswith(GZIP_MAGIC):
+        return 'text'
+    raise ManifestError('Unknown manifest format: %s' % (path))
+
+def open_manifest(path):
+    """Return a reader for path, detecting the manifest format."""
+    if manifest_format(path) == 'v2':
+        return ManifestReader(path)
+    return TextManifestReader(path)
+
+def manifest_writer(path, fmt=DEFAULT_FORMAT):
+    if fmt == 'v2':
+        return ManifestWriter(path)
+    if fmt == 'text':
+        return TextManifestWriter(path)
+    raise ManifestError('Unknown manifest format: %s' % (fmt))
+
+def convert_manifest(src, dst, fmt=DEFAULT_FORMAT):
+    """Rewrite manifest src as dst in format fmt. Returns the item count."""
+    reader = open_manifest(src)
+    (version, sha, length) = reader.header()
+    tmp = dst + '.part'
+    writer = manifest_writer(tmp, fmt)
+    for (url, offset, buf_len) in reader.entries():
+        writer.add(url, offset, buf_len)
+    writer.close(version, sha, length)
+    os.rename(tmp, dst)
+    return writer.count
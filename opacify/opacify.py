@@ -1,17 +1,38 @@
+import io
 import os
 import sys
+import json
+import mmap
 import time
 import hashlib
 import socket
-import requests
 import threading
 from enum import Enum
-from multiprocessing import Process, Manager
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from pprint import pprint
-import gzip
 
 from .opacifyinfo import *
-from .progress import progress_bar
+from .progress import Progress, DEFAULT_PROGRESS
+from .index import NgramIndex, index_path
+from .suffixarray import SuffixArrayIndex
+from .grams import GramTables, GRAM_MAX, byte_values
+from .corpus import Corpus
+from .fetch import Fetcher, FETCH_WORKERS
+from .cache import Cache
+from .stats import Stats
+from .ranges import RangeCache, coalesce, RANGE_GAP, RANGE_MAX_SPANS, RANGE_SUFFIX
+from .manifest import open_manifest, manifest_writer, manifest_format, ManifestWriter, ManifestReader, \
+    ManifestError, DEFAULT_FORMAT
+from .optimize import merge_runs, retarget
+from .planner import sample_input, url_coverage, plan_urls, PLAN_MIN_GAIN
+from .checkpoint import Checkpointer, load_checkpoint, remove_checkpoint, checkpoint_path, urls_digest, \
+    hash_prefix, CHECKPOINT_INTERVAL, Journal, load_journal, remove_journal
+from .incremental import PreviousVersion, cdc_chunks, READ_BLOCK
+from .selfref import SELF_URL, InputHistory, OutputWindow, self_copy, expand_self_refs
+from .shard import shard_bounds, split_entries, load_plan, write_plan, plan_path, SHARD_PLAN, SHARD_NAME, \
+    SHARDS_VERSION
 
 EPILOG  = """
 Examples:
@@ -54,6 +75,117 @@ Author  : %s
 #
 CHUNK_SIZE = 1
 
+if hasattr(os, 'pwrite'):
+    pwrite = os.pwrite
+    pread = os.pread
+else:
+    _pwrite_lock = threading.Lock()
+    def pwrite(fd, data, offset):
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+    def pread(fd, length, offset):
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+# Matching engines usable by pacify. Both return the longest match they can
+# find for a buffer, so pacify hands them MATCH_WINDOW bytes of lookahead and
+# advances by however much was matched instead of by chunk_size.
+ENGINES = {
+    'ngram': NgramIndex,
+    'suffix': SuffixArrayIndex,
+}
+DEFAULT_ENGINE = 'ngram'
+MATCH_WINDOW = 4096
+
+# Parallel pacify hands out input segments of at most this many bytes
+SEGMENT_SIZE = 1024 * 1024
+# Block size used when hashing a whole file
+HASH_BLOCK = 1024 * 1024
+# Corrupt output ranges listed when satisfy fails validation
+CORRUPT_SHOWN = 8
+
+def _fork_context():
+    # Pools are always forked so workers inherit the loaded corpus and index
+    # instead of receiving them through pickling, whatever the default start
+    # method is. None where fork is not available, callers then stay in the
+    # one process.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+# The Opacify instance, input path, urls and Progress of a parallel pacify,
+# handed to each worker by the pool initializer
+_worker = None
+
+def _init_worker(state):
+    global _worker
+    _worker = state
+
+def _pacify_segment(segment):
+    (o, input_file, urls, progress) = _worker
+    o.stats.reset()
+    start = time.time()
+    result = o._pacify_segment(input_file, segment[0], segment[1], urls)
+    progress.add(segment[1] - segment[0])
+    if not o.stats.enabled:
+        return result + (None,)
+    # The parent merges what this worker measured
+    o.stats.worker(nbytes=segment[1] - segment[0], seconds=time.time() - start)
+    return result + ({'phases': o.stats['phases'], 'counters': o.stats['counters'],
+        'workers': o.stats['workers']},)
+
+# The Opacify instance, urls and overwrite flag of a batch pacify, handed to
+# each worker by the pool initializer like _worker
+_batch = None
+
+def _init_batch(state):
+    global _batch
+    _batch = state
+
+def _pacify_batch_input(job):
+    (o, urls, overwrite) = _batch
+    return o._pacify_one(job[0], job[1], urls, overwrite)
+
+# Batch pacify writes <input>BATCH_SUFFIX per input and a BATCH_SUMMARY
+BATCH_SUFFIX = '.manifest'
+BATCH_SUMMARY = 'opacify-summary.json'
+
+def batch_inputs(inputs, out_dir):
+    """
+    Return the (input path, manifest path) pairs of a batch. inputs is a
+    directory, walked recursively, or a list of paths. The manifests mirror
+    the input paths below out_dir.
+    """
+    out_abs = os.path.abspath(out_dir)
+    if not isinstance(inputs, (list, tuple)) and os.path.isdir(inputs):
+        root = inputs
+        paths = []
+        for (d, dirs, files) in os.walk(inputs):
+            # Skip the manifests of an earlier run written inside the tree
+            dirs[:] = sorted(x for x in dirs if os.path.abspath(os.path.join(d, x)) != out_abs)
+            paths.extend(os.path.join(d, f) for f in sorted(files))
+    else:
+        paths = list(inputs)
+        if not paths:
+            return []
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    root = os.path.abspath(root)
+    return [(p, os.path.join(out_dir, os.path.relpath(os.path.abspath(p), root) + BATCH_SUFFIX)) for p in paths]
+
+# Satisfy to a stream writes items in order. It keeps this many items
+# queued so their sources can be fetched ahead of the writer.
+STREAM_WINDOW = 4096
+
+def _binary_stdio(name):
+    stream = getattr(sys, name)
+    return getattr(stream, 'buffer', stream)
+
+def _is_stream(path):
+    return path == '-' or hasattr(path, 'read') or hasattr(path, 'write')
+
 class StatusCodes(Enum):
     OK                  = True
     E_NONE              = None
@@ -74,6 +206,7 @@ class StatusCodes(Enum):
     E_URL_NOT_FOUND     = 16
     E_FAILED            = 17
     E_MANIFEST          = 18
+    E_CHECKPOINT        = 19
 
 class Status(object):
     def __init__(self, code=None, message=None):
@@ -101,7 +234,8 @@ class Results(object):
         return self.results
 
 class Opacify(object):
-    def __init__(self, cache_dir=None, debug=False, chunk_size=None):
+    def __init__(self, cache_dir=None, debug=False, chunk_size=None, engine=None, fetch_workers=None,
+            manifest_format=None, cache_limit=None, range_gap=None, ranges=True, stats=False, progress=None):
         self.total_chunks = 0
         self.total_chunk_size = 0
         self.__version = VERSION
@@ -109,11 +243,54 @@ class Opacify(object):
         self.debug = debug
         if cache_dir:
             self.cache_dir = cache_dir
-        self._failed_urls_cache = []
+        self._failed_urls_cache = set()
+        # Phase timers and counters of the last run, see stats.py
+        self.stats = Stats(enabled=stats)
+        # How progress is reported: 'bar', 'json' lines on stderr or 'quiet'
+        self.progress = progress or DEFAULT_PROGRESS
+        self.cache = Cache(self.cache_dir, limit=cache_limit)
+        self.fetcher = Fetcher(workers=fetch_workers or FETCH_WORKERS, failed=self._failed_urls_cache,
+            store=self.cache.store, on_download=self.stats.download)
         self.timer_start = time.time()
         self.results = Results()
         self.digest = None
         self.clength = 0
+        self.broken = {}
+        self.optimized = {}
+        self.planned = {}
+        # Plan of the last shard() and the shards assemble() rejected
+        self.shards = {}
+        self.bad_shards = []
+        # Bytes an incremental pacify reused from the previous manifest and matched again
+        self.reused = 0
+        self.rematched = 0
+        self.checkpoint_interval = CHECKPOINT_INTERVAL
+        # Repeats of earlier input become back references (see selfref.py)
+        self.self_refs = True
+        # One summary entry per input of the last batch pacify
+        self.batch = []
+        # Journal of the running satisfy and (sources, bytes) a resumed one kept
+        self.journal = None
+        self.resumed = (0, 0)
+        # Blocks whose output failed the digest check in validate_output()
+        self.corrupt = []
+        self.index = None
+        self.grams = None
+        self.corpus = Corpus(self._cache_path, on_open=self.cache.touch)
+        # satisfy fetches only the byte ranges a manifest uses unless ranges
+        # is False, merging spans less than range_gap bytes apart
+        self.ranges = RangeCache(self.cache_dir, self._cache_path, on_open=self.cache.touch)
+        self.use_ranges = ranges
+        self.range_gap = RANGE_GAP if range_gap is None else int(range_gap)
+        self.engine = DEFAULT_ENGINE
+        if engine:
+            if engine not in ENGINES:
+                raise Exception('Unknown engine: %s' % (engine))
+            self.engine = engine
+        self.match_window = MATCH_WINDOW
+        self.manifest_format = manifest_format or DEFAULT_FORMAT
+        # Where status output goes, switched to stderr when data is written to stdout
+        self.log = None
         self.chunk_size = CHUNK_SIZE
         if chunk_size:
             self.chunk_size = int(chunk_size)
@@ -121,9 +298,21 @@ class Opacify(object):
     def messages(self):
         return self._messages
 
+    def _progress(self, total, task, show=True, shared=False, done=0, timer_start=None):
+        # Progress reporter of a run in the mode of self.progress, quiet when
+        # not shown or while debugging. Call start() and stop() on it.
+        mode = self.progress if show and not self.debug else 'quiet'
+        return Progress(total, task=task, mode=mode, stream=self._log() if mode == 'bar' else None,
+            timer_start=timer_start or self.timer_start, shared=shared, done=done)
+
     def print_debug(self, msg):
         if self.debug:
-            print('DEBUG: %s' % (msg))
+            self._log().write('DEBUG: %s\n' % (msg))
+
+    def _log(self):
+        if self.log is not None:
+            return self.log
+        return sys.stdout
 
     def result(self, code, message):
         if self.debug:
@@ -134,21 +323,30 @@ class Opacify(object):
     def _write_url_to_cache(self, url, overwrite=False):
         cache_path = self._cache_path(url)
         if not os.path.exists(cache_path) or overwrite is True:
+            self.corpus.invalidate(url)
             self.print_debug('create cache file: %s' % (cache_path))
             self.print_debug('get: %s' % (url))
-            r = requests.get(url, timeout=5, stream=True)
-            if r.status_code != 200:
-                self._failed_urls_cache.append(url)
-                return self.result(StatusCodes.E_URL_OPEN, 'Failed to open URL: %s' % (url))
-            try:
-                with open(cache_path, 'wb') as cache_f:
-                    for chunk in r:
-                        cache_f.write(chunk)
-            except Exception as e:
-                return self.result(StatusCodes.E_CACHE_OPEN, "Failed to open cache '%s'. Error=%s" % (cache_path, e))
+            err = self.fetcher.fetch(url, cache_path)
+            if err is not None:
+                if url in self._failed_urls_cache:
+                    return self.result(StatusCodes.E_URL_OPEN, err)
+                return self.result(StatusCodes.E_CACHE_OPEN, err)
         return StatusCodes.OK
 
     def _find_buf(self, buf, urls):
+        if self.index is not None:
+            # Grams up to GRAM_MAX bytes are a direct table lookup
+            if len(buf) <= GRAM_MAX:
+                found = self.grams.find(buf)
+            else:
+                found = self.index.find(buf)
+                if found is None or found[0] < GRAM_MAX:
+                    short = self.grams.find(buf)
+                    if short is not None and (found is None or short[0] > found[0]):
+                        found = short
+            if found is None:
+                return False
+            return found
         while True:
             for url in urls:
                 if url in self._failed_urls_cache:
@@ -159,18 +357,9 @@ class Opacify(object):
                 elif test == StatusCodes.E_CACHE_OPEN:
                     return test
 
-                cache_path = self._cache_path(url)
-                cache_f = open(cache_path, 'rb')
-                total_chunk_size = 0
-                while True:
-                    chunk = cache_f.read(self.chunk_size*1024)
-                    if not chunk:
-                        break
-                    offset = chunk.find(buf)
-                    if offset > 0:
-                        #assert (len(buf) % 2 == 0 or (len(buf) != 1 and len(buf) % 2 == 0)), "Odd buffer size: %d" % (len(buf))
-                        return (len(buf), total_chunk_size+offset, url)
-                    total_chunk_size += len(chunk)
+                offset = self.corpus.find(url, buf)
+                if offset >= 0:
+                    return (len(buf), offset, url)
             lb = len(buf)
             #buf = buf[:-1]
             if lb > 8:
@@ -188,210 +377,569 @@ class Opacify(object):
         # Fallthrough that should not be reached. If it is, there is an error in the logic
         return self.result(StatusCodes.E_FAILED, 'Programmer error in _find_buf')
 
-    def build_cache(self, urls):
-        sys.stdout.write('Building cache...\r')
-        sys.stdout.flush()
+    def build_cache(self, urls, persist=True):
+        self.fetch_urls(urls)
+        self.build_index(urls, persist)
+
+    def fetch_urls(self, urls):
+        # Download the urls that are not cached yet
+        self._log().write('Building cache...\r')
+        self._log().flush()
         if not os.path.exists(self.cache_dir):
             os.mkdir(self.cache_dir)
+        missing = []
         for url in urls:
-            if url in self._failed_urls_cache:
+            if url in self._failed_urls_cache or os.path.exists(self._cache_path(url)):
                 continue
-            self._write_url_to_cache(url)
+            self.print_debug('get: %s' % (url))
+            missing.append((url, self._cache_path(url)))
+        self.stats.incr('cache_hits', len(urls) - len(missing))
+        self.stats.incr('cache_misses', len(missing))
+        with self.stats.timer('download'):
+            errors = self.fetcher.fetch_all(missing)
+        for url in sorted(errors.keys()):
+            if url in self._failed_urls_cache:
+                self.result(StatusCodes.E_URL_OPEN, errors[url])
+            else:
+                self.result(StatusCodes.E_CACHE_OPEN, errors[url])
+
+    def build_index(self, urls, persist=True):
+        # Reuse the index stored next to the cache files when it still matches them,
+        # otherwise build it once here so _find_buf never has to scan the corpus.
+        # The short-gram tables take 64MB or more on disk and are quick to
+        # rebuild, they are only saved when persist says the cache is kept.
+        urls = [url for url in urls if url not in self._failed_urls_cache]
+        engine = ENGINES[self.engine]
+        path = index_path(self.cache_dir, urls, kind=self.engine)
+        with self.stats.timer('index_load'):
+            self.index = engine.load(path, urls, self.corpus)
+        if self.index is None:
+            self._log().write('Building index...\r')
+            self._log().flush()
+            with self.stats.timer('index_build'):
+                self.index = engine.build(urls, self.corpus)
+                self.index.save(path)
+        self.print_debug('index(%s): %d urls %d bytes' % (self.engine, len(self.index.urls), self.index.total))
+        path = index_path(self.cache_dir, urls, kind='grams')
+        with self.stats.timer('grams_load'):
+            self.grams = GramTables.load(path, urls, self.corpus)
+        if self.grams is None:
+            with self.stats.timer('grams_build'):
+                self.grams = GramTables.build(urls, self.corpus)
+                if persist:
+                    self.grams.save(path)
+        return self.index
+
+    def check_coverage(self, input_file):
+        """
+        Fail before matching starts if the input has byte values no cached
+        url contains, pacify could never finish then. Streams are not checked.
+        """
+        if self.grams is None or _is_stream(input_file) or not os.path.exists(input_file):
+            return StatusCodes.OK
+        with self.stats.timer('coverage'):
+            missing = self.grams.missing(byte_values(input_file))
+        if missing:
+            shown = ' '.join('%02x' % (b) for b in missing[:16]) + (' ...' if len(missing) > 16 else '')
+            return self.result(StatusCodes.E_URL_NOT_FOUND, 'No url contains %d byte values of the input: %s' % (
+                len(missing), shown))
+        return StatusCodes.OK
+
+    def _match_stream(self, inf_f, input_size, urls, input_hash=None, feed=None, self_refs=False, base=0):
+        """
+        Match the data read from inf_f (input_size bytes, or until EOF when
+        None) against the corpus. Yields (buf_len, url_offset, url) per
+        manifest item, or (0, offset, None) if a byte could not be found.
+        input_hash is updated with and feed (e.g. ManifestWriter.feed) called
+        on every block read, before the items covering it are yielded. With
+        self_refs repeats of earlier input become back references (see
+        selfref.py), base is the input offset inf_f starts at.
+        """
+        # Lookahead handed to _find_buf. With an index the match is as long
+        # as the corpus allows (up to match_window), the linear scan keeps the
+        # old chunk_size behaviour.
+        lookahead = self.chunk_size
+        if self.index is not None:
+            lookahead = max(self.chunk_size, self.match_window)
+        # The input is read in large blocks and hashed as it is read, so it is
+        # never read twice and a stream only needs lookahead bytes buffered
+        pending = b''
+        pos = 0
+        read = 0
+        offset = 0
+        eof = False
+        # Counted in locals and added to stats once, the loop only pays for
+        # the timing check when stats are disabled
+        timing = self.stats.enabled
+        finds = 0
+        scanned = 0
+        find_time = 0.0
+        refs = 0
+        ref_bytes = 0
+        history = InputHistory(base) if self_refs else None
+        try:
+            while True:
+                if len(pending) - pos < lookahead and not eof:
+                    want = max(lookahead, 65536)
+                    if input_size is not None:
+                        want = min(want, input_size - read)
+                    data = inf_f.read(want) if want > 0 else b''
+                    if not data:
+                        eof = True
+                    else:
+                        read += len(data)
+                        if input_hash is not None:
+                            input_hash.update(data)
+                        if feed is not None:
+                            feed(data)
+                        if history is not None:
+                            history.append(data)
+                        pending = pending[pos:] + data
+                        pos = 0
+                buf = pending[pos:pos+lookahead]
+                if not buf:
+                    break
+                if history is not None:
+                    ref = history.find(base + offset, len(pending) - pos)
+                    if ref is not None:
+                        (buf_len, url_offset) = ref
+                        history.mark(base + offset, buf_len, url_offset)
+                        refs += 1
+                        ref_bytes += buf_len
+                        yield (buf_len, url_offset, SELF_URL)
+                        pos += buf_len
+                        offset += buf_len
+                        continue
+                if timing:
+                    t = time.time()
+                    fbu = self._find_buf(buf, urls)
+                    find_time += time.time() - t
+                    finds += 1
+                    scanned += len(buf)
+                else:
+                    fbu = self._find_buf(buf, urls)
+                if type(fbu) is not tuple: #StatusCodes.E_NONE:
+                    yield (0, offset, None)
+                    return
+                (buf_len, url_offset, url) = fbu
+                assert buf_len != 0, 'buffer length is 0'
+                if history is not None:
+                    history.mark(base + offset, buf_len)
+                yield fbu
+                pos += buf_len
+                offset += buf_len
+        finally:
+            if timing:
+                self.stats.add_time('find', find_time, finds)
+                self.stats.incr('find_calls', finds)
+                self.stats.incr('bytes_scanned', scanned)
+                self.stats.incr('bytes_matched', offset - ref_bytes)
+                self.stats.incr('self_refs', refs)
+                self.stats.incr('bytes_self', ref_bytes)
+
+    def _open_manifest_writer(self, input_file, manifest, urls, resume=False):
+        """
+        Open the manifest writer of a pacify run. Returns (writer, input hash,
+        offset), where offset is how far a resumed run already got and the
+        hash covers the input up to it. Manifest files written in the v2
+        format from an input file are checkpointed.
+        """
+        checkpoints = not _is_stream(input_file) and not _is_stream(manifest) and self.manifest_format == 'v2'
+        if not checkpoints:
+            if resume:
+                return self.result(StatusCodes.E_CHECKPOINT,
+                    'Resume needs an input file and a manifest file in the v2 format')
+            return (manifest_writer(manifest, self.manifest_format), hashlib.sha256(), 0)
+        offset = 0
+        prefix = hashlib.sha256()
+        if resume:
+            state = load_checkpoint(manifest)
+            if state is None or not os.path.exists(manifest):
+                return self.result(StatusCodes.E_CHECKPOINT, 'No checkpoint to resume from: %s' % (checkpoint_path(manifest)))
+            if state['input_size'] != os.path.getsize(input_file) or state['urls'] != urls_digest(urls):
+                return self.result(StatusCodes.E_CHECKPOINT, 'Checkpoint was made for a different input or urls file')
+            offset = state['offset']
+            hash_prefix(input_file, offset, h=prefix)
+            # The checkpoint hash covers the input read up to state['hashed']
+            hashed = hash_prefix(input_file, state.get('hashed', offset), h=prefix.copy(), start=offset)
+            if hashed.hexdigest() != state['sha256']:
+                return self.result(StatusCodes.E_CHECKPOINT, 'Input file changed since the checkpoint')
+            man_f = ManifestWriter.resume(manifest, state['manifest'])
+            self.print_debug('resume at offset %d (%d items)' % (offset, man_f.count))
+        else:
+            remove_checkpoint(manifest)
+            man_f = manifest_writer(manifest, self.manifest_format)
+        man_f.on_flush = Checkpointer(manifest, input_file, urls, prefix, interval=self.checkpoint_interval)
+        return (man_f, prefix, offset)
 
     def _pacify(self, input_file=None, url_file=None, manifest=None, overwrite=False, keep_cache=False,
-            input_offset=None, input_end=None, show_progress=False, thread_id=None, thread_info=None):
-        input_hash = hashlib.sha256()
-        if not input_file or not url_file or not manifest:
+            show_progress=False, resume=False, urls=None):
+        if not input_file or not (url_file or urls) or not manifest:
             raise Exception('Programmer error: pacify() requires input_file, url_file, manifest')
 
-        if os.path.exists(manifest) and not overwrite:
-            r = self.result(StatusCodes.E_MANIFEST_EXISTS, 'Manifest file exists. Use --force to overwrite')
-            if thread_id is not None and thread_id is not False and thread_info:
-                thread_info['result'] = self.results
-            return r
+        if not _is_stream(manifest) and os.path.exists(manifest) and not overwrite and not resume:
+            return self.result(StatusCodes.E_MANIFEST_EXISTS, 'Manifest file exists. Use --force to overwrite')
 
-        if input_offset is not None and input_end is not None:
-            manifest += '-%s-%s.tmp' % (input_offset, input_end)
-            inf_f = open(input_file, 'rb')
-            self.print_debug('THREADED(%d): input_offset:%d input_end:%d' % (thread_id, input_offset, input_end))
-            inf_f.seek(input_offset, os.SEEK_SET)
-            input_size = input_end - input_offset
-            offset = 0 #ehhh 0 should work? right?
-            thread_info['up'] = True
+        if _is_stream(input_file):
+            # Unknown size, read until EOF
+            inf_f = _binary_stdio('stdin') if input_file == '-' else input_file
+            input_size = None
+            show_progress = False
         else:
             inf_f = open(input_file, 'rb')
             input_size = os.path.getsize(input_file)
-            offset = 0
-
-        man_f = gzip.open(manifest, 'wb')
-        urls = open(url_file).read().strip().split('\n')
-        if show_progress:
-            if thread_id is not None:
-                progress_bar(0, input_size, prefix='Progress:', suffix='thread-%s' % (thread_id),
-                    length=24, timer_start=self.timer_start)
-            else:
-                progress_bar(0, input_size, prefix='Progress:', suffix='', length=24,
-                    timer_start=self.timer_start)
-        while offset < input_size:
-            if input_size - offset < self.chunk_size:
-                buf = inf_f.read(input_size - offset)
-            else:
-                buf = inf_f.read(self.chunk_size)
-            if not buf:
-                break
-            input_hash.update(buf)
-            start_buf_len = len(buf)
-            prev_buf_len = len(buf)
-            cur_offset = offset
-            while prev_buf_len > 0:
-                fbu = self._find_buf(buf, urls)
-                if type(fbu) is not tuple: #StatusCodes.E_NONE:
-                    # If this is a thread, return will not do anything
-                    # Instead messages are pushed into results and results
-                    # added to Manger() dict
-                    r = self.result(StatusCodes.E_URL_NOT_FOUND, 'Could not find url for buf at offset: %d' % (offset))
-                    if thread_info is not None:
-                        thread_info['result'] = self.results
-                    return r
+        if manifest == '-':
+            manifest = _binary_stdio('stdout')
+            self.log = sys.stderr
 
-                (buf_len, url_offset, url) = fbu
+        if urls is None:
+            urls = open(url_file).read().strip().split('\n')
+        r = self._open_manifest_writer(input_file, manifest, urls, resume)
+        if type(r) is not tuple:
+            if not _is_stream(input_file):
+                inf_f.close()
+            return r
+        (man_f, input_hash, offset) = r
+        if offset:
+            inf_f.seek(offset, os.SEEK_SET)
+        remaining = input_size - offset if input_size is not None else None
+        progress = self._progress(input_size, 'pacify', show=show_progress, done=offset).start()
+        try:
+            for (buf_len, url_offset, url) in self._match_stream(inf_f, remaining, urls, input_hash, man_f.feed,
+                    self_refs=self.self_refs, base=offset):
+                if url is None:
+                    man_f.abort()
+                    return self.result(StatusCodes.E_URL_NOT_FOUND, 'Could not find url for buf at offset: %d' % (offset))
                 self.total_chunk_size += buf_len
                 self.total_chunks += 1
-                cur_offset += buf_len
-                assert buf_len != 0, 'buffer length is 0'
                 self.print_debug('buf_len=%d url_offset=%d foff=%d url=%s' % (buf_len, url_offset, offset, url))
-                man_f.write(str('%s %s %s\n' % (url, url_offset, buf_len)).encode('utf-8'))
-                buf = buf[buf_len:]
-                prev_buf_len = len(buf)
-                if show_progress:
-                    if thread_id is None:
-                        progress_bar(cur_offset, input_size, prefix='Progress:', suffix='', length=24,
-                            timer_start=self.timer_start)
-
-            offset += start_buf_len
-            if not self.debug and show_progress:
-                if thread_id is not None:
-                    progress_bar(offset, input_size, prefix='Progress:', suffix='thread-%s' % (thread_id),
-                        length=24, timer_start=self.timer_start)
-                else:
-                    progress_bar(offset, input_size, prefix='Progress:', suffix='', length=24,
-                        timer_start=self.timer_start)
+                with self.stats.timer('manifest_write'):
+                    man_f.add(url, url_offset, buf_len)
+                offset += buf_len
+                progress.set(offset)
+        finally:
+            progress.stop()
+            if not _is_stream(input_file):
+                inf_f.close()
         sha = input_hash.hexdigest()
         self.digest = sha
         self.clength = offset
-        man_header = str('_header:%s:%s:%d\n' % (self.__version, sha, offset)).encode('utf-8')
-        man_f.write(man_header)
-        inf_f.close()
-        man_f.close()
-        if thread_id is not None and thread_id is not False and thread_info:
-            thread_info['result'] = self.results
-            #thread_info['msgs'] = self.messages()
+        with self.stats.timer('manifest_write'):
+            man_f.close(self.__version, sha, offset)
+        if not _is_stream(manifest):
+            remove_checkpoint(manifest)
         return self.result(StatusCodes.OK, 'OK')
 
-    def pacify(self, input_file=None, url_file=None, manifest=None, overwrite=False, keep_cache=False, threads=None):
-        self.timer_start = time.time()
-        self.build_cache(open(url_file).read().strip().split('\n'))
-        if threads is None:
-            return self._pacify(input_file=input_file, url_file=url_file, manifest=manifest,
-                overwrite=overwrite, keep_cache=keep_cache, show_progress=True)
+    def _pacify_segment(self, input_file, start, end, urls):
+        # Runs in a pool worker: match input bytes [start, end) and return the
+        # items with urls replaced by their index position, which keeps the
+        # results sent back over the pipe small
+        url_ids = self._url_ids
+        items = []
+        with open(input_file, 'rb') as inf_f:
+            inf_f.seek(start, os.SEEK_SET)
+            for (buf_len, url_offset, url) in self._match_stream(inf_f, end - start, urls,
+                    self_refs=self.self_refs, base=start):
+                if url is None:
+                    return (start, end, None, start + url_offset)
+                items.append((url_ids[url], url_offset, buf_len))
+        return (start, end, items, None)
 
-        # threads is set
-        n_threads = int(threads)
+    def _pacify_parallel(self, input_file=None, url_file=None, manifest=None, overwrite=False, keep_cache=False,
+            threads=None, segment_size=None, resume=False):
+        """
+        Pacify with a pool of worker processes. The input is cut into small
+        segments that idle workers pull from a shared queue, so one slow
+        region does not hold up the rest. Workers are forked after the corpus
+        and index are loaded and share them with the parent. Their results
+        come back over pipes and are written to the final manifest in order
+        as they arrive. Each segment is read once more to hash it and give
+        the manifest its block digests before its items are added.
+        """
+        if os.path.exists(manifest) and not overwrite and not resume:
+            return self.result(StatusCodes.E_MANIFEST_EXISTS, 'Manifest file exists. Use --force to overwrite')
+        n_workers = int(threads)
         input_size = os.path.getsize(input_file)
-        # do not thread on small sizes
-        if n_threads*10 > input_size:
+        if not segment_size:
+            # Several segments per worker so the work can be balanced
+            segment_size = max(4096, min(SEGMENT_SIZE, -(-input_size // (n_workers * 8))))
+        urls = open(url_file).read().strip().split('\n')
+        r = self._open_manifest_writer(input_file, manifest, urls, resume)
+        if type(r) is not tuple:
+            return r
+        (man_f, input_hash, resume_at) = r
+        segments = [(s, min(s + segment_size, input_size)) for s in range(resume_at, input_size, segment_size)]
+        url_list = list(self.index.urls) if self.index is not None else \
+            [url for url in urls if url not in self._failed_urls_cache]
+        url_list.append(SELF_URL)
+        self._url_ids = dict((url, i) for (i, url) in enumerate(url_list))
+
+        total_len = resume_at
+        # Workers add the segments they matched to the shared counter
+        progress = self._progress(input_size, 'pacify', shared=True, done=resume_at)
+        pool = _fork_context().Pool(n_workers, _init_worker, ((self, input_file, urls, progress),))
+        progress.start()
+        inf_f = open(input_file, 'rb')
+        inf_f.seek(resume_at, os.SEEK_SET)
+        try:
+            for (start, end, items, missing, seg_stats) in pool.imap(_pacify_segment, segments):
+                if items is None:
+                    pool.terminate()
+                    man_f.abort()
+                    return self.result(StatusCodes.E_URL_NOT_FOUND,
+                        'Could not find url for buf at offset: %d' % (missing))
+                if seg_stats is not None:
+                    self.stats.merge(seg_stats)
+                    for (name, w) in seg_stats['workers'].items():
+                        self.stats.worker(name, w['bytes'], w['seconds'], w['items'])
+                with self.stats.timer('hash'):
+                    left = end - start
+                    while left > 0:
+                        data = inf_f.read(min(HASH_BLOCK, left))
+                        if not data:
+                            break
+                        input_hash.update(data)
+                        man_f.feed(data)
+                        left -= len(data)
+                with self.stats.timer('merge'):
+                    for (url_id, url_offset, buf_len) in items:
+                        man_f.add(url_list[url_id], url_offset, buf_len)
+                        self.total_chunk_size += buf_len
+                        self.total_chunks += 1
+                total_len += end - start
+        finally:
+            pool.close()
+            pool.join()
+            inf_f.close()
+            progress.stop()
+        sha = input_hash.hexdigest()
+        self.digest = sha
+        self.clength = total_len
+        with self.stats.timer('merge'):
+            man_f.close(self.__version, sha, total_len)
+        remove_checkpoint(manifest)
+        return self.result(StatusCodes.OK, 'OK')
+
+    def _pacify_incremental(self, input_file=None, url_file=None, manifest=None, overwrite=False,
+            keep_cache=False, previous=None):
+        """
+        Pacify a new version of a file given the manifest of an older one.
+        The old content is rebuilt from the cache and both versions are cut
+        into content-defined chunks (see incremental.py). Chunks that did not
+        change keep their old items, only the others are matched again. Falls
+        back to a full pacify when the old content cannot be rebuilt.
+        """
+        if _is_stream(input_file) or _is_stream(manifest):
+            return self.result(StatusCodes.E_OPEN_INPUT_FILE, 'Incremental pacify needs an input and a manifest file')
+        if os.path.exists(manifest) and not overwrite:
+            return self.result(StatusCodes.E_MANIFEST_EXISTS, 'Manifest file exists. Use --force to overwrite')
+        try:
+            old_entries = list(expand_self_refs(open_manifest(previous).entries()))
+        except (IOError, OSError, ValueError, ManifestError) as e:
+            return self.result(StatusCodes.E_OPEN_MANIFEST, 'Failed to read previous manifest: %s' % (e))
+        urls = open(url_file).read().strip().split('\n')
+        # The old items may use urls that have left the list since
+        listed = set(urls)
+        extra = sorted(set(url for (url, _, _) in old_entries if url not in listed))
+        if extra:
+            self.fetch_urls(extra)
+        old = None
+        with self.stats.timer('previous'):
+            try:
+                old = PreviousVersion(old_entries, self.corpus.read)
+            except (IOError, OSError) as e:
+                self.print_debug('previous version unavailable: %s' % (e))
+        if old is None:
+            self._log().write('Previous version is not available, running a full pacify\n')
             return self._pacify(input_file=input_file, url_file=url_file, manifest=manifest,
                 overwrite=overwrite, keep_cache=keep_cache, show_progress=True)
 
-        leftovers = input_size % n_threads
-        per_thread = int(input_size / n_threads)
-        # {} Allows multiprocess communication back to parent
-        manager = Manager()
-        thread_info = {} #manager.dict()
-        offset = 0
-        for i in range(n_threads):
-            offset += per_thread
-            thread_info[i] = manager.dict(
-                {'offset':offset-per_thread, 'end':offset, 'result':None, 'up':False, 'msgs':[]})
-        thread_info[i]['end'] += leftovers # Add the remaining to the last thread
-        threads = []
-        for i in range(n_threads):
-            kw = {
-                'input_file':input_file,
-                'url_file':url_file,
-                'manifest':manifest,
-                'overwrite':overwrite,
-                'keep_cache':keep_cache,
-                'input_offset':thread_info[i]['offset'],
-                'input_end':thread_info[i]['end'],
-                'thread_id':i, 'show_progress':True,
-                'thread_info':thread_info[i],
-            }
-            if i+1 >= n_threads:
-                kw['show_progress'] = True
-            #t = threading.Thread(target=self._pacify, kwargs=kw)
-            t = Process(target=self._pacify, kwargs=kw)
-            #t.daemon = True
-            t.start()
-            threads.append(t)
-        # Threads will write to their own unique file "mainifest+offset+end.tmp"
-        # We then need to join these temp files in order to create the final
-        # manifes
-        for t in threads:
-            t.join()
-
-        for i in range(n_threads):
-            status = thread_info[i]
-            if status['result']:
-                for x in status['result'].get():
-                    for j in range(len(x.codes)):
-                        self.result(x.codes[j], x.messages[j])
-
-        combined_manifest = gzip.open(manifest, 'wb') # TODO: check if --force
-        total_len = 0
-        errors = 0
-        for i in range(n_threads):
-            t_manifest = '%s-%s-%s.tmp' % (manifest, thread_info[i]['offset'], thread_info[i]['end'])
-            try:
-                (version, sha, length) = self.get_manifest_header(t_manifest)
-            except Exception as e:
-                self.print_debug('%s' % (e))
-                self.result(StatusCodes.E_MANIFEST, 'Invalid manifest from thread: %s' % (t_manifest))
-                errors += 1
-                continue
-            with gzip.open(t_manifest, 'rb') as m_f:
-                for line in m_f:
-                    line = line.decode()
-                    if line.startswith('_header:'): break
-                    (url, url_offset, buf_len) = line.strip().split(' ')
-                    self.total_chunk_size += int(buf_len)
-                    self.total_chunks += 1
-                    total_len += int(buf_len)
-                    combined_manifest.write(str('%s %s %s\n' % (url, url_offset, buf_len)).encode('utf-8'))
-            os.unlink(t_manifest)
-        if errors > 0:
-            return self.result(StatusCodes.E_MANIFEST, 'Failed to combine all manifests.')
         input_hash = hashlib.sha256()
+        input_size = os.path.getsize(input_file)
+        def blocks():
+            with open(input_file, 'rb') as inf_f:
+                while True:
+                    data = inf_f.read(READ_BLOCK)
+                    if not data:
+                        break
+                    input_hash.update(data)
+                    man_f.feed(data)
+                    yield data
+        def items():
+            for (pos, chunk) in cdc_chunks(blocks()):
+                start = old.find(chunk)
+                if start is not None:
+                    self.reused += len(chunk)
+                    for item in old.items_between(start, start + len(chunk)):
+                        yield item
+                    continue
+                self.rematched += len(chunk)
+                for (buf_len, url_offset, url) in self._match_stream(io.BytesIO(chunk), len(chunk), urls):
+                    if url is None:
+                        yield (None, pos + url_offset, 0)
+                        return
+                    yield (url, url_offset, buf_len)
+
+        man_f = manifest_writer(manifest, self.manifest_format)
         offset = 0
-        with open(input_file, 'rb') as inf_f:
-            while True:
-                if total_len - offset < self.chunk_size:
-                    buf = inf_f.read(total_len - offset)
-                else:
-                    buf = inf_f.read(self.chunk_size)
-                if not buf:
-                    break
-                offset += len(buf)
-                input_hash.update(buf)
+        progress = self._progress(input_size, 'pacify').start()
+        try:
+            for (url, url_offset, buf_len) in merge_runs(items()):
+                if url is None:
+                    man_f.abort()
+                    return self.result(StatusCodes.E_URL_NOT_FOUND, 'Could not find url for buf at offset: %d' % (url_offset))
+                self.total_chunk_size += buf_len
+                self.total_chunks += 1
+                with self.stats.timer('manifest_write'):
+                    man_f.add(url, url_offset, buf_len)
+                offset += buf_len
+                progress.set(offset)
+        finally:
+            progress.stop()
+        self.stats.incr('bytes_reused', self.reused)
+        self.stats.incr('bytes_rematched', self.rematched)
         sha = input_hash.hexdigest()
         self.digest = sha
-        self.clength = total_len
-        man_header = str('_header:%s:%s:%d\n' % (self.__version, sha, total_len)).encode('utf-8')
-        inf_f.close()
-        combined_manifest.write(man_header)
-        combined_manifest.close()
-        if not keep_cache:
-            self.clean_cache()
+        self.clength = offset
+        with self.stats.timer('manifest_write'):
+            man_f.close(self.__version, sha, offset)
+        return self.result(StatusCodes.OK, 'OK')
+
+    def pacify(self, input_file=None, url_file=None, manifest=None, overwrite=False, keep_cache=False, threads=None,
+            resume=False, previous=None):
+        """
+        Build a manifest for input_file. With resume a run that was cut short
+        continues from its last checkpoint, with previous (the manifest of an
+        older version of the input) only the changed parts are matched.
+        """
+        self.timer_start = time.time()
+        self.stats.reset()
+        if manifest == '-':
+            self.log = sys.stderr
+        self.cache.acquire()
+        try:
+            self.build_cache(open(url_file).read().strip().split('\n'), persist=self._keeps_cache(keep_cache))
+            r = self.check_coverage(input_file)
+            if r != StatusCodes.OK:
+                pass
+            elif previous:
+                r = self._pacify_incremental(input_file=input_file, url_file=url_file, manifest=manifest,
+                    overwrite=overwrite, keep_cache=keep_cache, previous=previous)
+            elif threads is None or int(threads) < 2 or _is_stream(input_file) or _is_stream(manifest) or \
+                    _fork_context() is None:
+                r = self._pacify(input_file=input_file, url_file=url_file, manifest=manifest,
+                    overwrite=overwrite, keep_cache=keep_cache, show_progress=True, resume=resume)
+            else:
+                r = self._pacify_parallel(input_file=input_file, url_file=url_file, manifest=manifest,
+                    overwrite=overwrite, keep_cache=keep_cache, threads=threads, resume=resume)
+            with self.stats.timer('cache_cleanup'):
+                # A failed run keeps its downloads for --resume and the next attempt
+                self.finish_cache(keep_cache or r != StatusCodes.OK)
+        finally:
+            # finish_cache() releases the lock too, but not when this raises
+            self.cache.release()
+        self.stats.add_time('total', time.time() - self.timer_start)
+        self.stats.finish()
+        return r
+
+    def _pacify_one(self, input_file, manifest, urls, overwrite=False):
+        # Pacify one input of a batch and return its summary entry. Runs in a
+        # pool worker or in the parent, statuses of the input stay out of
+        # self.results and are returned as errors instead
+        results = self.results
+        self.results = Results()
+        self.total_chunks = 0
+        self.total_chunk_size = 0
+        start = time.time()
+        try:
+            d = os.path.dirname(manifest)
+            if d and not os.path.isdir(d):
+                os.makedirs(d, exist_ok=True)
+            r = self.check_coverage(input_file)
+            if r == StatusCodes.OK:
+                r = self._pacify(input_file=input_file, manifest=manifest, urls=urls, overwrite=overwrite)
+        except (IOError, OSError) as e:
+            r = self.result(StatusCodes.E_OPEN_INPUT_FILE, 'Failed to pacify input: %s' % (e))
+        errors = []
+        for status in self.results.get():
+            for (code, message) in zip(status.codes, status.messages):
+                if code != StatusCodes.OK:
+                    errors.append('%s: %s' % (code.name, message))
+        self.results = results
+        ok = r == StatusCodes.OK
+        return {
+            'input': input_file,
+            'manifest': manifest,
+            'result': r.name,
+            'sha256': self.digest if ok else None,
+            'length': self.clength if ok else None,
+            'items': self.total_chunks,
+            'seconds': time.time() - start,
+            'errors': errors,
+        }
+
+    def pacify_batch(self, inputs=None, url_file=None, out_dir=None, overwrite=False, keep_cache=False,
+            threads=None):
+        """
+        Pacify many input files against one corpus. inputs is a directory or
+        a list of paths (see batch_inputs()). The cache and index are loaded
+        once, then workers forked from this process share them and take the
+        inputs from a queue. A manifest is written per input below out_dir
+        along with BATCH_SUMMARY. The summary entries are kept in self.batch.
+        """
+        self.timer_start = time.time()
+        self.stats.reset()
+        jobs = batch_inputs(inputs, out_dir)
+        if not jobs:
+            return self.result(StatusCodes.E_OPEN_INPUT_FILE, 'No input files found')
+        urls = open(url_file).read().strip().split('\n')
+        self.cache.acquire()
+        try:
+            self.build_cache(urls, persist=self._keeps_cache(keep_cache))
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            self.batch = []
+            n_workers = int(threads or 1)
+            pool = None
+            if n_workers < 2 or _fork_context() is None:
+                done = (self._pacify_one(input_file, manifest, urls, overwrite) for (input_file, manifest) in jobs)
+            else:
+                pool = _fork_context().Pool(n_workers, _init_batch, ((self, urls, overwrite),))
+                # Small inputs are cheap, hand them out a few at a time
+                done = pool.imap_unordered(_pacify_batch_input, jobs, chunksize=max(1, min(16, len(jobs) // (n_workers * 4))))
+            progress = self._progress(len(jobs), 'batch').start()
+            try:
+                for entry in done:
+                    self.batch.append(entry)
+                    progress.set(len(self.batch))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+                progress.stop()
+            self.batch.sort(key=lambda entry: entry['input'])
+            failed = [entry for entry in self.batch if entry['result'] != StatusCodes.OK.name]
+            self.stats.incr('batch_inputs', len(self.batch))
+            self.stats.incr('batch_failed', len(failed))
+            with self.stats.timer('cache_cleanup'):
+                self.finish_cache(keep_cache)
+        finally:
+            # finish_cache() releases the lock too, but not when this raises
+            self.cache.release()
+        self.stats.add_time('total', time.time() - self.timer_start)
+        self.stats.finish()
+        summary = {
+            'inputs': len(self.batch),
+            'failed': len(failed),
+            'bytes': sum(entry['length'] or 0 for entry in self.batch),
+            'items': sum(entry['items'] for entry in self.batch),
+            'seconds': time.time() - self.timer_start,
+            'files': self.batch,
+        }
+        with open(os.path.join(out_dir, BATCH_SUMMARY), 'w') as f:
+            f.write(json.dumps(summary, indent=2) + '\n')
+        if failed:
+            return self.result(StatusCodes.E_FAILED, 'Failed to pacify %d of %d inputs.' % (len(failed), len(self.batch)))
         return self.result(StatusCodes.OK, 'OK')
 
     def _cache_path(self, url):
@@ -400,43 +948,42 @@ class Opacify(object):
         return cache_path
 
     def get_manifest_header(self, manifest_path):
-        last_line = None
-        # Start close to the end, but with enough padding that
-        # we won't skip the last line
-        start_offset = os.path.getsize(manifest_path) - 1024
-        if start_offset < 0:
-            start_offset = 0
-        self.print_debug('get_manifest_header: start_offest=%d' % (start_offset))
-        with gzip.open(manifest_path, 'rb') as f:
-            f.seek(start_offset, os.SEEK_SET)
-            for last_line in f:
-                pass
-        last_line = last_line.decode()
-        z = last_line.split(':')
-        (_, version, sha, length) = last_line.split(':')
-        return (version, sha, int(length))
+        return open_manifest(manifest_path).header()
+
+    def _keeps_cache(self, keep_cache):
+        # Whether the cache outlives a successful run, see finish_cache()
+        return keep_cache or self.cache.limit is not None
+
+    def finish_cache(self, keep_cache=False):
+        # With a cache limit the cache is kept and trimmed to the limit,
+        # otherwise it is removed unless keep_cache is set
+        if self.cache.limit is not None:
+            freed = self.cache.evict()
+            if freed is None:
+                self.print_debug('Cache is in use by another process, not evicting')
+            else:
+                self.print_debug('Evicted %d bytes from cache' % (freed))
+        elif not keep_cache:
+            self.clean_cache()
+        self.cache.release()
 
     def clean_cache(self):
         self.print_debug('Cleaning cache path: %s' % (self.cache_dir))
-        for name in os.listdir(self.cache_dir):
-            if not name.startswith('opacify-') or not name.endswith('.tmp'):
-                continue
-            path = '%s/%s' % (self.cache_dir, name)
-            self.print_debug('Remove cache file: %s' % (path))
-            os.unlink(path)
+        self.corpus.close()
+        self.ranges.close()
+        with self.cache.exclusive() as locked:
+            if not locked:
+                self.print_debug('Cache is in use by another process, not cleaning')
+                return
+            for name in os.listdir(self.cache_dir):
+                if not name.startswith('opacify-') or not name.endswith(('.tmp', '.idx', RANGE_SUFFIX)):
+                    continue
+                path = '%s/%s' % (self.cache_dir, name)
+                self.print_debug('Remove cache file: %s' % (path))
+                os.unlink(path)
 
-    def validate_output(self, path, sha, length):
-        h = hashlib.sha256()
-        clength = 0
+    def validate_digest(self, digest, sha, clength, length):
         length = int(length)
-        with open(path, 'rb') as f:
-            while True:
-                chunk = f.read(self.chunk_size)
-                if not chunk:
-                    break
-                h.update(chunk)
-                clength += len(chunk)
-        digest = h.hexdigest()
         self.print_debug('digest=%s sha=%s' % (digest, sha))
         if digest != sha:
             return self.result(StatusCodes.E_HASH_MISMATCH, 'Output file hash did not match manifest hash!')
@@ -447,57 +994,670 @@ class Opacify(object):
         self.clength = clength
         return self.result(StatusCodes.OK, 'OK')
 
-    def satisfy(self, manifest=None, out_file=None, keep_cache=False, overwrite=False, show_progress=True):
-        if not os.path.exists(self.cache_dir):
-            os.mkdir(self.cache_dir)
-        if os.path.exists(out_file) and not overwrite:
+    def validate_output(self, path, sha, length, reader=None):
+        """
+        Check the output file at path in one pass. When the manifest (reader)
+        has block digests every block is checked as well, and the output
+        ranges that do not match and their sources end up in self.corrupt.
+        """
+        h = hashlib.sha256()
+        clength = os.path.getsize(path)
+        blocks = reader.blocks() if reader is not None else None
+        if not blocks or blocks[-1].digest is None or blocks[-1].out_offset + blocks[-1].out_length != clength:
+            blocks = None
+        self.corrupt = []
+        if clength:
+            with open(path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    view = memoryview(m)
+                    if blocks is None:
+                        for pos in range(0, clength, HASH_BLOCK):
+                            h.update(view[pos:pos+HASH_BLOCK])
+                    else:
+                        for b in blocks:
+                            with view[b.out_offset:b.out_offset+b.out_length] as data:
+                                h.update(data)
+                                if hashlib.sha256(data).digest() != b.digest:
+                                    self.corrupt.append(b)
+                    view.release()
+                finally:
+                    m.close()
+        if self.corrupt:
+            lines = []
+            for b in self.corrupt[:CORRUPT_SHOWN]:
+                urls = sorted(set(url for (url, _, _) in reader.block_entries(b)))
+                lines.append('  %d-%d: %s' % (b.out_offset, b.out_offset + b.out_length, ' '.join(urls)))
+            if len(self.corrupt) > CORRUPT_SHOWN:
+                lines.append('  ... %d more' % (len(self.corrupt) - CORRUPT_SHOWN))
+            return self.result(StatusCodes.E_HASH_MISMATCH,
+                'Output file hash did not match manifest hash! Corrupt output ranges and their sources:\n%s' % (
+                '\n'.join(lines)))
+        return self.validate_digest(h.hexdigest(), sha, clength, length)
+
+    def _fetch_ranges(self, url, items):
+        # Fetch the coalesced byte ranges of url used by items that are not
+        # in the range cache yet. Stops early when the server ignores ranges
+        # and sends the whole source, which then lands in the full cache.
+        spans = coalesce([(url_offset, url_offset + buf_len) for (_, url_offset, buf_len) in items if buf_len > 0],
+            gap=self.range_gap, max_spans=RANGE_MAX_SPANS)
+        missing = self.ranges.missing(url, spans)
+        self.stats.incr('range_hits', len(spans) - len(missing))
+        for (start, end) in missing:
+            self.print_debug('get: %s range=%d-%d' % (url, start, end))
+            self.stats.incr('range_requests')
+            (kind, err) = self.fetcher.fetch_range(url, start, end, self.ranges.path(url, start, end),
+                self._cache_path(url))
+            if err is not None:
+                if url in self._failed_urls_cache:
+                    return self.result(StatusCodes.E_URL_OPEN, err)
+                return self.result(StatusCodes.E_CACHE_OPEN, err)
+            if kind == 'full':
+                self.print_debug('Ranges not supported, fetched whole source: %s' % (url))
+                break
+            self.ranges.add(url, start, end)
+        return StatusCodes.OK
+
+    def _satisfy_url(self, out_fd, url, items):
+        # Fetch one source (or just the ranges of it that items use) if needed
+        # and write every item that uses it to its precomputed output offset.
+        # Returns (url, bytes written, error).
+        start = time.time()
+        if self.corpus.has(url):
+            self.stats.incr('cache_hits')
+        else:
+            self.stats.incr('cache_misses')
+            if self.use_ranges:
+                r = self._fetch_ranges(url, items)
+            else:
+                r = self._write_url_to_cache(url)
+            if r != StatusCodes.OK:
+                return (url, 0, self.result(StatusCodes.E_OPEN_URL,
+                    'Failed to open url: %s\nOutput file is incomplete.' % (url)))
+        read = self.corpus.read if self.corpus.has(url) else self.ranges.read
+        written = 0
+        h = hashlib.sha256() if self.journal is not None else None
+        for (out_offset, url_offset, buf_len) in items:
+            self.print_debug('url=%s offset=%d len=%d out=%d' % (url, url_offset, buf_len, out_offset))
+            buf = read(url, url_offset, buf_len)
+            if len(buf) != buf_len:
+                return (url, written, self.result(StatusCodes.E_BUFFER_SIZE,
+                    'Source is too short: %s\nOutput file is incomplete.' % (url)))
+            pwrite(out_fd, buf, out_offset)
+            if h is not None:
+                h.update(buf)
+            written += buf_len
+        if h is not None:
+            self.journal.add(url, h.hexdigest())
+        self.stats.worker(nbytes=written, seconds=time.time() - start, items=len(items))
+        return (url, written, None)
+
+    def _satisfy_self(self, out_fd, items):
+        # Write the back references of a manifest once every source is
+        # written. In output order, so the output they copy is complete.
+        read = lambda offset, buf_len: pread(out_fd, buf_len, offset)
+        for (out_offset, ref, buf_len) in items:
+            if ref >= out_offset:
+                return self.result(StatusCodes.E_MANIFEST, 'Back reference to later output: %d' % (ref))
+            pwrite(out_fd, self_copy(read, ref, out_offset, buf_len), out_offset)
+        self.stats.incr('self_refs', len(items))
+        return StatusCodes.OK
+
+    def _satisfy_stream(self, reader, out_f, jobs=None):
+        # Write items strictly in order to a stream, hashing as they are
+        # written. Sources of the next STREAM_WINDOW items are fetched ahead
+        # by a thread pool, so memory stays bounded by the window.
+        h = hashlib.sha256()
+        clength = [0]
+        window = deque()
+        fetching = {}
+        # Output kept for back references
+        written = OutputWindow()
+        pool = ThreadPool(max(1, int(jobs or self.fetcher.workers)))
+
+        def fetch(url):
+            return self._write_url_to_cache(url)
+
+        def write(entry):
+            (url, url_offset, buf_len) = entry
+            if url == SELF_URL:
+                if url_offset >= clength[0]:
+                    return self.result(StatusCodes.E_MANIFEST, 'Back reference to later output: %d' % (url_offset))
+                try:
+                    buf = written.resolve(url_offset, buf_len)
+                except IOError as e:
+                    return self.result(StatusCodes.E_MANIFEST, str(e))
+                out_f.write(buf)
+                written.write(buf)
+                h.update(buf)
+                clength[0] += buf_len
+                return StatusCodes.OK
+            if url in fetching:
+                if fetching.pop(url).get() != StatusCodes.OK:
+                    return self.result(StatusCodes.E_OPEN_URL,
+                        'Failed to open url: %s\nOutput stream is incomplete.' % (url))
+            elif url in self._failed_urls_cache:
+                return StatusCodes.E_OPEN_URL
+            buf = self.corpus.read(url, url_offset, buf_len)
+            if len(buf) != buf_len:
+                return self.result(StatusCodes.E_BUFFER_SIZE,
+                    'Source is too short: %s\nOutput stream is incomplete.' % (url))
+            out_f.write(buf)
+            written.write(buf)
+            h.update(buf)
+            clength[0] += buf_len
+            return StatusCodes.OK
+
+        try:
+            for entry in reader.entries():
+                url = entry[0]
+                if url not in fetching and url != SELF_URL and not self.corpus.has(url):
+                    fetching[url] = pool.apply_async(fetch, (url,))
+                window.append(entry)
+                if len(window) >= STREAM_WINDOW:
+                    r = write(window.popleft())
+                    if r != StatusCodes.OK:
+                        return r
+            while window:
+                r = write(window.popleft())
+                if r != StatusCodes.OK:
+                    return r
+        finally:
+            pool.close()
+            pool.join()
+            out_f.flush()
+        (version, sha, length) = reader.header()
+        return self.validate_digest(h.hexdigest(), sha, clength[0], length)
+
+    def _check_written(self, out_file, groups, done):
+        # Sources of a resumed satisfy whose bytes in out_file still match the
+        # digest in the journal
+        valid = set()
+        if not os.path.getsize(out_file):
+            return valid
+        with open(out_file, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(m)
+                for (url, digest) in done.items():
+                    if url not in groups:
+                        continue
+                    h = hashlib.sha256()
+                    for (out_offset, _, buf_len) in groups[url]:
+                        h.update(view[out_offset:out_offset+buf_len])
+                    if h.hexdigest() == digest:
+                        valid.add(url)
+                    else:
+                        self.print_debug('written data changed, fetching again: %s' % (url))
+                view.release()
+            finally:
+                m.close()
+        return valid
+
+    def satisfy(self, manifest=None, out_file=None, keep_cache=False, overwrite=False, show_progress=True,
+            jobs=None, resume=False):
+        """
+        Rebuild out_file from manifest. Progress of an output file is kept in
+        a journal next to it until the output is validated, with resume a
+        rerun keeps the sources that were already written and only fetches
+        the others.
+        """
+        self.stats.reset()
+        start = time.time()
+        self.cache.acquire()
+        try:
+            r = self._satisfy(manifest=manifest, out_file=out_file, keep_cache=keep_cache, overwrite=overwrite,
+                show_progress=show_progress, jobs=jobs, resume=resume)
+        finally:
+            # finish_cache() releases the lock too, but not on early returns
+            self.cache.release()
+        self.stats.add_time('total', time.time() - start)
+        self.stats.finish()
+        return r
+
+    def _satisfy(self, manifest=None, out_file=None, keep_cache=False, overwrite=False, show_progress=True,
+            jobs=None, resume=False):
+        if _is_stream(manifest) or _is_stream(out_file):
+            # Manifest from stdin and/or output to stdout: single ordered pass
+            if resume:
+                return self.result(StatusCodes.E_CHECKPOINT, 'Resume needs a manifest file and an output file')
+            if manifest == '-':
+                reader = ManifestReader(_binary_stdio('stdin'))
+            elif _is_stream(manifest):
+                reader = ManifestReader(manifest)
+            else:
+                reader = open_manifest(manifest)
+            if _is_stream(out_file):
+                out_f = _binary_stdio('stdout') if out_file == '-' else out_file
+                if out_file == '-':
+                    self.log = sys.stderr
+            else:
+                if os.path.exists(out_file) and not overwrite:
+                    return self.result(StatusCodes.E_OUTFILE_EXISTS,
+                        'Output file exists. Use --force option to overwrite.')
+                out_f = open(out_file, 'wb')
+            try:
+                with self.stats.timer('stream'):
+                    r = self._satisfy_stream(reader, out_f, jobs=jobs)
+            finally:
+                if not _is_stream(out_file):
+                    out_f.close()
+            self.corpus.close()
+            self.finish_cache(keep_cache)
+            return r
+        if os.path.exists(out_file) and not overwrite and not resume:
             return self.result(StatusCodes.E_OUTFILE_EXISTS, 'Output file exists. Use --force option to overwrite.')
 
-        out_f = open(out_file, 'wb')
-        (version, sha, length) = self.get_manifest_header(manifest)
-        length = int(length)
-        self.print_debug('Manifest: %s %s %s' % (version, sha, length))
         timer_start = time.time()
-        progress_offset = 0
-        with gzip.open(manifest, 'rb') as m_f:
-            for line in m_f:
-                line = line.decode()
-                if line.startswith('_header:'): break
-                (url, url_offset, buf_len) = line.strip().split(' ')
-                url_offset = int(url_offset)
-                buf_len = int(buf_len)
-                self.print_debug('url=%s offset=%d len=%d' % (url, url_offset, buf_len))
-                progress_offset += buf_len
-                if show_progress:
-                    progress_bar(progress_offset, length, prefix='Progress:', suffix='', length=24,
-                        timer_start=timer_start)
-                buf = b''
-                cache_path = self._cache_path(url)
-                self.print_debug(cache_path)
-                if not os.path.exists(cache_path):
-                    self.print_debug('create cache file: %s' % (cache_path))
-                    self.print_debug('get: %s' % (url))
-                    r = requests.get(url, timeout=5, stream=True)
-                    if r.status_code != 200:
-                        return self.result(StatusCodes.E_OPEN_URL,
-                            'Failed to open url: %s\nOutput file is incomplete.' % (url))
-                    with open(cache_path, 'wb') as cache_f:
-                        for chunk in r:
-                            buf += chunk
-                            cache_f.write(chunk)
-                buf = b''
-                cache_f = open(cache_path, 'rb')
-                while True:
-                    tmp = cache_f.read(self.chunk_size*1000)
-                    if not tmp :break
-                    buf += tmp
-                    if len(buf) > buf_len + url_offset:
-                        break
-                cache_f.close()
-                buf = buf[url_offset:url_offset+buf_len]
-                out_f.write(buf)
+        # Every item's output offset is the running sum of the lengths before it,
+        # so items can be grouped by url and written in any order
+        reader = open_manifest(manifest)
+        groups = {}
+        out_offset = 0
+        with self.stats.timer('manifest_read'):
+            for (url, url_offset, buf_len) in reader.entries():
+                if url not in groups:
+                    groups[url] = []
+                groups[url].append((out_offset, url_offset, buf_len))
+                out_offset += buf_len
+            (version, sha, length) = reader.header()
+        self.print_debug('Manifest: %s %s %s' % (version, sha, length))
+        if out_offset != length:
+            return self.result(StatusCodes.E_MANIFEST, 'Manifest items do not add up to the header length.')
+        # Back references copy output of the other sources and are written
+        # after them
+        self_items = groups.pop(SELF_URL, [])
+
+        kept = set()
+        if resume and os.path.exists(out_file) and os.path.getsize(out_file) == length:
+            done = load_journal(out_file, sha, length)
+            if done:
+                with self.stats.timer('resume_check'):
+                    kept = self._check_written(out_file, groups, done)
+        if kept:
+            out_f = open(out_file, 'r+b')
+        else:
+            out_f = open(out_file, 'w+b')
+            out_f.truncate(length)
+        progress_offset = sum(buf_len for url in kept for (_, _, buf_len) in groups[url])
+        self.resumed = (len(kept), progress_offset)
+        self.stats.incr('resumed_sources', len(kept))
+        self.stats.incr('resumed_bytes', progress_offset)
+        self.journal = Journal(out_file, sha, length, append=bool(kept))
+        todo = [url for url in groups if url not in kept]
+        errors = 0
+        n_jobs = int(jobs or self.fetcher.workers)
+        pool = ThreadPool(max(1, min(n_jobs, len(todo))))
+        write_start = time.time()
+        progress = self._progress(length, 'satisfy', show=show_progress, done=progress_offset,
+            timer_start=timer_start).start()
+        try:
+            work = lambda url: self._satisfy_url(out_f.fileno(), url, groups[url])
+            for (url, written, err) in pool.imap_unordered(work, todo):
+                if err is not None:
+                    errors += 1
+                progress_offset += written
+                progress.set(progress_offset)
+            if self_items and not errors:
+                with self.stats.timer('self_refs'):
+                    r = self._satisfy_self(out_f.fileno(), self_items)
+                if r != StatusCodes.OK:
+                    errors += 1
+                progress.set(length)
+        finally:
+            pool.close()
+            pool.join()
+            progress.stop()
             out_f.close()
-        if not keep_cache:
-            self.clean_cache()
-        return self.validate_output(out_file, sha, length)
+            self.journal.close()
+            self.journal = None
+        self.stats.add_time('write', time.time() - write_start)
+        self.corpus.close()
+        self.ranges.close()
+        with self.stats.timer('cache_cleanup'):
+            self.finish_cache(keep_cache)
+        if errors > 0:
+            return self.result(StatusCodes.E_FAILED, 'Failed to satisfy %d of %d sources. Use --resume to retry them.' % (
+                errors, len(groups)))
+        with self.stats.timer('validate'):
+            r = self.validate_output(out_file, sha, length, reader)
+        # Done either way: a mismatch means the sources served other data
+        remove_journal(out_file)
+        return r
+
+    def verify(self, manifest=None, jobs=None, show_progress=True):
+        """
+        Check that every source of a manifest is reachable and long enough,
+        without downloading them. The manifest is streamed once to find the
+        furthest byte each url must serve, then all urls are probed
+        concurrently. Broken urls are kept in self.broken as
+        url -> (error, number of manifest items that cannot be satisfied).
+        """
+        if manifest == '-':
+            reader = ManifestReader(_binary_stdio('stdin'))
+        elif _is_stream(manifest):
+            reader = ManifestReader(manifest)
+        else:
+            reader = open_manifest(manifest)
+        self.stats.reset()
+        need = {}
+        items = {}
+        out_offset = 0
+        bad_refs = 0
+        with self.stats.timer('manifest_read'):
+            for (url, url_offset, buf_len) in reader.entries():
+                out_offset += buf_len
+                if url == SELF_URL:
+                    # Back references must point before their own output
+                    if url_offset >= out_offset - buf_len:
+                        bad_refs += 1
+                    continue
+                end = url_offset + buf_len
+                if end > need.get(url, 0):
+                    need[url] = end
+                items[url] = items.get(url, 0) + 1
+        self.broken = {}
+        if bad_refs:
+            return self.result(StatusCodes.E_MANIFEST, '%d back references do not point to earlier output.' % (bad_refs))
+        if not need:
+            return self.result(StatusCodes.OK, 'OK')
+        checked = 0
+        pool = ThreadPool(max(1, min(int(jobs or self.fetcher.workers), len(need))))
+        progress = self._progress(len(need), 'verify', show=show_progress, timer_start=time.time()).start()
+        try:
+            def work(url):
+                start = time.time()
+                r = (url,) + self.fetcher.probe(url, need[url])
+                self.stats.add_time('probe', time.time() - start)
+                self.stats.incr('probes')
+                self.stats.worker(items=1, seconds=time.time() - start)
+                return r
+            short = {}
+            for (url, size, err) in pool.imap_unordered(work, list(need.keys())):
+                self.print_debug('url=%s need=%d size=%s err=%s' % (url, need[url], size, err))
+                if err is not None:
+                    self.broken[url] = (err, items[url])
+                    self.stats.incr('broken_urls')
+                    if size is not None:
+                        short[url] = size
+                checked += 1
+                progress.set(checked)
+        finally:
+            pool.close()
+            pool.join()
+            progress.stop()
+        if short and not _is_stream(manifest):
+            # Only the items running past the end of a short source are broken
+            counts = dict((url, 0) for url in short)
+            for (url, url_offset, buf_len) in open_manifest(manifest).entries():
+                if url in short and url_offset + buf_len > short[url]:
+                    counts[url] += 1
+            for url in short:
+                self.broken[url] = (self.broken[url][0], counts[url])
+        if self.broken:
+            return self.result(StatusCodes.E_FAILED, '%d of %d sources are broken (%d items).' % (
+                len(self.broken), len(need), sum(n for (_, n) in self.broken.values())))
+        return self.result(StatusCodes.OK, 'OK')
+
+    def optimize(self, manifest=None, out_file=None, overwrite=False, fmt=None, retarget_urls=True):
+        """
+        Rewrite a manifest with contiguous items merged and, using the urls
+        already in the cache, with lightly used urls dropped in favour of
+        others holding the same bytes. The output is unchanged, so the header
+        is kept as is. The new manifest replaces out_file (or the manifest
+        itself) atomically. A summary is kept in self.optimized.
+        """
+        out_file = out_file or manifest
+        if out_file != manifest and os.path.exists(out_file) and not overwrite:
+            return self.result(StatusCodes.E_MANIFEST_EXISTS, 'Manifest file exists. Use --force to overwrite')
+        reader = open_manifest(manifest)
+        (version, sha, length) = reader.header()
+        count = [0]
+        def counted(entries):
+            for entry in entries:
+                count[0] += 1
+                yield entry
+        entries = list(merge_runs(counted(reader.entries())))
+        urls_before = len(set(url for (url, _, _) in entries))
+        if sum(buf_len for (_, _, buf_len) in entries) != length:
+            return self.result(StatusCodes.E_MANIFEST, 'Manifest items do not add up to the header length.')
+        dropped = []
+        if retarget_urls and os.path.isdir(self.cache_dir):
+            with self.stats.timer('retarget'):
+                dropped = retarget(entries, self.corpus, log=self.print_debug)
+            self.corpus.close()
+        tmp = '%s.%d.part' % (out_file, os.getpid())
+        writer = manifest_writer(tmp, fmt or manifest_format(manifest))
+        try:
+            for (url, url_offset, buf_len) in merge_runs(entries):
+                writer.add(url, url_offset, buf_len)
+            writer.close(version, sha, length)
+            os.rename(tmp, out_file)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self.digest = sha
+        self.clength = length
+        self.optimized = {
+            'items_before': count[0],
+            'items_after': writer.count,
+            'urls_before': urls_before,
+            'urls_after': urls_before - len(dropped),
+            'dropped': dropped,
+        }
+        return self.result(StatusCodes.OK, 'OK')
+
+    def _shard_data(self, items, input_f, start):
+        # Output bytes of one shard in order: read from the original input
+        # when there is one, otherwise rebuilt from the cache
+        if input_f is not None:
+            input_f.seek(start, os.SEEK_SET)
+            left = sum(buf_len for (_, _, buf_len) in items)
+            while left > 0:
+                data = input_f.read(min(HASH_BLOCK, left))
+                if not data:
+                    raise IOError('Input file is shorter than the manifest')
+                left -= len(data)
+                yield data
+            return
+        written = OutputWindow()
+        for (url, url_offset, buf_len) in items:
+            if url == SELF_URL:
+                buf = written.resolve(url_offset, buf_len)
+            else:
+                buf = self.corpus.read(url, url_offset, buf_len)
+                if len(buf) != buf_len:
+                    raise IOError('Source is too short: %s' % (url))
+            written.write(buf)
+            yield buf
+
+    def shard(self, manifest=None, out_dir=None, count=None, input_file=None, overwrite=False):
+        """
+        Split manifest into count shards by output byte range (see shard.py),
+        written to out_dir with their SHARD_PLAN. The sha256 of every shard
+        comes from input_file, the original input, or without it from the
+        sources in the cache. The plan is kept in self.shards.
+        """
+        path = os.path.join(out_dir, SHARD_PLAN)
+        if os.path.exists(path) and not overwrite:
+            return self.result(StatusCodes.E_PATH_EXISTS, 'Shard plan exists. Use --force to overwrite')
+        reader = open_manifest(manifest)
+        (version, sha, length) = reader.header()
+        with self.stats.timer('manifest_read'):
+            entries = list(reader.entries())
+        if sum(buf_len for (_, _, buf_len) in entries) != length:
+            return self.result(StatusCodes.E_MANIFEST, 'Manifest items do not add up to the header length.')
+        bounds = shard_bounds(length, int(count))
+        try:
+            shards = split_entries(entries, bounds)
+        except ValueError as e:
+            return self.result(StatusCodes.E_MANIFEST, str(e))
+        input_f = None
+        if input_file:
+            if os.path.getsize(input_file) != length:
+                return self.result(StatusCodes.E_LEN_MISMATCH, 'Input file length did not match manifest length!')
+            input_f = open(input_file, 'rb')
+        else:
+            missing = sorted(set(url for (url, _, _) in entries if url != SELF_URL and not self.corpus.has(url)))
+            if missing:
+                return self.result(StatusCodes.E_CACHE_OPEN,
+                    '%d sources are not in the cache, pass the input file instead: %s' % (len(missing), missing[0]))
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        fmt = self.manifest_format
+        h = hashlib.sha256()
+        plan = {
+            'version': SHARDS_VERSION,
+            'manifest': os.path.basename(manifest),
+            'sha256': sha,
+            'length': length,
+            'shards': [],
+        }
+        try:
+            for (i, items) in enumerate(shards):
+                name = SHARD_NAME % (i)
+                shard_h = hashlib.sha256()
+                writer = manifest_writer(os.path.join(out_dir, name + '.manifest'), fmt)
+                data = self._shard_data(items, input_f, bounds[i])
+                fed = 0
+                out = 0
+                for (url, url_offset, buf_len) in items:
+                    out += buf_len
+                    # Data goes to the writer ahead of its items, see ManifestWriter.feed()
+                    while fed < out:
+                        buf = next(data)
+                        h.update(buf)
+                        shard_h.update(buf)
+                        writer.feed(buf)
+                        fed += len(buf)
+                    writer.add(url, url_offset, buf_len)
+                writer.close(version, shard_h.hexdigest(), out)
+                plan['shards'].append({
+                    'index': i,
+                    'start': bounds[i],
+                    'end': bounds[i + 1],
+                    'length': out,
+                    'sha256': shard_h.hexdigest(),
+                    'items': len(items),
+                    'manifest': name + '.manifest',
+                    'output': name + '.out',
+                    'urls': sorted(set(url for (url, _, _) in items if url != SELF_URL)),
+                })
+        except (IOError, OSError) as e:
+            return self.result(StatusCodes.E_FAILED, 'Failed to shard manifest: %s' % (e))
+        finally:
+            if input_f is not None:
+                input_f.close()
+            self.corpus.close()
+        if h.hexdigest() != sha:
+            return self.result(StatusCodes.E_HASH_MISMATCH,
+                'Shard data does not match the manifest hash, the %s does not hold the original output!' % (
+                'input file' if input_file else 'cache'))
+        write_plan(path, plan)
+        self.shards = plan
+        return self.result(StatusCodes.OK, 'OK')
 
+    def assemble(self, plan=None, out_file=None, parts_dir=None, overwrite=False):
+        """
+        Concatenate the shard outputs of a shard plan into out_file, checking
+        every shard and the whole output against the plan in the same pass.
+        Shard outputs are looked up in parts_dir, by default the directory of
+        the plan. Shards that are missing or do not match are kept in
+        self.bad_shards.
+        """
+        if os.path.exists(out_file) and not overwrite:
+            return self.result(StatusCodes.E_OUTFILE_EXISTS, 'Output file exists. Use --force option to overwrite.')
+        try:
+            plan_data = load_plan(plan)
+        except (IOError, OSError, ValueError) as e:
+            return self.result(StatusCodes.E_OPEN_MANIFEST, 'Failed to read shard plan: %s' % (e))
+        parts_dir = parts_dir or os.path.dirname(plan_path(plan))
+        parts = [os.path.join(parts_dir, shard['output']) for shard in plan_data['shards']]
+        self.bad_shards = [shard['index'] for (shard, part) in zip(plan_data['shards'], parts)
+            if not os.path.exists(part)]
+        if self.bad_shards:
+            return self.result(StatusCodes.E_OPEN_INPUT_FILE, 'Missing shard outputs: %s' % (
+                ' '.join(SHARD_NAME % (i) for i in self.bad_shards)))
+        h = hashlib.sha256()
+        clength = 0
+        with open(out_file, 'wb') as out_f:
+            for (shard, part) in zip(plan_data['shards'], parts):
+                shard_h = hashlib.sha256()
+                n = 0
+                with open(part, 'rb') as f:
+                    while True:
+                        data = f.read(HASH_BLOCK)
+                        if not data:
+                            break
+                        shard_h.update(data)
+                        h.update(data)
+                        out_f.write(data)
+                        n += len(data)
+                clength += n
+                if n != shard['length'] or shard_h.hexdigest() != shard['sha256']:
+                    self.bad_shards.append(shard['index'])
+        if self.bad_shards:
+            return self.result(StatusCodes.E_HASH_MISMATCH, 'Shard outputs do not match the plan: %s' % (
+                ' '.join(SHARD_NAME % (i) for i in self.bad_shards)))
+        return self.validate_digest(h.hexdigest(), plan_data['sha256'], clength, plan_data['length'])
+
+    def plan(self, input_file=None, url_file=None, out_file=None, overwrite=False, keep_cache=False,
+            min_gain=PLAN_MIN_GAIN):
+        """
+        Rank the urls of url_file by how much of a sample of input_file they
+        cover, drop the ones that add nothing and write the rest to out_file
+        (most productive first). Urls are downloaded into the cache to score
+        them, keep the cache to reuse it for pacify. The plan is kept in
+        self.planned.
+        """
+        if out_file and os.path.exists(out_file) and not overwrite:
+            return self.result(StatusCodes.E_PATH_EXISTS, 'Output file exists. Use --force to overwrite')
+        try:
+            inf_f = open(input_file, 'rb')
+        except (IOError, OSError) as e:
+            return self.result(StatusCodes.E_OPEN_INPUT_FILE, 'Failed to open input file: %s' % (e))
+        self.stats.reset()
+        urls = []
+        self.cache.acquire()
+        try:
+            for url in open(url_file).read().strip().split('\n'):
+                url = url.strip()
+                if url and url not in urls:
+                    urls.append(url)
+            with self.stats.timer('download'):
+                self.fetch_urls(urls)
+            with self.stats.timer('sample'):
+                (grams, present) = sample_input(inf_f, os.path.getsize(input_file))
+            inf_f.close()
+            sources = []
+            unavailable = []
+            with self.stats.timer('score'):
+                for url in urls:
+                    if url in self._failed_urls_cache or not self.corpus.has(url):
+                        unavailable.append((url, 'unavailable'))
+                        continue
+                    (found, values) = url_coverage(self.corpus.view(url), grams)
+                    sources.append((url, found, values))
+            (kept, dropped, missing) = plan_urls(grams, present, sources, min_gain=min_gain)
+            self.corpus.close()
+            self.planned = {
+                'kept': kept,
+                'dropped': dropped + unavailable,
+                'uncovered': sorted(missing),
+            }
+            if out_file:
+                tmp = '%s.%d.part' % (out_file, os.getpid())
+                with open(tmp, 'w') as f:
+                    for (url, _, _) in kept:
+                        f.write('%s\n' % (url))
+                os.rename(tmp, out_file)
+            self.finish_cache(keep_cache)
+        finally:
+            # finish_cache() releases the lock too, but not when this raises
+            inf_f.close()
+            self.cache.release()
+        self.stats.finish()
+        if missing:
+            return self.result(StatusCodes.E_URL_NOT_FOUND,
+                'No url provides %d of the byte values in the input, pacify would fail' % (len(missing)))
+        return self.result(StatusCodes.OK, 'OK')
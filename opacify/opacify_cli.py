@@ -1,9 +1,19 @@
 import sys
 import os
 import time
+import json
 import argparse
+import cProfile
 from opacify import Opacify, StatusCodes
 from opacify import INFOTXT, EPILOG
+from opacify.opacify import ENGINES, DEFAULT_ENGINE, BATCH_SUMMARY
+from opacify.shard import SHARD_PLAN
+from opacify.fetch import FETCH_WORKERS
+from opacify.cache import parse_size
+from opacify.ranges import RANGE_GAP
+from opacify.planner import PLAN_MIN_GAIN
+from opacify.progress import PROGRESS_MODES, DEFAULT_PROGRESS
+from opacify.manifest import FORMATS, DEFAULT_FORMAT, convert_manifest, ManifestError
 
 #if __package__ is None or __package__ == '':
 if sys.version_info[0] < 3:
@@ -22,6 +32,21 @@ def dump_messages(o):
             if code == StatusCodes.OK: continue
             print('%s: %s' % (code.name, msg))
 
+def write_run_report(o, args, profiler, r):
+    # --profile and --stats-json output of a pacify, satisfy or verify run
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if getattr(args, 'stats_json', None):
+        report = dict(o.stats)
+        report['command'] = args.func
+        report['result'] = r.name if r is not None else None
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if args.stats_json == '-':
+            sys.stderr.write(data + '\n')
+        else:
+            with open(args.stats_json, 'w') as f:
+                f.write(data + '\n')
 
 #if __name__ == '__main__':
 def main():
@@ -41,12 +66,30 @@ def main():
         help='Validate manifest URLs and response length')
     group4 = subparser.add_parser('reddit', description='Auto-generate a urls file from reddit links',
         help='Auto-generate a urls file from reddit links')
+    group5 = subparser.add_parser('convert', description='Convert a manifest between formats',
+        help='Convert a manifest between formats')
+    group6 = subparser.add_parser('optimize',
+        description='Merge contiguous manifest items and move them to fewer urls (output is unchanged)',
+        help='Merge contiguous manifest items and move them to fewer urls')
+    group7 = subparser.add_parser('plan',
+        description='Rank the urls list by how much of the input each url covers and drop useless urls',
+        help='Rank and prune a urls list for an input file before pacify')
+    group8 = subparser.add_parser('shard',
+        description='Split a manifest into shards by output range that can be satisfied on different machines',
+        help='Split a manifest into independently satisfiable shards')
+    group9 = subparser.add_parser('assemble',
+        description='Join and verify the outputs of satisfied shards',
+        help='Join and verify the outputs of satisfied shards')
     # Pacify
     group4.add_argument('-o', '--out', required=True, help='Path to write urls to')
     group4.add_argument('-c', '--count', required=True, help='How many links to get')
-    group1.add_argument('-i', '--input', required=True, help='Path to input file')
+    inputs = group1.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--input',
+        help='Path to input file (- for stdin), or a directory to pacify every file below it')
+    inputs.add_argument('--input-list', help='Path to a file listing input files, one per line')
     group1.add_argument('-u', '--urls', required=True, help='Path to urls file')
-    group1.add_argument('-m', '--manifest', required=True, help='Output path of manifest file')
+    group1.add_argument('-m', '--manifest', required=True,
+        help='Output path of manifest file (- for stdout), or the manifest directory of a batch')
     group1.add_argument('-c', '--cache', required=True, help='Path to cache directory')
     group1.add_argument('-k', '--keep', action='store_const', const=True,
         help='Do not remove cache after completed. Useful for testing')
@@ -54,39 +97,157 @@ def main():
     group1.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
     group1.add_argument('-t', '--threads', help='Run processing multiple threads')
     group1.add_argument('-s', '--chunksize', help='Specify a different chunk size (default is 1 byte)')
+    group1.add_argument('-e', '--engine', choices=sorted(ENGINES.keys()), default=DEFAULT_ENGINE,
+        help='Matching engine built over the cache (default is %s)' % (DEFAULT_ENGINE))
+    group1.add_argument('-j', '--jobs', help='Number of parallel downloads (default is %d)' % (FETCH_WORKERS))
+    group1.add_argument('-L', '--cache-limit', type=parse_size,
+        help='Keep the cache between runs, evicting least recently used files above this size (e.g. 500M)')
+    group1.add_argument('-F', '--format', choices=FORMATS, default=DEFAULT_FORMAT,
+        help='Manifest format to write (default is %s)' % (DEFAULT_FORMAT))
+    group1.add_argument('-r', '--resume', action='store_const', const=True,
+        help='Continue an interrupted run from the checkpoint next to the manifest')
+    group1.add_argument('-P', '--previous',
+        help='Manifest of an older version of the input. Only changed parts are matched again')
+    group1.add_argument('--no-self-refs', action='store_const', const=True,
+        help='Match repeated input against the urls again instead of referring back to it')
     # Satisfy
-    group2.add_argument('-m', '--manifest', required=True, help='Path of manifest file')
-    group2.add_argument('-o', '--out', required=True, help='Path to write output file to')
+    group2.add_argument('-m', '--manifest', required=True, help='Path of manifest file (- for stdin)')
+    group2.add_argument('-o', '--out', required=True, help='Path to write output file to (- for stdout)')
     group2.add_argument('-c', '--cache', required=True, help='Path to cache directory')
     group2.add_argument('-k', '--keep', action='store_const', const=True,
         help='Do not remove cache after completed. Useful for testing')
     group2.add_argument('-f', '--force', action='store_const', const=True, help='Overwrite output file if it exists', default=False)
     group2.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
-    group3.add_argument('-m', '--manifest', required=True, help='Path of manifest file')
+    group2.add_argument('-j', '--jobs', help='Number of sources fetched and written in parallel (default is %d)' % (FETCH_WORKERS))
+    group2.add_argument('-L', '--cache-limit', type=parse_size,
+        help='Keep the cache between runs, evicting least recently used files above this size (e.g. 500M)')
+    group2.add_argument('-g', '--range-gap', type=parse_size,
+        help='Fetch byte ranges less than this far apart in one request (default is %s)' % (RANGE_GAP))
+    group2.add_argument('-R', '--full', action='store_const', const=True,
+        help='Download whole sources instead of only the byte ranges the manifest uses')
+    group2.add_argument('-r', '--resume', action='store_const', const=True,
+        help='Continue an interrupted or failed run, keeping the sources already written')
+    group3.add_argument('-m', '--manifest', required=True, help='Path of manifest file (- for stdin)')
     group3.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
+    group3.add_argument('-j', '--jobs', help='Number of sources checked in parallel (default is %d)' % (FETCH_WORKERS))
+    # Convert
+    group5.add_argument('-i', '--input', required=True, help='Path of manifest to convert')
+    group5.add_argument('-o', '--out', required=True, help='Path to write converted manifest to')
+    group5.add_argument('-F', '--format', choices=FORMATS, default=DEFAULT_FORMAT,
+        help='Manifest format to write (default is %s)' % (DEFAULT_FORMAT))
+    group5.add_argument('-f', '--force', action='store_const', const=True, help='Overwrite output if it exists')
+    group6.add_argument('-m', '--manifest', required=True, help='Path of manifest file')
+    group6.add_argument('-o', '--out', help='Path to write the optimized manifest to (default is in place)')
+    group6.add_argument('-c', '--cache',
+        help='Cache directory of the manifest urls (e.g. from pacify --keep). Without it items are only merged')
+    group6.add_argument('-F', '--format', choices=FORMATS,
+        help='Manifest format to write (default is the format of the input)')
+    group6.add_argument('-f', '--force', action='store_const', const=True, help='Overwrite output if it exists')
+    group6.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
+    group7.add_argument('-i', '--input', required=True, help='Path to input file')
+    group7.add_argument('-u', '--urls', required=True, help='Path to urls file')
+    group7.add_argument('-o', '--out', required=True, help='Path to write the planned urls file to')
+    group7.add_argument('-c', '--cache', required=True, help='Path to cache directory')
+    group7.add_argument('-k', '--keep', action='store_const', const=True,
+        help='Do not remove cache after completed. Lets pacify reuse the downloads')
+    group7.add_argument('-f', '--force', action='store_const', const=True, help='Overwrite output if it exists')
+    group7.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
+    group7.add_argument('-j', '--jobs', help='Number of parallel downloads (default is %d)' % (FETCH_WORKERS))
+    group7.add_argument('-L', '--cache-limit', type=parse_size,
+        help='Keep the cache between runs, evicting least recently used files above this size (e.g. 500M)')
+    group7.add_argument('--min-gain', type=float, default=PLAN_MIN_GAIN,
+        help='Drop urls adding less than this fraction of the sampled input (default is %s)' % (PLAN_MIN_GAIN))
+    group8.add_argument('-m', '--manifest', required=True, help='Path of manifest file')
+    group8.add_argument('-n', '--count', type=int, required=True, help='Number of shards')
+    group8.add_argument('-o', '--out', required=True, help='Directory to write the shard manifests and plan to')
+    group8.add_argument('-i', '--input',
+        help='The original input file, to compute the shard sha256s from. Without it the sources must be cached')
+    group8.add_argument('-c', '--cache', help='Cache directory holding the manifest sources (e.g. from pacify --keep)')
+    group8.add_argument('-F', '--format', choices=FORMATS, default=DEFAULT_FORMAT,
+        help='Manifest format of the shards (default is %s)' % (DEFAULT_FORMAT))
+    group8.add_argument('-f', '--force', action='store_const', const=True, help='Overwrite an existing shard plan')
+    group8.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
+    group9.add_argument('-p', '--plan', required=True, help='Path of the shard plan or the directory holding it')
+    group9.add_argument('-o', '--out', required=True, help='Path to write the output file to')
+    group9.add_argument('-s', '--shards',
+        help='Directory holding the shard outputs (<shard>.out, default is the plan directory)')
+    group9.add_argument('-f', '--force', action='store_const', const=True, help='Overwrite output file if it exists')
+    group9.add_argument('-d', '--debug', action='store_const', const=True, help='Turn on debug output')
+    for group in (group1, group2, group3):
+        group.add_argument('--stats-json', help='Write phase timings and counters as JSON to this path (- for stderr)')
+        group.add_argument('--profile', help='Write cProfile data of the run to this path')
+        group.add_argument('--progress', choices=PROGRESS_MODES, default=DEFAULT_PROGRESS,
+            help='Progress display: bar, json lines on stderr or quiet (default is %s)' % (DEFAULT_PROGRESS))
     parser.add_argument('-V', '--version', help='Display Opacify version info',
         action='version', version=version()) #'%(prog)s '+VERSION)
     args = parser.parse_args()
     cache = 'cache'
-    if args.func in ('pacify', 'satisfy'):
+    if args.func in ('pacify', 'satisfy', 'optimize', 'plan', 'shard'):
         if args.cache:
             cache = args.cache
+    # When data goes to stdout, keep the binary stream for it and send
+    # everything that is printed to stderr instead
+    data_out = None
+    if (args.func == 'pacify' and args.manifest == '-') or (args.func == 'satisfy' and args.out == '-'):
+        data_out = getattr(sys.stdout, 'buffer', sys.stdout)
+        sys.stdout = sys.stderr
     start_timer = time.time()
     debug = getattr(args, 'debug', False)
     n_threads = getattr(args, 'threads', None)
-    o = Opacify(cache_dir=cache, debug=debug)
+    o = Opacify(cache_dir=cache, debug=debug, engine=getattr(args, 'engine', None),
+        fetch_workers=getattr(args, 'jobs', None), manifest_format=getattr(args, 'format', None),
+        cache_limit=getattr(args, 'cache_limit', None), range_gap=getattr(args, 'range_gap', None),
+        ranges=not getattr(args, 'full', False), stats=bool(getattr(args, 'stats_json', None)),
+        progress=getattr(args, 'progress', None))
     r = None
-    if args.func == 'pacify':
+    profiler = None
+    if getattr(args, 'profile', None):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.func == 'pacify' and args.no_self_refs:
+        o.self_refs = False
+    if args.func == 'pacify' and (args.input_list or os.path.isdir(args.input)):
+        if args.chunksize:
+            o.chunk_size = int(args.chunksize)
+        inputs = args.input
+        if args.input_list:
+            inputs = [line.strip() for line in open(args.input_list) if line.strip()]
+        r = o.pacify_batch(inputs=inputs, url_file=args.urls, out_dir=args.manifest, overwrite=args.force,
+            keep_cache=args.keep, threads=n_threads)
+        write_run_report(o, args, profiler, r)
+        print('\n')
+        failed = [entry for entry in o.batch if entry['result'] != StatusCodes.OK.name]
+        for entry in failed:
+            print('FAILED: %s' % (entry['input']))
+            for err in entry['errors']:
+                print('    %s' % (err))
+        if not o.batch:
+            print('ERROR: Failed to pacify:')
+            dump_messages(o)
+            sys.exit(1)
+        print('Wrote manifests to: %s' % (args.manifest))
+        print('           Inputs: %d' % (len(o.batch)))
+        print('           Failed: %d' % (len(failed)))
+        print('    Original size: %d' % (sum(entry['length'] or 0 for entry in o.batch)))
+        print('     Total chunks: %d' % (sum(entry['items'] for entry in o.batch)))
+        print('          Summary: %s' % (os.path.join(args.manifest, BATCH_SUMMARY)))
+        print('         Duration: %.3fs' % (time.time() - start_timer))
+        if failed:
+            sys.exit(1)
+    elif args.func == 'pacify':
         if args.chunksize:
             o.chunk_size = int(args.chunksize)
         r = o.pacify(
             input_file=args.input,
             url_file=args.urls,
-            manifest=args.manifest,
+            manifest=data_out or args.manifest,
             overwrite=args.force,
             keep_cache=args.keep,
             threads=n_threads,
+            resume=args.resume,
+            previous=args.previous,
         )
+        write_run_report(o, args, profiler, r)
         print('\n')
         end_timer = time.time()
         avg_chunk_size = (o.total_chunk_size+1) / float(o.total_chunks+1)
@@ -98,14 +259,20 @@ def main():
             print('Wrote manifest to: %s' % (args.manifest))
             print('   Avg chunk size: %.2f' % (avg_chunk_size))
             print('     Total chunks: %s' % (o.total_chunks))
-            print('    Manifest size: %s' % (os.path.getsize(args.manifest)))
+            if data_out is None:
+                print('    Manifest size: %s' % (os.path.getsize(args.manifest)))
             #print('    Original size: %s' % (r[1]))
             #print('     Input sha256: %s' % (r[0]))
             print('    Original size: %s' % (o.clength))
             print('           sha256: %s...' % (o.digest[:16]))
+            if args.previous:
+                print('     Reused bytes: %s' % (o.reused))
+                print('  Rematched bytes: %s' % (o.rematched))
             print('         Duration: %.3fs' % (end_timer - start_timer))
     elif args.func == 'satisfy':
-        r = o.satisfy(manifest=args.manifest, out_file=args.out, keep_cache=args.keep, overwrite=args.force)
+        r = o.satisfy(manifest=args.manifest, out_file=data_out or args.out, keep_cache=args.keep,
+            overwrite=args.force, jobs=args.jobs, resume=args.resume)
+        write_run_report(o, args, profiler, r)
         print('\n')
         #if type(r) != tuple:
         if r != StatusCodes.OK:
@@ -113,10 +280,107 @@ def main():
             dump_messages(o)
         else:
             end_timer = time.time()
-            print('    Manifest size: %s' % (os.path.getsize(args.manifest)))
+            if args.manifest != '-':
+                print('    Manifest size: %s' % (os.path.getsize(args.manifest)))
             print('      Output size: %s' % (o.clength))
             print('           sha256: %s...' % (o.digest[:16]))
+            if args.resume:
+                print('  Resumed sources: %d (%d bytes)' % o.resumed)
             print('         Duration: %.3fs' % (end_timer - start_timer))
+    elif args.func == 'verify':
+        r = o.verify(manifest=args.manifest, jobs=args.jobs)
+        write_run_report(o, args, profiler, r)
+        print('\n')
+        if r != StatusCodes.OK:
+            print('ERROR: Failed to verify:')
+            for url in sorted(o.broken.keys()):
+                (err, items) = o.broken[url]
+                print('  %s: %s (%d items)' % (url, err, items))
+            dump_messages(o)
+            sys.exit(1)
+        end_timer = time.time()
+        print('Manifest is satisfiable: %s' % (args.manifest))
+        print('         Duration: %.3fs' % (end_timer - start_timer))
+    elif args.func == 'optimize':
+        size_before = os.path.getsize(args.manifest)
+        try:
+            r = o.optimize(manifest=args.manifest, out_file=args.out, overwrite=args.force, fmt=args.format,
+                retarget_urls=bool(args.cache))
+        except ManifestError as e:
+            print('ERROR: %s' % (e))
+            sys.exit(1)
+        if r != StatusCodes.OK:
+            print('ERROR: Failed to optimize:')
+            dump_messages(o)
+            sys.exit(1)
+        end_timer = time.time()
+        print('Wrote manifest to: %s' % (args.out or args.manifest))
+        print('            Items: %d -> %d' % (o.optimized['items_before'], o.optimized['items_after']))
+        print('             Urls: %d -> %d' % (o.optimized['urls_before'], o.optimized['urls_after']))
+        print('    Manifest size: %d -> %d' % (size_before, os.path.getsize(args.out or args.manifest)))
+        print('           sha256: %s...' % (o.digest[:16]))
+        print('         Duration: %.3fs' % (end_timer - start_timer))
+    elif args.func == 'plan':
+        r = o.plan(input_file=args.input, url_file=args.urls, out_file=args.out, overwrite=args.force,
+            keep_cache=args.keep, min_gain=args.min_gain)
+        print('\n')
+        planned = o.planned
+        for (url, gain, coverage) in planned.get('kept', []):
+            print('  keep  %6.2f%% %6.2f%%  %s' % (gain * 100, coverage * 100, url))
+        for (url, reason) in planned.get('dropped', []):
+            print('  drop  %-15s  %s' % (reason, url))
+        if r != StatusCodes.OK:
+            print('ERROR: Failed to plan:')
+            dump_messages(o)
+            sys.exit(1)
+        end_timer = time.time()
+        print('Wrote urls to: %s' % (args.out))
+        print('             Kept: %d' % (len(planned['kept'])))
+        print('          Dropped: %d' % (len(planned['dropped'])))
+        print('         Duration: %.3fs' % (end_timer - start_timer))
+    elif args.func == 'shard':
+        try:
+            r = o.shard(manifest=args.manifest, out_dir=args.out, count=args.count, input_file=args.input,
+                overwrite=args.force)
+        except ManifestError as e:
+            print('ERROR: %s' % (e))
+            sys.exit(1)
+        if r != StatusCodes.OK:
+            print('ERROR: Failed to shard:')
+            dump_messages(o)
+            sys.exit(1)
+        end_timer = time.time()
+        for shard in o.shards['shards']:
+            print('  %s  %d-%d  %d urls  %s...' % (shard['manifest'], shard['start'], shard['end'],
+                len(shard['urls']), shard['sha256'][:16]))
+        print('Wrote shards to: %s' % (args.out))
+        print('           Shards: %d' % (len(o.shards['shards'])))
+        print('             Plan: %s' % (os.path.join(args.out, SHARD_PLAN)))
+        print('         Duration: %.3fs' % (end_timer - start_timer))
+    elif args.func == 'assemble':
+        r = o.assemble(plan=args.plan, out_file=args.out, parts_dir=args.shards, overwrite=args.force)
+        if r != StatusCodes.OK:
+            print('ERROR: Failed to assemble:')
+            dump_messages(o)
+            sys.exit(1)
+        end_timer = time.time()
+        print('Wrote output to: %s' % (args.out))
+        print('      Output size: %d' % (o.clength))
+        print('    Output sha256: %s' % (o.digest))
+        print('         Duration: %.3fs' % (end_timer - start_timer))
+    elif args.func == 'convert':
+        if os.path.exists(args.out) and not args.force:
+            print('ERROR: %s exists. Use --force to overwrite' % (args.out))
+            sys.exit(1)
+        try:
+            count = convert_manifest(args.input, args.out, fmt=args.format)
+        except ManifestError as e:
+            print('ERROR: %s' % (e))
+            sys.exit(1)
+        print('Wrote %s manifest to: %s' % (args.format, args.out))
+        print('            Items: %d' % (count))
+        print('    Original size: %s' % (os.path.getsize(args.input)))
+        print('         New size: %s' % (os.path.getsize(args.out)))
     elif args.func == 'reddit':
         print('Generating urls from reddit data...')
         mode = 'w'
@@ -0,0 +1,69 @@
+#
+# Offline manifest optimization.
+#
+# merge_runs() joins consecutive items that continue each other in the same
+# url, which pacify produces a lot of with small chunk sizes.
+#
+# retarget() tries to drop whole urls: starting with the url the manifest
+# uses least, every item of it is looked up in the cached data of the urls
+# that are kept. Only if all of them are found are the items moved and the
+# url dropped, since a url that is still needed for one item still costs a
+# download. Items only ever move to bytes that compare equal, so the output
+# (and its sha256) does not change.
+#
+
+def merge_runs(entries):
+    """Yield (url, offset, length) items with contiguous runs merged."""
+    cur = None
+    for (url, offset, length) in entries:
+        if cur is not None and url == cur[0] and offset == cur[1] + cur[2]:
+            cur[2] += length
+            continue
+        if cur is not None:
+            yield tuple(cur)
+        cur = [url, offset, length]
+    if cur is not None:
+        yield tuple(cur)
+
+def retarget(entries, corpus, log=None):
+    """
+    Move the items of lightly used urls to heavier ones in place. entries is
+    a list of (url, offset, length) and corpus the cached data, urls that are
+    not cached are left alone. Returns the list of dropped urls.
+    """
+    weight = {}
+    by_url = {}
+    for (i, (url, offset, length)) in enumerate(entries):
+        weight[url] = weight.get(url, 0) + length
+        by_url.setdefault(url, []).append(i)
+    kept = sorted([url for url in weight if corpus.has(url)], key=lambda url: (-weight[url], url))
+    dropped = []
+    for url in list(reversed(kept)):
+        targets = [t for t in kept if t != url]
+        if not targets:
+            break
+        moves = []
+        for i in by_url[url]:
+            (_, offset, length) = entries[i]
+            data = bytes(corpus.read(url, offset, length))
+            if len(data) != length:
+                moves = None
+                break
+            for target in targets:
+                pos = corpus.find(target, data)
+                if pos >= 0:
+                    moves.append((i, target, pos))
+                    break
+            else:
+                moves = None
+                break
+        if moves is None:
+            continue
+        for (i, target, pos) in moves:
+            entries[i] = (target, pos, entries[i][2])
+            by_url[target].append(i)
+        kept.remove(url)
+        dropped.append(url)
+        if log is not None:
+            log('dropped %s (%d items)' % (url, len(moves)))
+    return dropped
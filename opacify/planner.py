@@ -0,0 +1,136 @@
+import heapq
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+# Corpus planner.
+#
+# Before a long pacify the url list can be cut down to the sources that are
+# actually useful for a given input. A sample of the input's k-grams (evenly
+# spaced blocks, weighted by how often each gram occurs) stands in for the
+# input. Every cached url is scored by the sampled weight it covers, and a
+# greedy weighted set cover keeps the url adding the most uncovered weight
+# until no url adds enough. Urls are kept in that order, so the most
+# productive sources come first in the list and are searched first.
+#
+# Every byte value of the input has to stay available or pacify fails, so
+# urls providing missing byte values are added at the end if needed.
+#
+# Scoring a url only looks up the sampled grams in its data, a block at a
+# time, so memory does not grow with the size of the source. With NumPy a
+# block is checked in one vectorized pass.
+#
+PLAN_K = 4
+PLAN_SAMPLES = 64
+PLAN_BLOCK = 4096
+# Urls adding less than this fraction of the sampled weight are dropped
+PLAN_MIN_GAIN = 0.0005
+READ_BLOCK = 1024 * 1024
+
+def sample_input(f, size, k=PLAN_K, samples=PLAN_SAMPLES, block=PLAN_BLOCK):
+    """
+    Return (grams, present) for a seekable input of size bytes: the sampled
+    k-grams with their counts and the set of byte values in the whole input.
+    """
+    present = set()
+    f.seek(0)
+    while len(present) < 256:
+        data = f.read(READ_BLOCK)
+        if not data:
+            break
+        present.update(bytearray(data))
+    if size <= samples * block:
+        positions = [(0, size)]
+    else:
+        step = (size - block) // (samples - 1)
+        positions = [(i * step, block) for i in range(samples)]
+    grams = {}
+    for (pos, length) in positions:
+        f.seek(pos)
+        data = f.read(length)
+        for i in range(len(data) - k + 1):
+            g = data[i:i+k]
+            grams[g] = grams.get(g, 0) + 1
+    return grams, present
+
+def url_coverage(data, grams, k=PLAN_K):
+    """Return (sampled grams found in data, byte values in data)."""
+    found = set()
+    values = set()
+    wanted = None
+    if numpy is not None:
+        wanted = numpy.array([int.from_bytes(g, 'big') for g in grams], dtype=numpy.uint64)
+    for start in range(0, len(data), READ_BLOCK):
+        # Blocks overlap by k-1 bytes so no gram is missed at the seams
+        block = bytes(data[start:start + READ_BLOCK + k - 1])
+        if len(values) < 256:
+            values.update(bytearray(block[:READ_BLOCK]))
+        if len(found) == len(grams):
+            continue
+        if wanted is not None:
+            found.update(_block_grams_numpy(block, wanted, k))
+        else:
+            found.update(block[i:i+k] for i in range(len(block) - k + 1) if block[i:i+k] in grams)
+    return found, values
+
+def _block_grams_numpy(block, wanted, k):
+    # The distinct grams of block whose values are in wanted, as bytes
+    d = numpy.frombuffer(block, dtype=numpy.uint8).astype(numpy.uint64)
+    count = len(d) - k + 1
+    if count <= 0:
+        return []
+    g = d[:count].copy()
+    for j in range(1, k):
+        g <<= numpy.uint64(8)
+        g |= d[j:j+count]
+    hits = numpy.unique(g[numpy.isin(g, wanted)])
+    return [int(v).to_bytes(k, 'big') for v in hits]
+
+def plan_urls(grams, present, sources, min_gain=PLAN_MIN_GAIN):
+    """
+    Choose and order urls. sources is a list of (url, found grams, byte
+    values) in url list order. Returns (kept, dropped, uncovered): kept is a
+    list of (url, gain, coverage) where gain is the weight the url added and
+    coverage the weight it covers on its own (both fractions of the sampled
+    weight), dropped a list of (url, reason) and uncovered the byte values
+    of the input no kept url has.
+    """
+    total = float(sum(grams.values())) or 1.0
+    weight = lambda found: sum(grams[g] for g in found)
+    coverage = dict((url, weight(found) / total) for (url, found, _) in sources)
+    found_of = dict((url, found) for (url, found, _) in sources)
+    bytes_of = dict((url, values) for (url, _, values) in sources)
+    # Lazy greedy: a url's gain only shrinks as more is covered, so a stale
+    # gain that still tops the heap after being refreshed is the best one
+    heap = [(-weight(found), i, url) for (i, (url, found, _)) in enumerate(sources)]
+    heapq.heapify(heap)
+    covered = set()
+    kept = []
+    while heap:
+        (_, i, url) = heapq.heappop(heap)
+        gain = weight(found_of[url] - covered)
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, i, url))
+            continue
+        if gain == 0 or gain / total < min_gain:
+            heapq.heappush(heap, (-gain, i, url))
+            break
+        kept.append((url, gain / total, coverage[url]))
+        covered |= found_of[url]
+    rest = [url for (_, _, url) in sorted(heap, key=lambda item: item[1])]
+    # Keep the input's byte values available
+    have = set()
+    for (url, _, _) in kept:
+        have |= bytes_of[url]
+    missing = set(present) - have
+    while missing and rest:
+        best = max(rest, key=lambda url: len(bytes_of[url] & missing))
+        if not bytes_of[best] & missing:
+            break
+        rest.remove(best)
+        kept.append((best, 0.0, coverage[best]))
+        missing -= bytes_of[best]
+    dropped = [(url, 'redundant' if found_of[url] else 'no coverage') for url in rest]
+    return kept, dropped, missing
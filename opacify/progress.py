@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import sys
 import time
+import json
+import threading
+import multiprocessing
 
 prev_tail = '|'
 tail = '|'
 # Modified version of comment here:
 #   https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
-def progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=50, fill='█', timer_start=None):
+def progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=50, fill='█', timer_start=None,
+        stream=None):
     """
     Call in a loop to create terminal progress bar
     @params:
@@ -18,8 +22,11 @@ def progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=50,
         length      - Optional  : character length of bar (Int)
         fill        - Optional  : bar fill character (Str)
         timer_start - Optional  : for estimating remaining time (time.time())
+        stream      - Optional  : file to draw on (default is sys.stdout)
     """
     global tail, prev_tail
+    if stream is None:
+        stream = sys.stdout
     if tail == '.':
         tail = '*'
     else:
@@ -46,11 +53,103 @@ def progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=50,
     filled_length = int(length * iteration // total)
     bar = fill * filled_length + '-' * (length - filled_length)
     if estimate:
-        sys.stdout.write('\r%s |%s| %s %s%% %s  %.2fm remaining    \r' % (prefix, bar, tail, percent, suffix, estimate)) #, end = '\r')
+        stream.write('\r%s |%s| %s %s%% %s  %.2fm remaining    \r' % (prefix, bar, tail, percent, suffix, estimate)) #, end = '\r')
     else:
-        sys.stdout.write('\r%s |%s| %s %s%% %s\r' % (prefix, bar, tail, percent, suffix)) #, end = '\r')
-    sys.stdout.flush()
+        stream.write('\r%s |%s| %s %s%% %s\r' % (prefix, bar, tail, percent, suffix)) #, end = '\r')
+    stream.flush()
     #if iteration == total:
     #    print('')
 
+#
+# Progress reporting.
+#
+# The loops of a run only store how far they got in a Progress, which costs
+# an attribute write (or a locked add on shared memory for counters that
+# worker processes update). A single reporter thread in the parent process
+# renders the counter every PROGRESS_INTERVAL seconds: as the progress bar,
+# as JSON lines for batch jobs and other programs, or not at all.
+#
+PROGRESS_MODES = ('bar', 'json', 'quiet')
+DEFAULT_PROGRESS = 'bar'
+# Seconds between two renders of the bar and two JSON lines
+PROGRESS_INTERVAL = 0.2
+JSON_INTERVAL = 1.0
 
+class Progress(object):
+    """
+    Progress of one task towards total (bytes, sources, inputs...). Set the
+    counter with set() or add() and render it with start() and stop(). With
+    shared=True the counter lives in shared memory, create the Progress
+    before forking workers and they can add() to it.
+    """
+    def __init__(self, total, task='', mode=DEFAULT_PROGRESS, stream=None, timer_start=None, shared=False,
+            done=0):
+        self.total = total
+        self.task = task
+        self.mode = mode
+        self.stream = stream
+        self.timer_start = timer_start or time.time()
+        self.done = done
+        self._shared = multiprocessing.Value('q', done) if shared else None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set(self, done):
+        self.done = done
+
+    def add(self, n):
+        if self._shared is not None:
+            with self._shared.get_lock():
+                self._shared.value += n
+        else:
+            self.done += n
+
+    def value(self):
+        if self._shared is not None:
+            return self._shared.value
+        return self.done
+
+    def start(self):
+        if self.mode == 'quiet' or self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the reporter and render the final state once."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.render(final=True)
+
+    def _run(self):
+        interval = JSON_INTERVAL if self.mode == 'json' else PROGRESS_INTERVAL
+        while not self._stop.wait(interval):
+            self.render()
+
+    def render(self, final=False):
+        done = self.value()
+        stream = self.stream
+        if stream is None:
+            stream = sys.stderr if self.mode == 'json' else sys.stdout
+        if self.mode == 'json':
+            elapsed = time.time() - self.timer_start
+            remaining = None
+            if done and self.total:
+                remaining = elapsed / done * (self.total - done)
+            stream.write(json.dumps({
+                'task': self.task,
+                'done': done,
+                'total': self.total,
+                'elapsed': round(elapsed, 3),
+                'remaining': round(remaining, 3) if remaining is not None else None,
+                'finished': final,
+            }) + '\n')
+            stream.flush()
+        elif self.total:
+            progress_bar(done, self.total, prefix='Progress:', suffix='', length=24,
+                timer_start=self.timer_start, stream=stream)
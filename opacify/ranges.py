@@ -0,0 +1,145 @@
+import os
+import mmap
+import threading
+from bisect import bisect_right
+
+#
+# Sparse range cache.
+#
+# satisfy only needs the bytes the manifest points at, so instead of whole
+# sources it can fetch byte ranges. A url's ranges are stored next to the
+# full cache files as opacify-<sha256(url)>.<start>-<end>.rng, each holding
+# bytes [start, end) of the source.
+#
+RANGE_SUFFIX = '.rng'
+# Spans closer than this are fetched with one request, reading the gap
+RANGE_GAP = 64 * 1024
+# At most this many range requests per url, the gap grows until it fits
+RANGE_MAX_SPANS = 64
+
+def coalesce(spans, gap=RANGE_GAP, max_spans=RANGE_MAX_SPANS):
+    """
+    Merge (start, end) spans that overlap or are at most gap bytes apart.
+    Returns sorted, disjoint spans. If more than max_spans remain the gap is
+    doubled until they fit, trading extra bytes for fewer round trips.
+    """
+    spans = sorted(spans)
+    while True:
+        merged = []
+        for (start, end) in spans:
+            if merged and start - merged[-1][1] <= gap:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        if not max_spans or len(merged) <= max_spans:
+            return [(start, end) for (start, end) in merged]
+        gap = max(gap * 2, 1)
+
+class RangeCache(object):
+    """
+    The byte ranges of urls held in the cache directory. Files already on
+    disk are found with one directory scan, new ones are added as they are
+    fetched. Ranges are memory mapped once and handed out as memoryviews,
+    like Corpus does for whole files.
+    """
+    def __init__(self, cache_dir, path_for, on_open=None):
+        # path_for(url) is the full cache path of a url, range files share
+        # its name up to the extension
+        self.cache_dir = cache_dir
+        self.path_for = path_for
+        self.on_open = on_open
+        self._ranges = None
+        self._maps = {}
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def _prefix(self, url):
+        return os.path.basename(self.path_for(url))[:-len('.tmp')]
+
+    def path(self, url, start, end):
+        return '%s/%s.%d-%d%s' % (self.cache_dir, self._prefix(url), start, end, RANGE_SUFFIX)
+
+    def _scan(self):
+        # prefix -> sorted [(start, end)] of every range file on disk
+        ranges = {}
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if not name.startswith('opacify-') or not name.endswith(RANGE_SUFFIX):
+                    continue
+                (prefix, _, span) = name[:-len(RANGE_SUFFIX)].rpartition('.')
+                (start, _, end) = span.partition('-')
+                if start.isdigit() and end.isdigit():
+                    ranges.setdefault(prefix, []).append((int(start), int(end)))
+        for spans in ranges.values():
+            spans.sort()
+        return ranges
+
+    def ranges(self, url):
+        with self._lock:
+            if self._ranges is None:
+                self._ranges = self._scan()
+            return list(self._ranges.get(self._prefix(url), ()))
+
+    def add(self, url, start, end):
+        # Record a range file that was just renamed into place
+        with self._lock:
+            if self._ranges is None:
+                self._ranges = self._scan()
+            spans = self._ranges.setdefault(self._prefix(url), [])
+            if (start, end) not in spans:
+                spans.append((start, end))
+                spans.sort()
+
+    def _find(self, url, start, end):
+        spans = self.ranges(url)
+        i = bisect_right(spans, (start, float('inf'))) - 1
+        while i >= 0:
+            if spans[i][0] <= start and spans[i][1] >= end:
+                return spans[i]
+            i -= 1
+        return None
+
+    def covers(self, url, start, end):
+        return self._find(url, start, end) is not None
+
+    def missing(self, url, spans):
+        return [(start, end) for (start, end) in spans if not self.covers(url, start, end)]
+
+    def read(self, url, offset, length):
+        """
+        Return bytes [offset, offset+length) of url from a cached range. The
+        result is short when no range holds them.
+        """
+        span = self._find(url, offset, offset + length)
+        if span is None:
+            return b''
+        path = self.path(url, span[0], span[1])
+        with self._lock:
+            v = self._views.get(path)
+            if v is None:
+                if self.on_open is not None:
+                    self.on_open(path)
+                with open(path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        v = memoryview(b'')
+                    else:
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        self._maps[path] = m
+                        v = memoryview(m)
+                self._views[path] = v
+        return v[offset - span[0]:offset - span[0] + length]
+
+    def close(self):
+        with self._lock:
+            for (path, v) in self._views.items():
+                m = self._maps.get(path)
+                try:
+                    v.release()
+                    if m is not None:
+                        m.close()
+                except BufferError:
+                    # Unmapped once the last slice is garbage collected
+                    pass
+            self._views = {}
+            self._maps = {}
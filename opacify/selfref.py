@@ -0,0 +1,170 @@
+from bisect import bisect_right
+
+#
+# Back references to the input itself.
+#
+# Repeated regions of an input (logs, archives, padding) would each be
+# matched against the corpus again and fetched again by satisfy. Instead
+# pacify remembers where every manifest item started, keyed by the SELF_MIN
+# bytes there, in a window over the input read so far. When the bytes at the
+# current position were seen at an item start before, the match is extended
+# as far as the two regions agree and emitted as an item of SELF_URL whose
+# offset is the earlier output offset. After a back reference the next one
+# is first tried where it left off, so long repeats continue without a
+# lookup.
+#
+# A back reference copies output bytes [offset, offset + length) in order,
+# like LZ77: it may overlap the output it produces, in which case the bytes
+# between offset and its own output offset repeat. It never points further
+# back than SELF_WINDOW, so satisfy to a stream only keeps that much output.
+#
+SELF_URL = 'opacify:self'
+SELF_MIN = 32
+SELF_WINDOW = 8 * 1024 * 1024
+# Item starts remembered before the ones that left the window are dropped
+SELF_INDEX_MAX = 1 << 20
+
+def _common_prefix(data, i, j, limit):
+    # Length of the common prefix of data[i:] and data[j:], at most limit.
+    # Blocks double in size while they compare equal and the first block
+    # that differs is bisected, so only O(log n) slices are compared.
+    n = 0
+    step = SELF_MIN
+    while n < limit:
+        k = min(step, limit - n)
+        if data[i+n:i+n+k] == data[j+n:j+n+k]:
+            n += k
+            step *= 2
+            continue
+        lo = 0
+        hi = k
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if data[i+n:i+n+mid] == data[j+n:j+n+mid]:
+                lo = mid
+            else:
+                hi = mid
+        return n + lo
+    return n
+
+class InputHistory(object):
+    """
+    The input read so far (at most about two windows of it) and the item
+    starts seen in it. Offsets are absolute input offsets, base is where
+    the history starts.
+    """
+    def __init__(self, base=0, window=SELF_WINDOW):
+        self.base = base
+        self.window = window
+        self.data = bytearray()
+        self.starts = {}
+        self.next = None
+
+    def append(self, data):
+        self.data += data
+        if len(self.data) > 2 * self.window:
+            drop = len(self.data) - self.window
+            del self.data[:drop]
+            self.base += drop
+            if len(self.starts) > SELF_INDEX_MAX:
+                self.starts = dict((key, pos) for (key, pos) in self.starts.items() if pos >= self.base)
+
+    def find(self, pos, limit):
+        """
+        Return (length, earlier offset) of the longest repeat at pos that is
+        at least SELF_MIN and at most limit bytes long, or None.
+        """
+        i = pos - self.base
+        limit = min(limit, len(self.data) - i)
+        if limit < SELF_MIN:
+            return None
+        for ref in (self.next, self.starts.get(bytes(self.data[i:i+SELF_MIN]))):
+            if ref is None or ref < self.base or ref >= pos or pos - ref > self.window:
+                continue
+            length = _common_prefix(self.data, ref - self.base, i, limit)
+            if length >= SELF_MIN:
+                return (length, ref)
+        return None
+
+    def mark(self, pos, length, ref=None):
+        """Record the item of length bytes at pos, ref is set for a back reference."""
+        i = pos - self.base
+        key = bytes(self.data[i:i+SELF_MIN])
+        if len(key) == SELF_MIN:
+            self.starts[key] = pos
+        self.next = ref + length if ref is not None else None
+
+def self_copy(read, ref, out_offset, length):
+    """
+    Bytes of a back reference at out_offset. read(offset, length) returns
+    output bytes written before out_offset.
+    """
+    d = out_offset - ref
+    if d >= length:
+        return read(ref, length)
+    # Overlapping: out_offset - ref bytes repeat
+    period = read(ref, d)
+    return (period * (length // d + 1))[:length]
+
+class OutputWindow(object):
+    """The last SELF_WINDOW (or more) bytes of output written in order."""
+    def __init__(self, window=SELF_WINDOW):
+        self.window = window
+        self.base = 0
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) > 2 * self.window:
+            drop = len(self.data) - self.window
+            del self.data[:drop]
+            self.base += drop
+
+    def read(self, offset, length):
+        if offset < self.base:
+            raise IOError('Back reference to %d is out of the window' % (offset))
+        i = offset - self.base
+        return bytes(self.data[i:i+length])
+
+    def resolve(self, ref, length):
+        """Bytes of a back reference at the current end of the output."""
+        return self_copy(self.read, ref, self.base + len(self.data), length)
+
+def expand_self_refs(entries):
+    """
+    Yield (url, offset, length) items with every back reference replaced
+    by the items it copies.
+    """
+    starts = []
+    items = []
+    out = [0]
+    def add(item):
+        starts.append(out[0])
+        items.append(item)
+        out[0] += item[2]
+        return item
+    for (url, offset, length) in entries:
+        if url != SELF_URL:
+            yield add((url, offset, length))
+            continue
+        ref = offset
+        left = length
+        while left > 0:
+            # Overlapping references are copied a period at a time
+            n = min(left, out[0] - ref)
+            if n <= 0:
+                raise ValueError('Back reference to %d at output offset %d' % (ref, out[0]))
+            end = ref + n
+            parts = []
+            i = bisect_right(starts, ref) - 1
+            while i < len(items) and starts[i] < end:
+                (u, o, l) = items[i]
+                lo = max(ref, starts[i])
+                hi = min(end, starts[i] + l)
+                if hi > lo:
+                    parts.append((u, o + lo - starts[i], hi - lo))
+                i += 1
+            for item in parts:
+                yield add(item)
+            ref += n
+            left -= n
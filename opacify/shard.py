@@ -0,0 +1,98 @@
+import os
+import json
+from bisect import bisect_right
+
+from .selfref import SELF_URL, expand_self_refs
+
+#
+# Sharded satisfy.
+#
+# A manifest is cut into shards by output byte range. Every shard is an
+# ordinary manifest of its own bytes (with their sha256 and length), so any
+# node can run satisfy on it with its own cache, and the shard outputs
+# concatenated in order are the original output. SHARD_PLAN lists the
+# shards with their ranges, digests and urls, and is what assemble checks
+# the shard outputs and the result against.
+#
+# Items are split where a shard boundary cuts them. A back reference into
+# an earlier shard is replaced by the items it copies, the others are
+# rebased to the shard start, so shards never depend on each other.
+#
+SHARDS_VERSION = 1
+SHARD_PLAN = 'opacify-shards.json'
+SHARD_NAME = 'shard-%04d'
+
+def shard_bounds(length, count):
+    """Output offsets cutting length bytes into count shards of about equal size."""
+    count = max(1, min(count, length))
+    return [length * i // count for i in range(count + 1)]
+
+class _Flat(object):
+    # The items of a manifest with back references expanded, by output offset
+    def __init__(self, entries):
+        self.starts = []
+        self.items = []
+        out = 0
+        for item in expand_self_refs(entries):
+            self.starts.append(out)
+            self.items.append(item)
+            out += item[2]
+
+    def between(self, start, end):
+        i = bisect_right(self.starts, start) - 1
+        while i < len(self.items) and self.starts[i] < end:
+            (url, offset, length) = self.items[i]
+            lo = max(start, self.starts[i])
+            hi = min(end, self.starts[i] + length)
+            if hi > lo:
+                yield (url, offset + lo - self.starts[i], hi - lo)
+            i += 1
+
+def split_entries(entries, bounds):
+    """
+    Cut a list of (url, offset, length) items at the output offsets in
+    bounds (see shard_bounds()). Returns the items of every shard.
+    """
+    shards = [[] for _ in range(len(bounds) - 1)]
+    flat = None
+    i = 0
+    out = 0
+    for (url, offset, length) in entries:
+        pos = out
+        end = out + length
+        while pos < end:
+            while bounds[i + 1] <= pos:
+                i += 1
+            start = bounds[i]
+            n = min(end, bounds[i + 1]) - pos
+            skip = pos - out
+            if url != SELF_URL:
+                shards[i].append((url, offset + skip, n))
+            elif offset + skip >= start:
+                shards[i].append((SELF_URL, offset + skip - start, n))
+            else:
+                if flat is None:
+                    flat = _Flat(entries)
+                shards[i].extend(flat.between(pos, pos + n))
+            pos += n
+        out = end
+    return shards
+
+def plan_path(path):
+    # A plan is given by its path or the directory holding it
+    if os.path.isdir(path):
+        return os.path.join(path, SHARD_PLAN)
+    return path
+
+def load_plan(path):
+    with open(plan_path(path)) as f:
+        plan = json.load(f)
+    if plan.get('version') != SHARDS_VERSION:
+        raise ValueError('Unsupported shard plan version: %s' % (plan.get('version')))
+    return plan
+
+def write_plan(path, plan):
+    tmp = '%s.%d.part' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(plan, indent=2) + '\n')
+    os.rename(tmp, path)
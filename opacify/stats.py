@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.time() - self.start)
+        return False
+
+class Stats(dict):
+    """
+    Phase timers and counters of a pacify, satisfy or verify run.
+
+    It is a plain dict underneath so it can be dumped as JSON directly:
+
+        phases   name -> {'seconds', 'calls'}
+        counters name -> number
+        urls     url -> {'bytes', 'seconds'} downloaded
+        workers  name -> {'items', 'bytes', 'seconds', 'mb_per_sec'}
+
+    When disabled every call returns straight away, and timer() hands out a
+    shared no-op context manager.
+    """
+    def __init__(self, enabled=False):
+        dict.__init__(self)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.clear()
+        self['phases'] = {}
+        self['counters'] = {}
+        self['urls'] = {}
+        self['workers'] = {}
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            phase = self['phases'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+            phase['seconds'] += seconds
+            phase['calls'] += calls
+
+    def incr(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self['counters'][name] = self['counters'].get(name, 0) + n
+
+    def download(self, url, nbytes, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self['urls'].setdefault(url, {'bytes': 0, 'seconds': 0.0})
+            entry['bytes'] += nbytes
+            entry['seconds'] += seconds
+            counters = self['counters']
+            counters['download_bytes'] = counters.get('download_bytes', 0) + nbytes
+
+    def worker(self, name=None, nbytes=0, seconds=0.0, items=1):
+        # Throughput of one worker process or thread, named after it by default
+        if not self.enabled:
+            return
+        if name is None:
+            name = '%d-%d' % (os.getpid(), threading.current_thread().ident)
+        with self._lock:
+            entry = self['workers'].setdefault(str(name), {'items': 0, 'bytes': 0, 'seconds': 0.0})
+            entry['items'] += items
+            entry['bytes'] += nbytes
+            entry['seconds'] += seconds
+            entry['mb_per_sec'] = (entry['bytes'] / 1048576.0) / entry['seconds'] if entry['seconds'] else None
+
+    def finish(self):
+        # Derived values, filled in at the end of a run
+        if not self.enabled:
+            return
+        counters = self['counters']
+        if counters.get('find_calls'):
+            counters['bytes_scanned_per_match'] = counters.get('bytes_scanned', 0) / float(counters['find_calls'])
+            counters['bytes_per_match'] = counters.get('bytes_matched', 0) / float(counters['find_calls'])
+
+    def merge(self, other):
+        # Fold in the counters and phases collected by a worker process
+        if not self.enabled or not other:
+            return
+        for (name, phase) in other.get('phases', {}).items():
+            self.add_time(name, phase['seconds'], phase['calls'])
+        for (name, n) in other.get('counters', {}).items():
+            self.incr(name, n)
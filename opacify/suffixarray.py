@@ -0,0 +1,175 @@
+import os
+import json
+import struct
+from array import array
+from bisect import bisect_right
+
+from .index import common_prefix, cached_urls, index_is_current
+
+#
+# Suffix array over the concatenated URL cache.
+#
+# Each cached URL is followed by a unique sentinel symbol (256 + document
+# number) so that no suffix compares past the end of its own document. The
+# array is built by prefix doubling and stored next to the cache files.
+#
+# find() narrows the suffix range one input byte at a time, so a single query
+# returns the longest match in the whole corpus starting at the current input
+# position in O(match_length * log(corpus)).
+#
+SA_MAGIC = b'OPCFYSA1'
+SA_VERSION = 1
+
+def build_suffix_array(text, ends):
+    n = len(text)
+    rank = array('l', iter(text))
+    for doc, end in enumerate(ends):
+        rank[end] = 256 + doc
+    sa = sorted(range(n), key=rank.__getitem__)
+    k = 1
+    while True:
+        r = rank
+        key = [r[i] * (n + 257) + (r[i+k] + 1 if i + k < n else 0) for i in range(n)]
+        sa.sort(key=key.__getitem__)
+        new_rank = array('l', [0]) * n
+        classes = 0
+        prev = key[sa[0]]
+        for i in sa:
+            if key[i] != prev:
+                classes += 1
+                prev = key[i]
+            new_rank[i] = classes
+        rank = new_rank
+        if classes == n - 1:
+            break
+        k *= 2
+    return array('l', sa)
+
+class SuffixArrayIndex(object):
+    def __init__(self):
+        self.corpus = None
+        self.urls = []
+        self.sizes = []
+        self.starts = []
+        self.ends = []
+        self.total = 0
+        self.text = b''
+        self.sa = array('l')
+
+    def _load_text(self):
+        # text holds every document followed by one filler byte standing in
+        # for its sentinel, so suffix positions index it directly
+        parts = []
+        self.starts = []
+        self.ends = []
+        pos = 0
+        for url, size in zip(self.urls, self.sizes):
+            parts.append(self.corpus.view(url))
+            parts.append(b'\0')
+            self.starts.append(pos)
+            pos += size
+            self.ends.append(pos)
+            pos += 1
+        self.text = b''.join(parts)
+        self.total = sum(self.sizes)
+        self._end_set = set(self.ends)
+
+    def _symbol(self, pos):
+        if pos in self._end_set:
+            return 256
+        return self.text[pos]
+
+    def _narrow(self, lo, hi, depth, c):
+        # Suffixes in [lo, hi) share their first `depth` symbols, so the
+        # symbols at `depth` are sorted and the run equal to c is found by
+        # two binary searches
+        sa = self.sa
+        symbol = self._symbol
+        a, b = lo, hi
+        while a < b:
+            mid = (a + b) // 2
+            if symbol(sa[mid] + depth) < c:
+                a = mid + 1
+            else:
+                b = mid
+        first = a
+        b = hi
+        while a < b:
+            mid = (a + b) // 2
+            if symbol(sa[mid] + depth) <= c:
+                a = mid + 1
+            else:
+                b = mid
+        return first, a
+
+    def find(self, buf):
+        """
+        Return (length, url_offset, url) for the longest prefix of buf that
+        occurs anywhere in the corpus, or None if buf[0] never occurs.
+        """
+        lo, hi = 0, len(self.sa)
+        depth = 0
+        while depth < len(buf) and hi - lo > 1:
+            a, b = self._narrow(lo, hi, depth, buf[depth])
+            if a == b:
+                break
+            lo, hi = a, b
+            depth += 1
+        if hi - lo == 1 and depth < len(buf):
+            # Only one suffix left, extend it directly up to its document end
+            pos = self.sa[lo]
+            doc = bisect_right(self.starts, pos) - 1
+            end = self.starts[doc] + self.sizes[doc]
+            depth = common_prefix(self.text[pos:min(end, pos + len(buf))], buf)
+        if depth == 0:
+            return None
+        pos = self.sa[lo]
+        doc = bisect_right(self.starts, pos) - 1
+        return (depth, pos - self.starts[doc], self.urls[doc])
+
+    def close(self):
+        pass
+
+    def save(self, path):
+        meta = json.dumps({
+            'version': SA_VERSION,
+            'urls': self.urls,
+            'sizes': self.sizes,
+        }).encode('utf-8')
+        tmp = path + '.part'
+        with open(tmp, 'wb') as f:
+            f.write(SA_MAGIC)
+            f.write(struct.pack('<I', len(meta)))
+            f.write(meta)
+            self.sa.tofile(f)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, urls, corpus):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            if f.read(len(SA_MAGIC)) != SA_MAGIC:
+                return None
+            (meta_len,) = struct.unpack('<I', f.read(4))
+            meta = json.loads(f.read(meta_len).decode('utf-8'))
+            if meta['version'] != SA_VERSION or not index_is_current(meta, urls, corpus):
+                return None
+            index = cls()
+            index.sa.frombytes(f.read())
+        index.corpus = corpus
+        index.urls = meta['urls']
+        index.sizes = meta['sizes']
+        index._load_text()
+        return index
+
+    @classmethod
+    def build(cls, urls, corpus):
+        index = cls()
+        index.corpus = corpus
+        index.urls = cached_urls(urls, corpus)
+        index.sizes = [corpus.size(url) for url in index.urls]
+        index._load_text()
+        if index.sizes:
+            index.sa = build_suffix_array(index.text, index.ends)
+        return index
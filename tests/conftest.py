@@ -0,0 +1,185 @@
+import os
+import sys
+import random
+import subprocess
+import threading
+import functools
+try:
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    ThreadingHTTPServer = None
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from opacify import Opacify
+
+#
+# Test fixtures.
+#
+# A site is a small deterministic corpus served by a local http.server that
+# honours single Range requests, counts the requests per path and can be told
+# to fail a path a number of times with a given status, with 'short' to cut
+# the body off half way or with 'clip' to send only half of it.
+#
+SOURCE_COUNT = 4
+SOURCE_SIZE = 64 * 1024
+
+class Handler(SimpleHTTPRequestHandler if ThreadingHTTPServer else object):
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        site = self.server.site
+        with site.lock:
+            site.hits[self.path] = site.hits.get(self.path, 0) + 1
+            (left, status) = site.failing.get(self.path, (0, None))
+            if left:
+                site.failing[self.path] = (left - 1, status)
+        if left and status not in ('short', 'clip'):
+            self.send_error(status)
+            return None
+        rng = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+        size = os.path.getsize(path)
+        if rng:
+            (first, last) = rng.split('=', 1)[1].split('-')
+            (first, last) = (int(first), min(int(last), size - 1))
+        else:
+            (first, last) = (0, size - 1)
+        if first >= size:
+            self.send_error(416)
+            return None
+        if rng:
+            with site.lock:
+                site.ranges.append((self.path, first, last + 1))
+        f = open(path, 'rb')
+        f.seek(first)
+        if rng:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+        else:
+            self.send_response(200)
+        length = last - first + 1
+        if left and status == 'clip':
+            # A complete response that is shorter than it should be
+            length //= 2
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        if left and status == 'short':
+            # Drop the connection half way through the body
+            self.close_connection = True
+            return _Limited(f, length // 2)
+        return _Limited(f, length)
+
+class _Limited(object):
+    # The first n bytes of a file, for copyfile()
+    def __init__(self, f, n):
+        self.f = f
+        self.n = n
+
+    def read(self, size=-1):
+        if size < 0 or size > self.n:
+            size = self.n
+        data = self.f.read(size)
+        self.n -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class Site(object):
+    def __init__(self, root):
+        self.root = root
+        self.www = os.path.join(root, 'www')
+        os.mkdir(self.www)
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.ranges = []
+        self.failing = {}
+        self.sources = {}
+        rng = random.Random(1234)
+        for i in range(SOURCE_COUNT):
+            # Random bytes, the first source also holds every byte value so
+            # any input can be pacified
+            data = bytes(bytearray(rng.getrandbits(8) for _ in range(SOURCE_SIZE)))
+            if i == 0:
+                data = bytes(bytearray(range(256))) + data
+            self.sources['s%d.bin' % (i)] = data
+            with open(os.path.join(self.www, 's%d.bin' % (i)), 'wb') as f:
+                f.write(data)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=self.www))
+        self.server.site = self
+        self.base = 'http://127.0.0.1:%d' % (self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url_file = self.path('urls.txt')
+        self.write_urls(self.url_file, sorted(self.sources))
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def url(self, name):
+        return '%s/%s' % (self.base, name)
+
+    def write_urls(self, path, names):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.url(name) for name in names) + '\n')
+
+    def fail(self, name, times, status=503):
+        self.failing['/' + name] = (times, status)
+
+    def make_input(self, name, size, seed=1, repeat=False):
+        # Spans copied out of the sources, with a copy of the first half
+        # appended again when repeat is set
+        rng = random.Random(seed)
+        sources = [self.sources[key] for key in sorted(self.sources)]
+        out = bytearray()
+        while len(out) < size:
+            src = rng.choice(sources)
+            n = rng.randint(16, 512)
+            start = rng.randrange(len(src) - n)
+            out += src[start:start + n]
+        data = bytes(out[:size])
+        if repeat:
+            data += data[:size // 2]
+        path = self.path(name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+CLI = [sys.executable, '-c', 'import sys; from opacify.opacify_cli import main; sys.argv[0] = "opacify"; main()']
+
+def cli(args, **kw):
+    # Start the command line tool in a new process
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.Popen(CLI + list(args), env=env, **kw)
+
+def opacify(cache_dir, **kw):
+    kw.setdefault('progress', 'quiet')
+    return Opacify(cache_dir=cache_dir, **kw)
+
+def pacify(site, input_file, manifest, cache='pcache', **kw):
+    o = opacify(site.path(cache))
+    kw.setdefault('overwrite', True)
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=manifest, **kw)
+    return (o, r)
+
+@pytest.fixture
+def site(tmp_path):
+    if ThreadingHTTPServer is None:
+        pytest.skip('http.server.ThreadingHTTPServer is not available')
+    s = Site(str(tmp_path))
+    yield s
+    s.close()
@@ -0,0 +1,82 @@
+import io
+import random
+import threading
+
+import pytest
+
+import opacify.api as api
+from opacify import Library, OpacifyError, NotCoveredError, SourceError, IntegrityError, StatusCodes
+
+def make_library():
+    rng = random.Random(7)
+    # No source has the byte 0xff
+    a = bytes(bytearray(rng.randrange(255) for _ in range(20000)))
+    b = bytes(bytearray(range(255))) + a[:5000]
+    return Library([('http://example.com/a.bin', a), ('http://example.com/b.bin', b)]), a
+
+@pytest.mark.parametrize('fmt', ['v2', 'text'])
+def test_roundtrip(fmt):
+    (lib, a) = make_library()
+    data = a[100:5000] + a[7000:9000] + a[100:5000]
+    manifest = lib.pacify_bytes(data, fmt=fmt)
+    assert lib.satisfy_bytes(manifest) == data
+    out = io.BytesIO()
+    lib.pacify(io.BytesIO(data), out, fmt=fmt)
+    assert lib.satisfy_bytes(out.getvalue()) == data
+
+def test_threads(monkeypatch):
+    # Threads sharing a library build its index once
+    (lib, a) = make_library()
+    builds = []
+    build = api.GramTables.build
+    def counted(urls, corpus):
+        builds.append(urls)
+        return build(urls, corpus)
+    monkeypatch.setattr(api.GramTables, 'build', staticmethod(counted))
+    inputs = [a[i * 1000:i * 1000 + 4000] + a[:500] for i in range(8)]
+    results = [None] * len(inputs)
+    def run(i):
+        results[i] = lib.satisfy_bytes(lib.pacify_bytes(inputs[i]))
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(inputs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == inputs
+    assert len(builds) == 1
+
+def test_not_covered():
+    (lib, a) = make_library()
+    with pytest.raises(NotCoveredError) as e:
+        lib.pacify_bytes(a[:100] + b'\xff')
+    assert e.value.offset == 100
+
+def test_missing_source():
+    (lib, a) = make_library()
+    manifest = lib.pacify_bytes(a[:1000])
+    other = Library([('http://example.com/b.bin', b'x')])
+    with pytest.raises(SourceError) as e:
+        other.satisfy_bytes(manifest)
+    assert e.value.url == 'http://example.com/a.bin'
+
+@pytest.mark.parametrize('fmt', ['v2', 'text'])
+def test_damaged_manifest(fmt):
+    (lib, a) = make_library()
+    manifest = lib.pacify_bytes(a[100:5000] + a[7000:9000], fmt=fmt)
+    for damaged in (b'', b'garbage' * 10, manifest[:len(manifest) // 2], manifest[:12]):
+        with pytest.raises(OpacifyError) as e:
+            lib.satisfy_bytes(damaged)
+        assert e.value.code == StatusCodes.E_MANIFEST
+
+def test_manifest_not_found(tmp_path):
+    (lib, a) = make_library()
+    with pytest.raises(OpacifyError) as e:
+        lib.satisfy(str(tmp_path / 'missing.man'), io.BytesIO())
+    assert e.value.code == StatusCodes.E_OPEN_MANIFEST
+
+def test_integrity():
+    (lib, a) = make_library()
+    manifest = lib.pacify_bytes(a[:1000])
+    lib.add('http://example.com/a.bin', b'\0' + a[1:])
+    with pytest.raises(IntegrityError):
+        lib.satisfy_bytes(manifest)
@@ -0,0 +1,47 @@
+import os
+import json
+import multiprocessing
+
+from opacify import StatusCodes
+from opacify.opacify import BATCH_SUMMARY, BATCH_SUFFIX
+import opacify.opacify as opacify_module
+from conftest import opacify, read
+
+def run_batch(site):
+    inputs = site.path('inputs')
+    os.makedirs(os.path.join(inputs, 'sub'))
+    paths = []
+    for (i, name) in enumerate(['a.bin', 'b.bin', os.path.join('sub', 'c.bin')]):
+        path = os.path.join(inputs, name)
+        os.rename(site.make_input('in%d.bin' % (i), 5000 + i * 1000, seed=i), path)
+        paths.append(path)
+    out_dir = site.path('manifests')
+    o = opacify(site.path('pcache'))
+    r = o.pacify_batch(inputs=inputs, url_file=site.url_file, out_dir=out_dir, threads=2)
+    assert r == StatusCodes.OK
+    with open(os.path.join(out_dir, BATCH_SUMMARY)) as f:
+        summary = json.load(f)
+    assert (summary['inputs'], summary['failed']) == (3, 0)
+    for path in paths:
+        manifest = os.path.join(out_dir, os.path.relpath(path, inputs) + BATCH_SUFFIX)
+        s = opacify(site.path('scache'))
+        r = s.satisfy(manifest=manifest, out_file=site.path('out.bin'), overwrite=True)
+        assert r == StatusCodes.OK
+        assert read(site.path('out.bin')) == read(path)
+
+def test_batch(site):
+    run_batch(site)
+
+def test_batch_spawn_default(site):
+    # Workers are forked even where the default start method is spawn
+    method = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method('spawn', force=True)
+    try:
+        run_batch(site)
+    finally:
+        multiprocessing.set_start_method(method, force=True)
+
+def test_batch_without_fork(site, monkeypatch):
+    # Without fork the inputs are pacified in the one process
+    monkeypatch.setattr(opacify_module, '_fork_context', lambda: None)
+    run_batch(site)
@@ -0,0 +1,137 @@
+import os
+import fcntl
+import subprocess
+import pytest
+
+from opacify import StatusCodes
+from opacify.manifest import open_manifest
+from opacify.grams import GramTables
+from conftest import cli, opacify, pacify, read
+
+def cached(path):
+    return sorted(name for name in os.listdir(path) if name.startswith('opacify-'))
+
+def test_kept_cache(site):
+    input_file = site.make_input('input.bin', 5000)
+    (_, r) = pacify(site, input_file, site.path('t.man'), keep_cache=True)
+    assert r == StatusCodes.OK
+    assert len([name for name in cached(site.path('pcache')) if name.endswith('.tmp')]) >= 4
+
+def test_grams_saved_with_kept_cache(site, monkeypatch):
+    # The gram tables only go to disk when the cache outlives the run
+    saved = []
+    monkeypatch.setattr(GramTables, 'save', lambda self, path: saved.append(path))
+    input_file = site.make_input('input.bin', 5000)
+    (_, r) = pacify(site, input_file, site.path('t.man'))
+    assert r == StatusCodes.OK
+    assert saved == []
+    (_, r) = pacify(site, input_file, site.path('t.man'), keep_cache=True)
+    assert r == StatusCodes.OK
+    assert len(saved) == 1
+
+def test_cache_removed(site):
+    input_file = site.make_input('input.bin', 5000)
+    (_, r) = pacify(site, input_file, site.path('t.man'))
+    assert r == StatusCodes.OK
+    assert cached(site.path('pcache')) == []
+
+def test_failed_pacify_keeps_cache(site):
+    input_file = site.make_input('input.bin', 5000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest, keep_cache=True)
+    assert r == StatusCodes.OK
+    before = cached(site.path('pcache'))
+    for keep_cache in (True, False):
+        (_, r) = pacify(site, input_file, manifest, keep_cache=keep_cache, overwrite=False)
+        assert r == StatusCodes.E_MANIFEST_EXISTS
+        assert cached(site.path('pcache')) == before
+
+def hold_shared(path):
+    # Another user of the cache
+    f = open(os.path.join(path, 'opacify.lock'), 'a')
+    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+    return f
+
+def test_cache_kept_while_in_use(site):
+    input_file = site.make_input('input.bin', 5000)
+    os.mkdir(site.path('pcache'))
+    lock_f = hold_shared(site.path('pcache'))
+    (_, r) = pacify(site, input_file, site.path('t.man'))
+    assert r == StatusCodes.OK
+    assert cached(site.path('pcache'))
+    lock_f.close()
+    (_, r) = pacify(site, input_file, site.path('t.man'))
+    assert cached(site.path('pcache')) == []
+
+def test_eviction_skipped_while_in_use(site):
+    input_file = site.make_input('input.bin', 5000)
+    os.mkdir(site.path('pcache'))
+    lock_f = hold_shared(site.path('pcache'))
+    o = opacify(site.path('pcache'), cache_limit='1K')
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=site.path('t.man'))
+    assert r == StatusCodes.OK
+    assert len(cached(site.path('pcache'))) >= 4
+    lock_f.close()
+    assert o.cache.evict() > 0
+
+def test_satisfy_error_releases_lock(site):
+    input_file = site.make_input('input.bin', 5000)
+    (_, r) = pacify(site, input_file, site.path('t.man'))
+    out_file = site.path('out.bin')
+    open(out_file, 'wb').close()
+    o = opacify(site.path('scache'))
+    r = o.satisfy(manifest=site.path('t.man'), out_file=out_file)
+    assert r == StatusCodes.E_OUTFILE_EXISTS
+    with open(os.path.join(site.path('scache'), 'opacify.lock'), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def test_errors_release_lock(site):
+    # An exception part way through a run still releases the cache lock
+    input_file = site.make_input('input.bin', 5000)
+    missing = site.path('missing.txt')
+    o = opacify(site.path('pcache'))
+    runs = [
+        lambda: o.pacify(input_file=input_file, url_file=missing, manifest=site.path('t.man')),
+        lambda: o.plan(input_file=input_file, url_file=missing),
+        # The output directory is a file
+        lambda: o.pacify_batch(inputs=[input_file], url_file=site.url_file, out_dir=input_file),
+    ]
+    for run in runs:
+        with pytest.raises(OSError):
+            run()
+        with open(os.path.join(site.path('pcache'), 'opacify.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def test_concurrent_cache(site):
+    # Processes sharing one bounded cache all finish with correct output
+    input_file = site.make_input('input.bin', 20000)
+    (_, r) = pacify(site, input_file, site.path('t.man'))
+    assert r == StatusCodes.OK
+    procs = []
+    for i in range(4):
+        procs.append(cli(['satisfy', '-m', site.path('t.man'), '-o', site.path('out%d.bin' % (i)),
+            '-c', site.path('shared'), '-L', '100K', '--progress', 'quiet'], stdout=subprocess.DEVNULL))
+    procs.append(cli(['pacify', '-i', input_file, '-u', site.url_file, '-m', site.path('t2.man'),
+        '-c', site.path('shared'), '-L', '100K', '--progress', 'quiet'], stdout=subprocess.DEVNULL))
+    for p in procs:
+        assert p.wait() == 0
+    for i in range(4):
+        assert read(site.path('out%d.bin' % (i))) == read(input_file)
+    (_, sha, length) = open_manifest(site.path('t2.man')).header()
+    assert (sha, length) == open_manifest(site.path('t.man')).header()[1:]
+
+def test_limit_evicts_indexes_first(site):
+    # The gram tables alone are larger than the limit, the downloads are not
+    input_file = site.make_input('input.bin', 5000)
+    o = opacify(site.path('pcache'), cache_limit='300K')
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=site.path('t.man'))
+    assert r == StatusCodes.OK
+    names = cached(site.path('pcache'))
+    assert not [name for name in names if name.endswith('.idx')]
+    for name in site.sources:
+        assert os.path.exists(o._cache_path(site.url(name)))
+    assert o.cache.usage()[0] <= 300 * 1024
+    site.hits.clear()
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=site.path('t.man'), overwrite=True)
+    assert r == StatusCodes.OK
+    assert site.hits == {}
@@ -0,0 +1,44 @@
+import pytest
+
+import opacify.grams as grams_module
+from opacify.grams import GramTables, position_type
+from opacify.corpus import MemoryCorpus
+
+URLS = ['http://a/1', 'http://a/2']
+
+def corpus():
+    return MemoryCorpus([(URLS[0], b'abcabd'), (URLS[1], b'xyzabcq')])
+
+def test_position_type():
+    assert position_type(0) == 'i'
+    assert position_type((1 << 31) - 1) == 'i'
+    assert position_type(1 << 31) == 'q'
+
+@pytest.mark.parametrize('typecode', ['i', 'q'])
+@pytest.mark.parametrize('with_numpy', [True, False])
+def test_find(monkeypatch, tmp_path, typecode, with_numpy):
+    if not with_numpy:
+        monkeypatch.setattr(grams_module, 'numpy', None)
+    elif grams_module.numpy is None:
+        pytest.skip('NumPy is not installed')
+    monkeypatch.setattr(grams_module, 'position_type', lambda total: typecode)
+    c = corpus()
+    grams = GramTables.build(URLS, c)
+    assert grams.typecode == typecode
+    # The first url in the list wins, then the first occurrence in it
+    assert grams.find(b'abc') == (3, 0, URLS[0])
+    assert grams.find(b'xyzz') == (3, 0, URLS[1])
+    assert grams.find(b'cq') == (2, 5, URLS[1])
+    assert grams.find(b'bx') == (1, 1, URLS[0])
+    assert grams.find(b'!') is None
+    path = str(tmp_path / 'grams.idx')
+    grams.save(path)
+    loaded = GramTables.load(path, URLS, c)
+    assert loaded.typecode == typecode
+    assert loaded.find(b'cq') == (2, 5, URLS[1])
+
+def test_find_checks_bytes():
+    # A position that does not hold the gram is never returned
+    grams = GramTables.build(URLS, corpus())
+    grams.tables[3][int.from_bytes(b'abd', 'big')] = 0
+    assert grams.find(b'abd') == (2, 0, URLS[0])
@@ -0,0 +1,99 @@
+import os
+import json
+
+import pytest
+
+from opacify import StatusCodes
+from opacify import manifest as manifest_module
+from opacify.checkpoint import checkpoint_path
+from opacify.incremental import cdc_chunks, CDC_MAX
+from conftest import opacify, pacify, read
+
+def edit(data):
+    # An insert a third of the way in and a changed byte at two thirds
+    data = bytearray(data)
+    data[len(data) // 3:len(data) // 3] = b'EDITED'
+    data[2 * len(data) // 3] ^= 0xff
+    return bytes(data)
+
+def test_cdc_reuse_after_edit():
+    # Low-entropy records still get cut often enough that an edit only
+    # invalidates the chunks around it
+    data = b''.join(b'record: name=abc value=%08d flags=--------\n' % (i) for i in range(12000))
+    old = set(chunk for (_, chunk) in cdc_chunks([data]))
+    new = edit(data)
+    chunks = list(cdc_chunks([new[i:i+65536] for i in range(0, len(new), 65536)]))
+    assert b''.join(chunk for (_, chunk) in chunks) == new
+    assert max(len(chunk) for (_, chunk) in chunks) < CDC_MAX
+    lost = sum(len(chunk) for (_, chunk) in chunks if chunk not in old)
+    assert lost < CDC_MAX
+
+def test_incremental_pacify(site):
+    input_file = site.make_input('input.bin', 200000)
+    (_, r) = pacify(site, input_file, site.path('old.man'), keep_cache=True)
+    assert r == StatusCodes.OK
+    with open(site.path('new.bin'), 'wb') as f:
+        f.write(edit(read(input_file)))
+    (o, r) = pacify(site, site.path('new.bin'), site.path('new.man'), keep_cache=True, previous=site.path('old.man'))
+    assert r == StatusCodes.OK
+    assert o.reused > 100000
+    s = opacify(site.path('scache'))
+    r = s.satisfy(manifest=site.path('new.man'), out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(site.path('new.bin'))
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(o, calls):
+    # Make the match loop of o fail after a number of lookups
+    find_buf = o._find_buf
+    left = [calls]
+    def find(buf, urls):
+        left[0] -= 1
+        if left[0] < 0:
+            raise Interrupted()
+        return find_buf(buf, urls)
+    o._find_buf = find
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    # Checkpoints are taken per manifest block
+    monkeypatch.setattr(manifest_module, 'BLOCK_ITEMS', 16)
+
+@pytest.mark.parametrize('threads', [None, 2])
+def test_resume_after_failure(site, small_blocks, threads):
+    # A run cut short is finished from its checkpoint, by one or more workers
+    input_file = site.make_input('input.bin', 60000)
+    manifest = site.path('t.man')
+    o = opacify(site.path('pcache'))
+    o.checkpoint_interval = 0
+    interrupt_after(o, 100)
+    with pytest.raises(Interrupted):
+        o.pacify(input_file=input_file, url_file=site.url_file, manifest=manifest, overwrite=True)
+    with open(checkpoint_path(manifest)) as f:
+        state = json.load(f)
+    assert 0 < state['offset'] <= state['hashed'] <= os.path.getsize(input_file)
+    assert state['offset'] < os.path.getsize(input_file)
+    o = opacify(site.path('pcache'))
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=manifest, resume=True, threads=threads)
+    assert r == StatusCodes.OK
+    assert not os.path.exists(checkpoint_path(manifest))
+    s = opacify(site.path('scache'))
+    r = s.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+def test_resume_changed_input(site, small_blocks):
+    input_file = site.make_input('input.bin', 60000)
+    manifest = site.path('t.man')
+    o = opacify(site.path('pcache'))
+    o.checkpoint_interval = 0
+    interrupt_after(o, 100)
+    with pytest.raises(Interrupted):
+        o.pacify(input_file=input_file, url_file=site.url_file, manifest=manifest, overwrite=True)
+    with open(input_file, 'r+b') as f:
+        f.write(b'changed')
+    o = opacify(site.path('pcache'))
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=manifest, resume=True)
+    assert r == StatusCodes.E_CHECKPOINT
@@ -0,0 +1,74 @@
+import io
+import random
+import hashlib
+
+import pytest
+
+from opacify import StatusCodes
+from opacify import manifest as manifest_module
+from opacify.manifest import ManifestWriter, ManifestReader, open_manifest
+from conftest import opacify, pacify, read
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(manifest_module, 'BLOCK_ITEMS', 4)
+
+def test_block_digests_bounded(monkeypatch):
+    # Data is fed ahead of the items, the writer only keeps what no item
+    # covers yet rather than the data of the whole block
+    monkeypatch.setattr(manifest_module, 'BLOCK_ITEMS', 64)
+    rng = random.Random(3)
+    data = bytes(bytearray(rng.getrandbits(8) for _ in range(1 << 20)))
+    out = io.BytesIO()
+    writer = ManifestWriter(out)
+    fed = 0
+    added = 0
+    buffered = 0
+    while added < len(data):
+        if fed < len(data) and fed - added < 65536:
+            writer.feed(data[fed:fed + 16384])
+            fed = min(fed + 16384, len(data))
+        length = min(rng.randint(1, 4000), fed - added)
+        writer.add('http://example.com/a', added, length)
+        added += length
+        buffered = max(buffered, len(writer._data))
+    writer.close('test', hashlib.sha256(data).hexdigest(), len(data))
+    assert buffered <= 65536 + 16384
+    reader = ManifestReader(io.BytesIO(out.getvalue()))
+    blocks = reader.blocks()
+    assert len(blocks) > 1
+    for b in blocks:
+        assert b.digest == hashlib.sha256(data[b.out_offset:b.out_offset + b.out_length]).digest()
+
+def test_stream_pacify_digests(site, small_blocks):
+    # Several blocks written from a stream all get digests satisfy checks
+    input_file = site.make_input('input.bin', 30000)
+    manifest = site.path('t.man')
+    o = opacify(site.path('pcache'))
+    with open(input_file, 'rb') as f:
+        r = o.pacify(input_file=f, url_file=site.url_file, manifest=manifest, overwrite=True)
+    assert r == StatusCodes.OK
+    blocks = open_manifest(manifest).blocks()
+    assert len(blocks) > 1
+    assert all(b.digest is not None for b in blocks)
+    s = opacify(site.path('scache'))
+    r = s.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+def test_corrupt_blocks_pinpointed(site, small_blocks):
+    input_file = site.make_input('input.bin', 30000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest)
+    assert r == StatusCodes.OK
+    blocks = open_manifest(manifest).blocks()
+    # Change one byte of the rebuilt output
+    data = bytearray(read(input_file))
+    data[blocks[2].out_offset] ^= 0xff
+    with open(site.path('out.bin'), 'wb') as f:
+        f.write(data)
+    (version, sha, length) = open_manifest(manifest).header()
+    o = opacify(site.path('scache'))
+    r = o.validate_output(site.path('out.bin'), sha, length, open_manifest(manifest))
+    assert r == StatusCodes.E_HASH_MISMATCH
+    assert [b.out_offset for b in o.corrupt] == [blocks[2].out_offset]
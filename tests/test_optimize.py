@@ -0,0 +1,43 @@
+import os
+
+from opacify import StatusCodes
+from opacify.manifest import open_manifest
+from conftest import opacify, pacify, read
+
+def test_optimize(site):
+    # dup.bin is a copy of part of s1 listed first, so pacify takes that part
+    # from it. Optimize moves those items to s1, which the manifest uses as
+    # well, drops the url and joins the matches that the match window cut
+    # into pieces.
+    s1 = site.sources['s1.bin']
+    s2 = site.sources['s2.bin']
+    with open(os.path.join(site.www, 'dup.bin'), 'wb') as f:
+        f.write(s1[1000:3000])
+    site.write_urls(site.url_file, ['dup.bin'] + sorted(site.sources))
+    input_file = site.path('input.bin')
+    with open(input_file, 'wb') as f:
+        f.write(s1[1000:3000] + s2[:20000] + s1[5000:6000])
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest, keep_cache=True)
+    assert r == StatusCodes.OK
+    before = list(open_manifest(manifest).entries())
+    assert site.url('dup.bin') in set(url for (url, _, _) in before)
+
+    o = opacify(site.path('pcache'))
+    optimized = site.path('o.man')
+    r = o.optimize(manifest=manifest, out_file=optimized)
+    assert r == StatusCodes.OK
+    after = list(open_manifest(optimized).entries())
+    assert len(after) < len(before)
+    assert len(set(url for (url, _, _) in after)) < len(set(url for (url, _, _) in before))
+    assert o.optimized['dropped'] == [site.url('dup.bin')]
+    assert (o.optimized['items_before'], o.optimized['items_after']) == (len(before), len(after))
+    assert site.url('dup.bin') not in set(url for (url, _, _) in after)
+    assert open_manifest(optimized).header() == open_manifest(manifest).header()
+
+    # The optimized manifest still rebuilds the input, without dup.bin
+    os.unlink(os.path.join(site.www, 'dup.bin'))
+    s = opacify(site.path('scache'))
+    r = s.satisfy(manifest=optimized, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
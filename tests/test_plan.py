@@ -0,0 +1,21 @@
+from opacify import StatusCodes
+from conftest import opacify, read
+
+def test_plan_selects_urls(site):
+    # Most of the input comes from s2 and the rest from s1, s0 and s3 add
+    # nothing
+    s1 = site.sources['s1.bin']
+    s2 = site.sources['s2.bin']
+    input_file = site.path('input.bin')
+    with open(input_file, 'wb') as f:
+        f.write(s2[:30000] + s1[:10000] + s2[40000:50000])
+    o = opacify(site.path('pcache'))
+    out_file = site.path('planned.txt')
+    r = o.plan(input_file=input_file, url_file=site.url_file, out_file=out_file)
+    assert r == StatusCodes.OK
+    assert [url for (url, _, _) in o.planned['kept']] == [site.url('s2.bin'), site.url('s1.bin')]
+    assert read(out_file).decode('utf-8').split() == [site.url('s2.bin'), site.url('s1.bin')]
+    (gain2, gain1) = [gain for (_, gain, _) in o.planned['kept']]
+    assert gain2 > gain1 > 0
+    assert sorted(url for (url, _) in o.planned['dropped']) == [site.url('s0.bin'), site.url('s3.bin')]
+    assert o.planned['uncovered'] == []
@@ -0,0 +1,61 @@
+import io
+import json
+import time
+import subprocess
+
+from opacify import StatusCodes
+import opacify.progress as progress_module
+from opacify.progress import Progress
+from conftest import cli, opacify
+
+def test_json_lines(monkeypatch):
+    monkeypatch.setattr(progress_module, 'JSON_INTERVAL', 0.01)
+    stream = io.StringIO()
+    p = Progress(100, 'pacify', mode='json', stream=stream).start()
+    thread = p._thread
+    assert thread.is_alive()
+    for done in range(0, 101, 20):
+        p.set(done)
+        time.sleep(0.02)
+    p.stop()
+    # The reporter is joined before the final line is written
+    assert not thread.is_alive()
+    assert p._thread is None
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(lines) >= 2
+    assert all(line['task'] == 'pacify' and line['total'] == 100 for line in lines)
+    assert [line['finished'] for line in lines] == [False] * (len(lines) - 1) + [True]
+    assert lines[-1]['done'] == 100
+    dones = [line['done'] for line in lines]
+    assert dones == sorted(dones)
+
+def test_quiet_starts_no_thread():
+    p = Progress(100, 'pacify', mode='quiet').start()
+    assert p._thread is None
+    p.stop()
+
+def test_pacify_json_progress(site):
+    input_file = site.make_input('input.bin', 20000)
+    p = cli(['pacify', '-i', input_file, '-u', site.url_file, '-m', site.path('t.man'), '-c', site.path('pcache'),
+        '--progress', 'json'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (_, err) = p.communicate()
+    assert p.returncode == 0
+    lines = [json.loads(line) for line in err.decode('utf-8').splitlines() if line.startswith('{')]
+    pacify = [line for line in lines if line['task'] == 'pacify']
+    assert pacify[-1] == dict(pacify[-1], finished=True, done=20000, total=20000)
+
+def test_reporter_joined_in_process(site, monkeypatch):
+    # No reporter thread outlives a run
+    threads = []
+    start = Progress.start
+    def started(self):
+        start(self)
+        threads.append(self._thread)
+        return self
+    monkeypatch.setattr(Progress, 'start', started)
+    input_file = site.make_input('input.bin', 20000)
+    o = opacify(site.path('pcache'), progress='json')
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=site.path('t.man'))
+    assert r == StatusCodes.OK
+    assert threads and all(t is not None for t in threads)
+    assert [t for t in threads if t.is_alive()] == []
@@ -0,0 +1,60 @@
+import os
+
+from opacify import StatusCodes
+from opacify.manifest import open_manifest
+from opacify.ranges import coalesce
+from opacify.fetch import Fetcher
+from conftest import opacify, pacify, read
+
+def test_ranges_coalesced(site):
+    # Items close together in a source are fetched with one range request
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    pacify(site, input_file, manifest)
+    items = list(open_manifest(manifest).entries())
+    o = opacify(site.path('scache'))
+    r = o.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+    assert site.ranges
+    assert len(site.ranges) < len(items)
+    assert len(site.ranges) == len(set(path for (path, _, _) in site.ranges))
+
+def test_ranges_split_by_gap(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    pacify(site, input_file, manifest)
+    o = opacify(site.path('scache'), range_gap=0)
+    r = o.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+    assert len(site.ranges) > len(set(path for (path, _, _) in site.ranges))
+
+def test_without_ranges(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    pacify(site, input_file, manifest)
+    o = opacify(site.path('scache'), ranges=False)
+    r = o.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+    assert site.ranges == []
+
+def test_short_range_retried(site):
+    # A range response with fewer bytes than asked for is never stored
+    data = site.sources['s1.bin']
+    site.fail('s1.bin', 1, status='clip')
+    fetcher = Fetcher(backoff=0.01)
+    (kind, err) = fetcher.fetch_range(site.url('s1.bin'), 100, 1100, site.path('range'), site.path('full'))
+    assert (kind, err) == ('range', None)
+    assert site.hits['/s1.bin'] == 2
+    assert read(site.path('range')) == data[100:1100]
+    site.fail('s1.bin', 100, status='clip')
+    (kind, err) = fetcher.fetch_range(site.url('s1.bin'), 100, 1100, site.path('range2'), site.path('full'))
+    assert kind is None and err.startswith('Short range')
+    assert not os.path.exists(site.path('range2'))
+
+def test_coalesce():
+    assert coalesce([(10, 20), (0, 5), (15, 30)], gap=0) == [(0, 5), (10, 30)]
+    assert coalesce([(10, 20), (0, 5)], gap=5) == [(0, 20)]
+    assert coalesce([(0, 1), (10, 11), (40, 41)], gap=0, max_spans=2) == [(0, 11), (40, 41)]
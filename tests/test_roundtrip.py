@@ -0,0 +1,95 @@
+import subprocess
+import multiprocessing
+
+from opacify import StatusCodes
+from opacify.fetch import Fetcher
+import opacify.opacify as opacify_module
+from conftest import cli, opacify, pacify, read
+
+def satisfy(site, manifest, out_file, cache='scache', **kw):
+    o = opacify(site.path(cache))
+    kw.setdefault('overwrite', True)
+    r = o.satisfy(manifest=manifest, out_file=out_file, **kw)
+    return (o, r)
+
+def test_roundtrip(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest)
+    assert r == StatusCodes.OK
+    (_, r) = satisfy(site, manifest, site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+def test_roundtrip_parallel(site):
+    input_file = site.make_input('input.bin', 40000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest, threads=2)
+    assert r == StatusCodes.OK
+    (_, r) = satisfy(site, manifest, site.path('out.bin'), jobs=4)
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+def test_roundtrip_parallel_spawn_default(site):
+    # Workers are forked even where the default start method is spawn
+    method = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method('spawn', force=True)
+    try:
+        input_file = site.make_input('input.bin', 40000)
+        manifest = site.path('t.man')
+        (_, r) = pacify(site, input_file, manifest, threads=2)
+    finally:
+        multiprocessing.set_start_method(method, force=True)
+    assert r == StatusCodes.OK
+    (_, r) = satisfy(site, manifest, site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+def test_pacify_parallel_without_fork(site, monkeypatch):
+    # Without fork a parallel pacify runs in the one process
+    monkeypatch.setattr(opacify_module, '_fork_context', lambda: None)
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest, threads=2)
+    assert r == StatusCodes.OK
+    (_, r) = satisfy(site, manifest, site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+def test_fetch_retries(site):
+    input_file = site.make_input('input.bin', 5000)
+    site.fail('s1.bin', 2)
+    o = opacify(site.path('pcache'))
+    o.fetcher.backoff = 0.01
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=site.path('t.man'))
+    assert r == StatusCodes.OK
+    assert site.hits['/s1.bin'] == 3
+
+def test_fetch_retries_short_body(site):
+    # A connection dropped in the middle of the body is retried like any
+    # other connection error and does not fail the url
+    site.fail('s1.bin', 2, status='short')
+    fetcher = Fetcher(backoff=0.01)
+    assert fetcher.fetch(site.url('s1.bin'), site.path('s1.copy')) is None
+    assert site.hits['/s1.bin'] == 3
+    assert fetcher.failed == set()
+    assert read(site.path('s1.copy')) == site.sources['s1.bin']
+
+def test_fetch_permanent_failure(site):
+    input_file = site.make_input('input.bin', 5000)
+    site.fail('s2.bin', 100, status=404)
+    (o, r) = pacify(site, input_file, site.path('t.man'))
+    assert site.hits['/s2.bin'] == 1
+    assert o.fetcher.failed == set([site.url('s2.bin')])
+
+def test_stream(site):
+    input_file = site.make_input('input.bin', 20000)
+    with open(input_file, 'rb') as f:
+        p = cli(['pacify', '-i', '-', '-u', site.url_file, '-m', '-', '-c', site.path('pcache')],
+            stdin=f, stdout=subprocess.PIPE)
+        manifest = p.communicate()[0]
+    assert p.returncode == 0
+    p = cli(['satisfy', '-m', '-', '-o', '-', '-c', site.path('scache')], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE)
+    out = p.communicate(manifest)[0]
+    assert out == read(input_file)
@@ -0,0 +1,44 @@
+import os
+
+from opacify import StatusCodes
+from opacify.checkpoint import journal_path
+from conftest import opacify, pacify, read
+
+def test_resume_after_failure(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest)
+    assert r == StatusCodes.OK
+    out_file = site.path('out.bin')
+    site.fail('s2.bin', 100, status=404)
+    o = opacify(site.path('scache'))
+    r = o.satisfy(manifest=manifest, out_file=out_file)
+    assert r == StatusCodes.E_FAILED
+    assert os.path.exists(journal_path(out_file))
+    site.failing.clear()
+    site.hits.clear()
+    o = opacify(site.path('scache2'))
+    r = o.satisfy(manifest=manifest, out_file=out_file, resume=True)
+    assert r == StatusCodes.OK
+    assert read(out_file) == read(input_file)
+    assert o.resumed[0] == 3
+    assert list(site.hits) == ['/s2.bin']
+    assert not os.path.exists(journal_path(out_file))
+
+def test_resume_rewrites_damaged_output(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    pacify(site, input_file, manifest)
+    out_file = site.path('out.bin')
+    site.fail('s2.bin', 100, status=404)
+    o = opacify(site.path('scache'))
+    assert o.satisfy(manifest=manifest, out_file=out_file) == StatusCodes.E_FAILED
+    site.failing.clear()
+    # Zero the whole output, no journal entry may be trusted
+    with open(out_file, 'r+b') as f:
+        f.write(b'\0' * os.path.getsize(out_file))
+    o = opacify(site.path('scache2'))
+    r = o.satisfy(manifest=manifest, out_file=out_file, resume=True)
+    assert r == StatusCodes.OK
+    assert o.resumed == (0, 0)
+    assert read(out_file) == read(input_file)
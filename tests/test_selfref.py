@@ -0,0 +1,45 @@
+import subprocess
+
+from opacify import StatusCodes
+from opacify.manifest import open_manifest
+from opacify.selfref import SELF_URL, expand_self_refs, OutputWindow
+from conftest import cli, opacify, pacify, read
+
+def test_expand_overlapping():
+    # A back reference may overlap the output it produces
+    items = [('a', 0, 3), (SELF_URL, 1, 5)]
+    assert list(expand_self_refs(items)) == [('a', 0, 3), ('a', 1, 2), ('a', 1, 2), ('a', 1, 1)]
+    window = OutputWindow()
+    window.write(b'xyz')
+    assert window.resolve(1, 5) == b'yzyzy'
+
+def test_roundtrip_self_refs(site):
+    input_file = site.make_input('input.bin', 20000, repeat=True)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest)
+    assert r == StatusCodes.OK
+    refs = [item for item in open_manifest(manifest).entries() if item[0] == SELF_URL]
+    assert sum(length for (_, _, length) in refs) >= 10000 - 512
+    o = opacify(site.path('scache'))
+    r = o.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+    # Streamed to stdout back references are resolved from the output window
+    p = cli(['satisfy', '-m', manifest, '-o', '-', '-c', site.path('scache2')], stdout=subprocess.PIPE)
+    assert p.communicate()[0] == read(input_file)
+
+def test_verify_self_refs(site):
+    input_file = site.make_input('input.bin', 20000, repeat=True)
+    manifest = site.path('t.man')
+    pacify(site, input_file, manifest)
+    o = opacify(site.path('vcache'))
+    assert o.verify(manifest=manifest) == StatusCodes.OK
+
+def test_without_self_refs(site):
+    input_file = site.make_input('input.bin', 20000, repeat=True)
+    manifest = site.path('t.man')
+    o = opacify(site.path('pcache'))
+    o.self_refs = False
+    r = o.pacify(input_file=input_file, url_file=site.url_file, manifest=manifest)
+    assert r == StatusCodes.OK
+    assert not [item for item in open_manifest(manifest).entries() if item[0] == SELF_URL]
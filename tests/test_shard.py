@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+from opacify import StatusCodes
+from opacify.selfref import SELF_URL, expand_self_refs
+from opacify.shard import shard_bounds, split_entries, load_plan
+from conftest import cli, opacify, pacify, read
+
+def test_split_entries():
+    # Shards cover the same bytes and never point into another shard
+    items = [('a', 0, 10), ('b', 5, 10), (SELF_URL, 0, 15), ('a', 20, 5)]
+    bounds = shard_bounds(40, 3)
+    shards = split_entries(items, bounds)
+    flat = list(expand_self_refs(items))
+    for (i, shard) in enumerate(shards):
+        assert sum(length for (_, _, length) in shard) == bounds[i + 1] - bounds[i]
+        out = 0
+        for (url, offset, length) in shard:
+            if url == SELF_URL:
+                assert offset < out
+            out += length
+    expanded = [list(expand_self_refs(shard)) for shard in shards]
+    def data(entries):
+        return b''.join(('%s%d,' % (url, offset + k)).encode() for (url, offset, length) in entries
+            for k in range(length))
+    assert b''.join(data(entries) for entries in expanded) == data(flat)
+
+def test_shard_assemble(site):
+    # Shards are satisfied by separate processes with their own caches
+    input_file = site.make_input('input.bin', 30000, repeat=True)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest)
+    assert r == StatusCodes.OK
+    shards = site.path('shards')
+    o = opacify(site.path('pcache'))
+    r = o.shard(manifest=manifest, out_dir=shards, count=3, input_file=input_file)
+    assert r == StatusCodes.OK
+    plan = load_plan(shards)
+    assert len(plan['shards']) == 3
+    procs = []
+    for (i, shard) in enumerate(plan['shards']):
+        procs.append(cli(['satisfy', '-m', os.path.join(shards, shard['manifest']),
+            '-o', os.path.join(shards, shard['output']), '-c', site.path('node%d' % (i)), '--progress', 'quiet'],
+            stdout=subprocess.DEVNULL))
+    for p in procs:
+        assert p.wait() == 0
+    o = opacify(site.path('acache'))
+    r = o.assemble(plan=shards, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == read(input_file)
+
+    # A damaged shard output is named
+    part = os.path.join(shards, plan['shards'][1]['output'])
+    data = bytearray(read(part))
+    data[0] ^= 0xff
+    with open(part, 'wb') as f:
+        f.write(data)
+    o = opacify(site.path('acache'))
+    r = o.assemble(plan=shards, out_file=site.path('out.bin'), overwrite=True)
+    assert r == StatusCodes.E_HASH_MISMATCH
+    assert o.bad_shards == [1]
+
+    # So is a missing one
+    os.unlink(part)
+    o = opacify(site.path('acache'))
+    r = o.assemble(plan=shards, out_file=site.path('out.bin'), overwrite=True)
+    assert r == StatusCodes.E_OPEN_INPUT_FILE
+    assert o.bad_shards == [1]
@@ -0,0 +1,27 @@
+import json
+
+from conftest import cli, read
+
+def test_stats_json(site):
+    input_file = site.make_input('input.bin', 20000)
+    stats_file = site.path('stats.json')
+    p = cli(['pacify', '-i', input_file, '-u', site.url_file, '-m', site.path('t.man'), '-c', site.path('pcache'),
+        '--stats-json', stats_file, '--progress', 'quiet'])
+    assert p.wait() == 0
+    stats = json.loads(read(stats_file).decode('utf-8'))
+    assert stats['command'] == 'pacify'
+    assert stats['result'] == 'OK'
+    phases = stats['phases']
+    for name in ('download', 'index_build', 'find', 'manifest_write', 'total'):
+        assert phases[name]['calls'] >= 1
+        assert phases[name]['seconds'] >= 0
+    assert phases['total']['seconds'] >= phases['find']['seconds']
+    counters = stats['counters']
+    assert counters['bytes_matched'] + counters.get('bytes_self', 0) == 20000
+    assert counters['find_calls'] >= 1
+    assert counters['bytes_per_match'] == float(counters['bytes_matched']) / counters['find_calls']
+    # Every source was downloaded in full once
+    assert sorted(stats['urls']) == sorted(site.url(name) for name in site.sources)
+    for (name, data) in site.sources.items():
+        assert stats['urls'][site.url(name)]['bytes'] == len(data)
+    assert counters['download_bytes'] == sum(len(data) for data in site.sources.values())
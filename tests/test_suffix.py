@@ -0,0 +1,28 @@
+import os
+
+from opacify import StatusCodes
+from opacify.manifest import open_manifest
+from conftest import opacify, read
+
+def test_roundtrip_suffix(site):
+    # The longest match runs into the end of a short source and on into
+    # another one
+    short = site.sources['s1.bin'][:300]
+    with open(os.path.join(site.www, 'short.bin'), 'wb') as f:
+        f.write(short)
+    site.write_urls(site.url_file, ['short.bin', 's0.bin'])
+    s0 = site.sources['s0.bin']
+    data = short + s0[1000:6000] + short[:50] + s0[9000:9100]
+    with open(site.path('input.bin'), 'wb') as f:
+        f.write(data)
+    manifest = site.path('t.man')
+    o = opacify(site.path('pcache'), engine='suffix')
+    r = o.pacify(input_file=site.path('input.bin'), url_file=site.url_file, manifest=manifest)
+    assert r == StatusCodes.OK
+    items = list(open_manifest(manifest).entries())
+    assert items[0] == (site.url('short.bin'), 0, 300)
+    assert (site.url('s0.bin'), 1000, 4096) in items
+    s = opacify(site.path('scache'))
+    r = s.satisfy(manifest=manifest, out_file=site.path('out.bin'))
+    assert r == StatusCodes.OK
+    assert read(site.path('out.bin')) == data
@@ -0,0 +1,28 @@
+import os
+
+from opacify import StatusCodes
+from conftest import opacify, pacify
+
+def test_verify(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    (_, r) = pacify(site, input_file, manifest)
+    assert r == StatusCodes.OK
+    site.hits.clear()
+    o = opacify(site.path('vcache'))
+    assert o.verify(manifest=manifest) == StatusCodes.OK
+    assert o.broken == {}
+    # Nothing is downloaded
+    assert site.ranges == []
+
+def test_verify_broken(site):
+    input_file = site.make_input('input.bin', 20000)
+    manifest = site.path('t.man')
+    pacify(site, input_file, manifest)
+    os.unlink(os.path.join(site.www, 's3.bin'))
+    with open(os.path.join(site.www, 's2.bin'), 'r+b') as f:
+        f.truncate(100)
+    o = opacify(site.path('vcache'))
+    o.fetcher.backoff = 0.01
+    assert o.verify(manifest=manifest) != StatusCodes.OK
+    assert sorted(o.broken) == [site.url('s2.bin'), site.url('s3.bin')]